@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""
+Periscope API for the masses
+
+Benchmark the built-in TS to MP4 remuxer against the FFMPEG conversion path on synthetic
+segments. Run from the repository root: python benchmarks/bench_remux.py --help
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from subprocess import Popen
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# pylint: disable=wrong-import-position
+from periapi.download import FFMPEG_CONVERT
+from periapi.remux import TsRemuxer
+from synthetic_ts import write_segments
+
+
+def bench_python(segments, target):
+    """Remux segment by segment, the way downloads assemble with the built-in remuxer"""
+    start = time.time()
+    with open(target + '.mp4', 'wb') as handle:
+        remuxer = TsRemuxer(handle)
+        for segment in segments:
+            with open(segment, 'rb') as ts_file:
+                remuxer.feed(ts_file.read())
+            remuxer.flush()
+        remuxer.close()
+    return time.time() - start
+
+
+def bench_ffmpeg(segments, target):
+    """Concatenate to .ts then convert with FFMPEG, the way downloads do by default"""
+    start = time.time()
+    with open(target + '.ts', 'wb') as handle:
+        for segment in segments:
+            with open(segment, 'rb') as ts_file:
+                handle.write(ts_file.read())
+    Popen(FFMPEG_CONVERT.format(target), shell=True).wait()
+    return time.time() - start
+
+
+def main():
+    """Run the benchmark and print a report"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--segments', type=int, nargs='+', default=[10, 100, 400],
+                        help="Segment counts to benchmark")
+    parser.add_argument('--duration', type=float, default=3.0, help="Seconds per segment")
+    parser.add_argument('--bitrate', type=int, default=800000, help="Video bitrate (bits/s)")
+    parser.add_argument('--repeat', type=int, default=3, help="Runs per case, best is kept")
+    args = parser.parse_args()
+
+    engines = [('python', bench_python)]
+    if shutil.which('ffmpeg') is not None:
+        engines.append(('ffmpeg', bench_ffmpeg))
+    else:
+        print("ffmpeg not found, only benchmarking the built-in remuxer.")
+
+    print("{:>9} {:>10} {:>8} {:>10} {:>10}".format(
+        "segments", "input MB", "engine", "seconds", "MB/s"))
+    for count in args.segments:
+        work_dir = tempfile.mkdtemp(prefix='periapi-bench-')
+        try:
+            segments = write_segments(work_dir, count, args.duration,
+                                      video_bitrate=args.bitrate)
+            size = sum(os.path.getsize(segment) for segment in segments) / 1e6
+            for name, bench in engines:
+                target = os.path.join(work_dir, 'out-{}'.format(name))
+                best = min(bench(segments, target) for _ in range(args.repeat))
+                print("{:>9} {:>10.1f} {:>8} {:>10.3f} {:>10.1f}".format(
+                    count, size, name, best, size / best))
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
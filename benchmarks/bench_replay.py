@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+"""
+Periscope API for the masses
+
+Benchmark replay downloads (and, with FFMPEG, live captures) end to end against the local HLS
+stand-in server, across chunk thread counts and conversion engines. Every case runs in a
+fresh process, so its peak RSS and bytes written are its own.
+Run from the repository root: python benchmarks/bench_replay.py --help
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from queue import Empty
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# pylint: disable=wrong-import-position
+from hls_server import HlsStandIn
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+BROADCAST_START = '2026-01-01T00:00:00.000Z'
+REPORTED_PHASES = ('chunks', 'assemble', 'convert', 'capture')
+
+
+class BenchAPI:
+    """Just enough of PeriAPI for a Broadcast to be downloaded: a session holding the config,
+    and broadcast info that turns a live broadcast into a replay after live_seconds"""
+
+    def __init__(self, config, info, live_seconds):
+        self.session = SimpleNamespace(config=config)
+        self.info = info
+        self.ends_at = time.time() + live_seconds
+
+    def get_broadcast_info(self, broadcast_id):
+        """Latest info of the (only) broadcast"""
+        if self.info['state'] == 'RUNNING' and time.time() >= self.ends_at:
+            self.info = dict(self.info, state='ENDED')
+        return dict(self.info)
+
+
+def io_written():
+    """Bytes this process (and the children it has reaped) passed to write calls, or None
+    where /proc doesn't tell"""
+    try:
+        with open('/proc/self/io') as io_file:
+            counters = dict(line.split(': ', 1) for line in io_file.read().splitlines())
+        return int(counters['wchar'])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def peak_rss():
+    """Peak resident memory of this process in MB, or None where it can't be told"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak / (1e6 if sys.platform == 'darwin' else 1e3)
+
+
+def run_case(work_dir, case, results):
+    """Download one broadcast as case describes and put the measurements on results. Runs in
+    its own process, started after PERIAPI_API_BASE points at the stand-in."""
+    # Imported here so the download url constants are read with the stand-in's address
+    from periapi import download
+    from periapi.broadcast import Broadcast
+    from periapi.login import PeriConfig
+
+    os.chdir(work_dir)
+    download_dir = os.path.join(work_dir, 'downloads')
+    os.makedirs(download_dir)
+    with open('.peri.conf', 'w') as config_file:
+        json.dump({'cookie': 'benchmark', 'download_directory': download_dir,
+                   'separate_folders': False, 'remux_engine': case['engine'],
+                   'preallocate': case['preallocate']}, config_file)
+    download.DEFAULT_DL_THREADS = case['threads']
+
+    info = {'id': 'bench{}'.format(case['run']), 'username': 'benchmark',
+            'start': BROADCAST_START, 'state': 'RUNNING' if case['mode'] == 'live' else 'ENDED',
+            'available_for_replay': True, 'is_locked': case['mode'] == 'private'}
+    api = BenchAPI(PeriConfig(), info, case['live_seconds'])
+    broadcast = Broadcast(api, dict(info))
+
+    written = io_written()
+    started = time.time()
+    download_ok, broadcast = download.Download(broadcast).start()
+    wall = time.time() - started
+    written = io_written() - written if written is not None else None
+
+    size = sum(os.path.getsize(os.path.join(download_dir, name))
+               for name in os.listdir(download_dir) if not name.startswith('.'))
+    phases = dict()
+    for record in (broadcast.trace[-1] if broadcast.trace else list()):
+        phases[record['phase']] = phases.get(record['phase'], 0) + record['duration']
+    results.put(dict(case, ok=download_ok, wall=wall, bytes=size, written=written,
+                     rss=peak_rss(), phases=phases,
+                     error=None if download_ok else repr(broadcast.failure_reason)))
+
+
+def measure(case, context):
+    """Run case in a fresh process and return its measurements"""
+    work_dir = tempfile.mkdtemp(prefix='periapi-bench-')
+    results = context.Queue()
+    try:
+        process = context.Process(target=run_case, args=(work_dir, case, results))
+        process.start()
+        # Read the result before joining: the process can't exit while it is unread
+        result = dict(case, ok=False, wall=None, error="Benchmark process failed")
+        while True:
+            try:
+                result = results.get(timeout=1)
+                break
+            except Empty:
+                if not process.is_alive():
+                    break
+        process.join()
+        return result
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def format_row(result):
+    """One line of the report"""
+    def number(value, scale=1.0, width=8, digits=2):
+        return "{:>{w}}".format("n/a", w=width) if value is None else \
+            "{:>{w}.{d}f}".format(value / scale, w=width, d=digits)
+
+    megabytes = result.get('bytes', 0) / 1e6
+    phases = result.get('phases') or dict()
+    return " ".join([
+        "{:>7} {:>7} {:>7} {:>3}".format(result['mode'], result['threads'], result['engine'],
+                                         'ok' if result['ok'] else 'ERR'),
+        number(megabytes, width=8, digits=1),
+        number(result['wall'], width=8),
+        number(megabytes / result['wall'] if result['ok'] and result['wall'] else None,
+               width=8, digits=1),
+        " ".join(number(phases.get(phase), width=10) for phase in REPORTED_PHASES),
+        number(result.get('rss'), width=8, digits=1),
+        number(result.get('written'), scale=1e6, width=9, digits=1)])
+
+
+def main():
+    """Run the benchmark and print a report"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--chunks', type=int, default=100, help="Chunks per replay")
+    parser.add_argument('--chunk-seconds', type=float, default=3.0, help="Seconds per chunk")
+    parser.add_argument('--bitrate', type=int, default=800000, help="Video bitrate (bits/s)")
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help="Seconds the server waits before each response")
+    parser.add_argument('--bandwidth', type=int, default=None,
+                        help="Server bytes/s cap per connection")
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help="Fraction of chunk requests the server fails")
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 6, 12],
+                        help="Chunk download thread counts to benchmark")
+    parser.add_argument('--engines', nargs='+', default=['python', 'ffmpeg'],
+                        help="Conversion engines to benchmark")
+    parser.add_argument('--private', action='store_true',
+                        help="Download through the private replay endpoint")
+    parser.add_argument('--no-preallocate', action='store_true',
+                        help="Don't preallocate the final file")
+    parser.add_argument('--live', type=float, default=0,
+                        help="Also capture a live stream of this many seconds (needs FFMPEG)")
+    parser.add_argument('--repeat', type=int, default=1, help="Runs per case, fastest is kept")
+    parser.add_argument('--seed', type=int, default=None, help="Seed for injected errors")
+    parser.add_argument('--json', default=None, help="Also write the results to this file")
+    args = parser.parse_args()
+
+    engines = list(args.engines)
+    if 'ffmpeg' in engines and shutil.which('ffmpeg') is None:
+        print("ffmpeg not found, not benchmarking the ffmpeg engine or live captures.")
+        engines.remove('ffmpeg')
+        args.live = 0
+
+    standin = HlsStandIn(args.chunks, args.chunk_seconds, args.bitrate, args.latency,
+                         args.bandwidth, args.error_rate, args.live or 60, args.seed).start()
+    os.environ['PERIAPI_API_BASE'] = standin.api_base
+    context = multiprocessing.get_context('spawn')
+
+    cases = [dict(mode='private' if args.private else 'replay', threads=threads, engine=engine)
+             for threads in args.threads for engine in engines]
+    if args.live:
+        cases.extend(dict(mode='live', threads=0, engine=engine) for engine in engines)
+
+    print("{:>7} {:>7} {:>7} {:>3} {:>8} {:>8} {:>8} {} {:>8} {:>9}".format(
+        "mode", "threads", "engine", "", "MB", "wall s", "MB/s",
+        " ".join("{:>10}".format(phase + " s") for phase in REPORTED_PHASES), "RSS MB",
+        "write MB"))
+    results = list()
+    run = 0
+    try:
+        for case in cases:
+            runs = list()
+            for _ in range(args.repeat):
+                run += 1
+                runs.append(measure(dict(case, run=run, live_seconds=args.live,
+                                         preallocate=not args.no_preallocate), context))
+            finished = [i for i in runs if i['ok']]
+            best = min(finished, key=lambda i: i['wall']) if finished else runs[-1]
+            results.append(best)
+            print(format_row(best))
+            if not best['ok']:
+                print("\t{}".format(best['error']))
+    finally:
+        standin.stop()
+
+    print("Server: {0} chunks ({1:.1f} MB) served, {2} errors injected".format(
+        standin.stats['chunks'], standin.stats['bytes_served'] / 1e6,
+        standin.stats['errors_injected']))
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump({'options': vars(args), 'results': results}, json_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
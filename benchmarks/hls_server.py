@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+"""
+Periscope API for the masses
+
+Local stand-in for the Periscope replay and live HLS servers, for benchmarks. Serves the
+access endpoints downloads use plus synthetic playlists and TS chunks, with configurable
+chunk count and size, response latency, a per connection bandwidth cap and injected errors.
+Run from the repository root: python benchmarks/hls_server.py --help
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from synthetic_ts import SyntheticStream
+
+API_PREFIX = '/api/v2'
+WRITE_BLOCK = 16 * 1024
+LIVE_WINDOW = 3
+
+
+class ChunkCache:
+    """Consecutive synthetic segments, generated on first request and kept in memory"""
+
+    def __init__(self, chunk_seconds, **stream_opts):
+        self.chunk_seconds = chunk_seconds
+        self.stream = SyntheticStream(**stream_opts)
+        self.chunks = list()
+        self.lock = threading.Lock()
+
+    def get(self, index):
+        """Bytes of segment index (segments before it are generated first)"""
+        with self.lock:
+            while len(self.chunks) <= index:
+                self.chunks.append(self.stream.segment(self.chunk_seconds))
+            return self.chunks[index]
+
+
+class HlsStandIn:
+    """Threaded HTTP server playing the part of Periscope's API and CDN. Every broadcast id
+    gets the same replay of chunks segments; live streams run for live_seconds from their first
+    request. latency is seconds before each response, bandwidth bytes/s per connection (None
+    for no cap) and error_rate the fraction of chunk requests answered with a 503."""
+
+    def __init__(self, chunks=100, chunk_seconds=3.0, bitrate=800000, latency=0.0,
+                 bandwidth=None, error_rate=0.0, live_seconds=60, seed=None, host='127.0.0.1',
+                 port=0):
+        self.chunk_count = chunks
+        self.chunk_seconds = chunk_seconds
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.live_seconds = live_seconds
+        self.replay = ChunkCache(chunk_seconds, video_bitrate=bitrate)
+        self.live = ChunkCache(chunk_seconds, video_bitrate=bitrate)
+        self.live_started = dict()
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = Counter()
+
+        self.server = ThreadingHTTPServer((host, port), StandInHandler)
+        self.server.daemon_threads = True
+        self.server.standin = self
+        self.thread = None
+
+    @property
+    def url(self):
+        """Base url of the server"""
+        return "http://{0}:{1}".format(*self.server.server_address[:2])
+
+    @property
+    def api_base(self):
+        """Value for PERIAPI_API_BASE that points downloads at this server"""
+        return self.url + API_PREFIX
+
+    def start(self):
+        """Serve in a background thread, pregenerating the replay chunks. Returns self."""
+        self.replay.get(self.chunk_count - 1)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Stop serving"""
+        self.server.shutdown()
+        self.server.server_close()
+
+    def inject_error(self):
+        """Whether this chunk request should fail"""
+        with self.lock:
+            return self.error_rate and self.random.random() < self.error_rate
+
+    def count(self, key, amount=1):
+        """Add to a request statistic"""
+        with self.lock:
+            self.stats[key] += amount
+
+    def replay_playlist(self, broadcast_id):
+        """Ended media playlist of the replay"""
+        lines = ["#EXTM3U", "#EXT-X-VERSION:3",
+                 "#EXT-X-TARGETDURATION:{:.0f}".format(self.chunk_seconds + 0.5),
+                 "#EXT-X-MEDIA-SEQUENCE:0"]
+        for index in range(self.chunk_count):
+            lines.append("#EXTINF:{:.3f},".format(self.chunk_seconds))
+            lines.append("{0}/replay/{1}/chunk_{2}.ts".format(self.url, broadcast_id, index))
+        lines.append("#EXT-X-ENDLIST")
+        return "\n".join(lines) + "\n"
+
+    def live_playlist(self, broadcast_id):
+        """Sliding window playlist of the live stream as of now, ended once live_seconds
+        have passed since it was first requested"""
+        with self.lock:
+            started = self.live_started.setdefault(broadcast_id, time.time())
+        elapsed = min(time.time() - started, self.live_seconds)
+        newest = max(int(elapsed / self.chunk_seconds), 1)
+        oldest = max(newest - LIVE_WINDOW, 0)
+        lines = ["#EXTM3U", "#EXT-X-VERSION:3",
+                 "#EXT-X-TARGETDURATION:{:.0f}".format(self.chunk_seconds + 0.5),
+                 "#EXT-X-MEDIA-SEQUENCE:{}".format(oldest)]
+        for index in range(oldest, newest):
+            lines.append("#EXTINF:{:.3f},".format(self.chunk_seconds))
+            lines.append("{0}/live/{1}/chunk_{2}.ts".format(self.url, broadcast_id, index))
+        if elapsed >= self.live_seconds:
+            lines.append("#EXT-X-ENDLIST")
+        return "\n".join(lines) + "\n"
+
+    def live_ended(self, broadcast_id):
+        """Whether the live stream of broadcast_id has run its course"""
+        with self.lock:
+            started = self.live_started.get(broadcast_id)
+        return started is not None and time.time() - started >= self.live_seconds
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Routes requests to the stand-in's endpoints"""
+
+    protocol_version = 'HTTP/1.1'
+
+    @property
+    def standin(self):
+        """The HlsStandIn being served"""
+        return self.server.standin
+
+    def do_GET(self):
+        """Access endpoints, playlists and chunks"""
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        parts = url.path.strip('/').split('/')
+        time.sleep(self.standin.latency)
+
+        if parts[-1] == 'getAccessPublic':
+            broadcast_id = query.get('broadcast_id', [''])[0]
+            self.send_json({'replay_url': "{0}/replay/{1}/playlist.m3u8".format(
+                self.standin.url, broadcast_id)})
+        elif parts[-1] == 'replayPlaylist.m3u8':
+            self.send_body(self.standin.replay_playlist(query.get('broadcast_id', [''])[0]),
+                           'application/vnd.apple.mpegurl')
+        elif len(parts) == 3 and parts[2] == 'playlist.m3u8' and parts[0] in ('replay', 'live'):
+            playlist = self.standin.replay_playlist(parts[1]) if parts[0] == 'replay' else \
+                self.standin.live_playlist(parts[1])
+            self.send_body(playlist, 'application/vnd.apple.mpegurl')
+        elif len(parts) == 3 and parts[2].startswith('chunk_') and parts[0] in ('replay', 'live'):
+            self.send_chunk(parts[0], int(parts[2][len('chunk_'):-len('.ts')]))
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        """accessChannel, as used for private replays and live streams"""
+        length = int(self.headers.get('Content-Length') or 0)
+        payload = json.loads(self.rfile.read(length) or b'{}')
+        time.sleep(self.standin.latency)
+        if urlparse(self.path).path.rstrip('/').endswith('/accessChannel'):
+            broadcast_id = payload.get('broadcast_id', '')
+            self.send_json({
+                'hls_url': "{0}/live/{1}/playlist.m3u8".format(self.standin.url, broadcast_id),
+                'replay_url': "{0}/replay/{1}/playlist.m3u8".format(self.standin.url,
+                                                                    broadcast_id)})
+        else:
+            self.send_error(404)
+
+    def send_json(self, data):
+        """Answer with a JSON document"""
+        self.send_body(json.dumps(data), 'application/json')
+
+    def send_body(self, text, content_type):
+        """Answer with a small text body"""
+        body = text.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.standin.count('requests')
+
+    def send_chunk(self, kind, index):
+        """Answer with a TS chunk (honouring Range requests), throttled to the bandwidth cap"""
+        standin = self.standin
+        if kind == 'replay' and index >= standin.chunk_count:
+            self.send_error(404)
+            return None
+        if standin.inject_error():
+            standin.count('errors_injected')
+            self.send_error(503)
+            return None
+        data = standin.replay.get(index) if kind == 'replay' else standin.live.get(index)
+
+        status = 200
+        byterange = self.headers.get('Range')
+        if byterange and byterange.startswith('bytes='):
+            first, _, last = byterange[len('bytes='):].partition('-')
+            first, last = int(first), min(int(last) if last else len(data) - 1, len(data) - 1)
+            data = data[first:last + 1]
+            status = 206
+        self.send_response(status)
+        self.send_header('Content-Type', 'video/mp2t')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+
+        started = time.time()
+        for offset in range(0, len(data), WRITE_BLOCK):
+            self.wfile.write(data[offset:offset + WRITE_BLOCK])
+            if standin.bandwidth:
+                ahead = (offset + WRITE_BLOCK) / standin.bandwidth - (time.time() - started)
+                if ahead > 0:
+                    time.sleep(ahead)
+        standin.count('chunks')
+        standin.count('bytes_served', len(data))
+
+    def log_message(self, *args):
+        """Keep requests out of the console"""
+        pass
+
+
+def main():
+    """Serve until interrupted"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--port', type=int, default=8089, help="Port to serve on")
+    parser.add_argument('--chunks', type=int, default=100, help="Chunks per replay")
+    parser.add_argument('--chunk-seconds', type=float, default=3.0, help="Seconds per chunk")
+    parser.add_argument('--bitrate', type=int, default=800000, help="Video bitrate (bits/s)")
+    parser.add_argument('--latency', type=float, default=0.0, help="Seconds before responses")
+    parser.add_argument('--bandwidth', type=int, default=None,
+                        help="Bytes/s cap per connection")
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help="Fraction of chunk requests failed with a 503")
+    parser.add_argument('--live-seconds', type=float, default=60, help="Length of live streams")
+    args = parser.parse_args()
+
+    standin = HlsStandIn(args.chunks, args.chunk_seconds, args.bitrate, args.latency,
+                         args.bandwidth, args.error_rate, args.live_seconds,
+                         port=args.port).start()
+    print("Serving on {0}; set PERIAPI_API_BASE={1}".format(standin.url, standin.api_base))
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        standin.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+"""
+Periscope API for the masses
+
+Load test the autocap polling loop (Listener and AdaptivePoller, without downloading anything)
+against the mock Periscope API: thousands of follows, lives going up and down at random, bursts
+and replays. Reports poll latency, CPU per poll, API calls per minute and how long new lives
+took to be detected. Run from the repository root: python benchmarks/loadtest_listener.py --help
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# pylint: disable=wrong-import-position
+from mock_api import MockPeriscope
+
+UNTHROTTLED_RATE = (1000.0, 1000)
+
+
+def write_config(work_dir, args):
+    """Config of a logged in account that needs no Twitter login or user search, with the
+    polling bounds (and rate limits) under test"""
+    config = {'cookie': 'loadtest', 'uid': 'loadtest', 'name': 'loadtest', 'pubid': 'loadtest',
+              'download_directory': os.path.join(work_dir, 'downloads'),
+              'min_notification_interval': args.fixed_interval or args.min_interval,
+              'max_notification_interval': args.fixed_interval or args.max_interval}
+    if args.unthrottled:
+        config['rate_limits'] = dict((family, UNTHROTTLED_RATE) for family in
+                                     ('feed', 'broadcast', 'social', 'search', 'default'))
+    with open(os.path.join(work_dir, '.peri.conf'), 'w') as config_file:
+        json.dump(config, config_file)
+
+
+def run(mock, args):
+    """Poll the mock for args.duration seconds the way AutoCap does and return the
+    measurements"""
+    # Imported here so the API url constants are read with the mock's address
+    from periapi.api import PeriAPI
+    from periapi.listener import Listener
+    from periapi.polling import AdaptivePoller
+
+    api = PeriAPI()
+    listener = Listener(api, count_active=lambda username: 0)
+    poller = AdaptivePoller(api.session.config)
+
+    polls, cpu, failures = list(), list(), 0
+    detected, replays = dict(), 0
+    started = found_at = time.time()
+    while time.time() - started < args.duration:
+        poll_started, cpu_started = time.time(), time.thread_time()
+        try:
+            new_broadcasts = listener.check_for_new()
+        except IOError:
+            new_broadcasts = None
+            failures += 1
+        # thread_time leaves out the mock's server threads running in this process
+        cpu.append(time.thread_time() - cpu_started)
+        polls.append(time.time() - poll_started)
+
+        found_at = time.time()
+        for broadcast in new_broadcasts or list():
+            if broadcast.islive and broadcast.id in mock.went_live:
+                detected.setdefault(broadcast.id, found_at - mock.went_live[broadcast.id])
+            elif broadcast.isreplay:
+                replays += 1
+        poller.record_poll(new_broadcasts)
+        time.sleep(max(min(poller.next_interval(), started + args.duration - time.time()), 0))
+    elapsed = time.time() - started
+
+    # Written now, while the working directory is still the one the config belongs in
+    api.session.config.flush()
+    with mock.lock:
+        lives = [i for i, when in mock.went_live.items() if started <= when < found_at]
+    return {'elapsed': elapsed, 'polls': polls, 'cpu': cpu, 'failures': failures,
+            'detected': [detected[i] for i in lives if i in detected],
+            'missed': sum(1 for i in lives if i not in detected), 'replays': replays,
+            'limiter': dict(api.session.stats)}
+
+
+def report(mock, result):
+    """Print the measurements"""
+    # Imported here, like in run(), so importing periapi doesn't read the API url too early
+    from periapi.polling import percentile
+
+    def seconds(values, scale=1.0, digits=2):
+        return " ".join("{0} {1}".format(label, "n/a" if value is None else
+                                         "{:.{d}f}".format(value * scale, d=digits))
+                        for label, value in (('p50', percentile(values, 0.5) if values else None),
+                                             ('p90', percentile(values, 0.9) if values else None),
+                                             ('max', max(values) if values else None)))
+
+    minutes = result['elapsed'] / 60
+    calls = sum(mock.calls.values())
+    print("Polls:            {0} in {1:.0f}s, {2} failed".format(
+        len(result['polls']), result['elapsed'], result['failures']))
+    print("Poll latency s:   {}".format(seconds(result['polls'])))
+    print("CPU per poll ms:  {}".format(seconds(result['cpu'], scale=1e3, digits=1)))
+    print("API calls/min:    {0:.1f} ({1})".format(calls / minutes, ", ".join(
+        "{0} {1:.1f}".format(endpoint, count / minutes)
+        for endpoint, count in sorted(mock.calls.items()))))
+    print("Rate limiter:     {}".format(", ".join(
+        "{0} {1:.0f}".format(key, value) for key, value in sorted(result['limiter'].items()))
+        or "n/a"))
+    print("Detection s:      {0} ({1} lives found, {2} missed, {3} replays)".format(
+        seconds(result['detected'], digits=1), len(result['detected']), result['missed'],
+        result['replays']))
+    print("Mock:             {0} users followed, {1} broadcasts, {2} errors injected".format(
+        len(mock.follows), len(mock.broadcasts), mock.errors_injected))
+
+
+def main():
+    """Run the load test and print a report"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--follows', type=int, default=2000, help="Followed users")
+    parser.add_argument('--duration', type=float, default=120, help="Seconds to poll for")
+    parser.add_argument('--lives-per-minute', type=float, default=20,
+                        help="Rate at which followed users go live")
+    parser.add_argument('--live-seconds', type=float, default=60,
+                        help="Typical length of a live broadcast")
+    parser.add_argument('--replay-delay', type=float, default=10,
+                        help="Seconds until an ended broadcast's replay is available")
+    parser.add_argument('--burst', type=int, default=0,
+                        help="Lives starting at once halfway through the run")
+    parser.add_argument('--new-follows', type=int, default=0,
+                        help="Users followed a third of the way through the run")
+    parser.add_argument('--script', default=None,
+                        help="JSON file of timed events to play instead (see "
+                             "MockPeriscope.run_script)")
+    parser.add_argument('--min-interval', type=float, default=5,
+                        help="min_notification_interval to poll with")
+    parser.add_argument('--max-interval', type=float, default=120,
+                        help="max_notification_interval to poll with")
+    parser.add_argument('--fixed-interval', type=float, default=None,
+                        help="Poll at this interval instead of adaptively")
+    parser.add_argument('--unthrottled', action='store_true',
+                        help="Lift the client side rate limits")
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help="Seconds the mock waits before each response")
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help="Fraction of API calls the mock fails")
+    parser.add_argument('--seed', type=int, default=None, help="Seed for the simulation")
+    args = parser.parse_args()
+
+    mock = MockPeriscope(args.latency, args.error_rate, args.replay_delay,
+                         seed=args.seed).start()
+    mock.add_users(args.follows)
+    os.environ['PERIAPI_API_BASE'] = mock.api_base
+    work_dir = tempfile.mkdtemp(prefix='periapi-loadtest-')
+    cwd = os.getcwd()
+    try:
+        write_config(work_dir, args)
+        os.chdir(work_dir)
+        if args.script:
+            with open(os.path.join(cwd, args.script)) as script_file:
+                mock.run_script(json.load(script_file))
+        else:
+            mock.churn(args.lives_per_minute, args.live_seconds, args.duration)
+            mock.run_script([{'at': args.duration / 3, 'action': 'follow',
+                              'count': args.new_follows},
+                             {'at': args.duration / 2, 'action': 'burst', 'count': args.burst}])
+        result = run(mock, args)
+    finally:
+        os.chdir(cwd)
+        mock.stop()
+        shutil.rmtree(work_dir, ignore_errors=True)
+    report(mock, result)
+
+
+if __name__ == '__main__':
+    main()
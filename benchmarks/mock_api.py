@@ -0,0 +1,344 @@
+#!/usr/bin/env python3
+"""
+Periscope API for the masses
+
+Scriptable local stand-in for the Periscope API endpoints periapi uses, for load tests:
+thousands of followed users, bursts of broadcasts going live and ending, and lives turning
+into replays. Run from the repository root: python benchmarks/mock_api.py --help
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+
+from collections import Counter, deque
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+API_PREFIX = '/api/v2'
+FEED_LIMIT = 200
+CALL_HISTORY = 100000
+
+
+def atom(when):
+    """ATOM timestamp of a unix time, the way Periscope formats them"""
+    return datetime.fromtimestamp(when, timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+
+class MockPeriscope:
+    """In-memory users, follows and broadcasts behind a threaded HTTP server. The account
+    logged in follows the users added with follow=True. Broadcasts are scripted with go_live,
+    end and burst (or a whole timed script with run_script); ended broadcasts become
+    available as replays after replay_delay seconds. latency is seconds before each response
+    and error_rate the fraction of calls answered with a 503."""
+
+    def __init__(self, latency=0.0, error_rate=0.0, replay_delay=0.0, media_url=None,
+                 seed=None, host='127.0.0.1', port=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.replay_delay = replay_delay
+        self.media_url = media_url
+        self.random = random.Random(seed)
+        self.lock = threading.RLock()
+
+        self.users = dict()
+        self.usernames = dict()
+        self.follows = set()
+        self.broadcasts = dict()
+        self.by_user = dict()
+        self.live = set()
+        self.went_live = dict()
+        self.serial = 0
+
+        self.calls = Counter()
+        self.call_times = deque(maxlen=CALL_HISTORY)
+        self.errors_injected = 0
+
+        self.server = ThreadingHTTPServer((host, port), MockHandler)
+        self.server.daemon_threads = True
+        self.server.mock = self
+        self.thread = None
+        self.script_thread = None
+
+    @property
+    def url(self):
+        """Base url of the server"""
+        return "http://{0}:{1}".format(*self.server.server_address[:2])
+
+    @property
+    def api_base(self):
+        """Value for PERIAPI_API_BASE that points periapi at this server"""
+        return self.url + API_PREFIX
+
+    def start(self):
+        """Serve in a background thread. Returns self."""
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Stop serving"""
+        self.server.shutdown()
+        self.server.server_close()
+
+    def add_users(self, count, prefix='user', follow=True):
+        """Create count users (following them if follow). Returns their ids."""
+        with self.lock:
+            ids = list()
+            for _ in range(count):
+                self.serial += 1
+                user_id = "u{}".format(self.serial)
+                username = "{0}{1}".format(prefix, self.serial)
+                self.users[user_id] = {'id': user_id, 'username': username,
+                                       'display_name': username.title()}
+                self.usernames[username.casefold()] = user_id
+                self.by_user[user_id] = list()
+                if follow:
+                    self.follows.add(user_id)
+                ids.append(user_id)
+            return ids
+
+    def go_live(self, user_id=None, private=False):
+        """Start a broadcast by user_id (a random followed user if None). Returns its id."""
+        with self.lock:
+            if user_id is None:
+                idle = [i for i in self.follows if not self._is_live(i)]
+                if not idle:
+                    return None
+                user_id = self.random.choice(sorted(idle))
+            self.serial += 1
+            broadcast_id = "bc{:011d}".format(self.serial)
+            now = time.time()
+            user = self.users[user_id]
+            self.broadcasts[broadcast_id] = {
+                'id': broadcast_id, 'user_id': user_id, 'username': user['username'],
+                'user_display_name': user['display_name'], 'status': "Broadcast {}".format(
+                    self.serial), 'state': 'RUNNING', 'available_for_replay': False,
+                'is_locked': private, 'start': atom(now), 'language': 'en'}
+            self.by_user[user_id].append(broadcast_id)
+            self.live.add(broadcast_id)
+            self.went_live[broadcast_id] = now
+            return broadcast_id
+
+    def end(self, broadcast_id=None, replay=True):
+        """End a live broadcast (a random one if None); it becomes a replay after
+        replay_delay seconds if replay. Returns its id."""
+        with self.lock:
+            if broadcast_id is None:
+                if not self.live:
+                    return None
+                broadcast_id = self.random.choice(sorted(self.live))
+            self.live.discard(broadcast_id)
+            info = self.broadcasts[broadcast_id]
+            info.update(state='ENDED', end=atom(time.time()))
+            if replay:
+                info['replay_at'] = time.time() + self.replay_delay
+            return broadcast_id
+
+    def burst(self, count):
+        """Have count followed users go live at once. Returns the broadcast ids."""
+        return [i for i in (self.go_live() for _ in range(count)) if i is not None]
+
+    def follow(self, count):
+        """Start following count new users. Returns their ids."""
+        return self.add_users(count, prefix='newfollow', follow=True)
+
+    def run_script(self, events):
+        """Play a timed script in a background thread. Each event is a dict with 'at'
+        (seconds from now), 'action' (go_live, end, burst or follow) and optionally 'count'."""
+        actions = {'go_live': lambda count: [self.go_live() for _ in range(count)],
+                   'end': lambda count: [self.end() for _ in range(count)],
+                   'burst': self.burst, 'follow': self.follow}
+        started = time.time()
+
+        def play():
+            for event in sorted(events, key=lambda i: i['at']):
+                time.sleep(max(started + event['at'] - time.time(), 0))
+                actions[event['action']](event.get('count', 1))
+
+        self.script_thread = threading.Thread(target=play, daemon=True)
+        self.script_thread.start()
+        return self.script_thread
+
+    def churn(self, lives_per_minute, live_seconds, duration):
+        """Random go-lives at lives_per_minute for duration seconds, each lasting about
+        live_seconds, in a background thread"""
+        def play():
+            ending = dict()
+            stop_at = time.time() + duration
+            while time.time() < stop_at:
+                time.sleep(self.random.expovariate(lives_per_minute / 60.0))
+                broadcast_id = self.go_live()
+                if broadcast_id is not None:
+                    ending[broadcast_id] = time.time() + self.random.uniform(
+                        0.5 * live_seconds, 1.5 * live_seconds)
+                for broadcast_id, when in list(ending.items()):
+                    if when <= time.time():
+                        self.end(broadcast_id)
+                        del ending[broadcast_id]
+
+        thread = threading.Thread(target=play, daemon=True)
+        thread.start()
+        return thread
+
+    def _is_live(self, user_id):
+        """Whether the user has a broadcast running"""
+        return any(i in self.live for i in self.by_user[user_id][-1:])
+
+    def broadcast_info(self, broadcast_id):
+        """Public view of a broadcast, or None"""
+        with self.lock:
+            info = self.broadcasts.get(broadcast_id)
+            if info is None:
+                return None
+            info = dict(info)
+        replay_at = info.pop('replay_at', None)
+        info['available_for_replay'] = replay_at is not None and time.time() >= replay_at
+        return info
+
+    def feed(self):
+        """Most recent broadcasts of followed users, newest first"""
+        with self.lock:
+            recent = list()
+            for broadcast_id in reversed(list(self.broadcasts)):
+                if self.broadcasts[broadcast_id]['user_id'] in self.follows:
+                    recent.append(broadcast_id)
+                    if len(recent) >= FEED_LIMIT:
+                        break
+        return [self.broadcast_info(i) for i in recent]
+
+    def record_call(self, endpoint):
+        """Count a call. Returns whether it should be failed."""
+        with self.lock:
+            self.calls[endpoint] += 1
+            self.call_times.append(time.time())
+            if self.error_rate and self.random.random() < self.error_rate:
+                self.errors_injected += 1
+                return True
+        return False
+
+    def calls_per_minute(self, window=60.0):
+        """API calls per minute over the last window seconds"""
+        cutoff = time.time() - window
+        with self.lock:
+            return sum(1 for i in self.call_times if i >= cutoff) * 60.0 / window
+
+    def handle(self, endpoint, params):
+        """Answer an API call. Returns the JSON response, or None for unknown endpoints."""
+        if endpoint == 'followingBroadcastFeed':
+            return self.feed()
+        if endpoint == 'following':
+            with self.lock:
+                return [dict(self.users[i]) for i in sorted(self.follows)]
+        if endpoint == 'getBroadcastPublic':
+            info = self.broadcast_info(params.get('broadcast_id'))
+            return {'broadcast': info} if info is not None else dict()
+        if endpoint == 'accessChannel':
+            broadcast_id = params.get('broadcast_id')
+            info = self.broadcast_info(broadcast_id)
+            media = self.media_url or self.url
+            return {'broadcast': info,
+                    'hls_url': "{0}/live/{1}/playlist.m3u8".format(media, broadcast_id),
+                    'replay_url': "{0}/replay/{1}/playlist.m3u8".format(media, broadcast_id)}
+        if endpoint == 'userBroadcasts':
+            with self.lock:
+                history = list(self.by_user.get(params.get('user_id'), list()))
+            return [self.broadcast_info(i) for i in reversed(history)]
+        if endpoint == 'userSearch':
+            search = (params.get('search') or '').casefold()
+            with self.lock:
+                return [dict(self.users[user_id]) for username, user_id in
+                        self.usernames.items() if username.startswith(search)][:50]
+        if endpoint in ('follow', 'unfollow'):
+            with self.lock:
+                if params.get('user_id') not in self.users:
+                    return {'success': False}
+                if endpoint == 'follow':
+                    self.follows.add(params['user_id'])
+                else:
+                    self.follows.discard(params['user_id'])
+            return {'success': True}
+        return None
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    """Routes API calls to the mock"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        """Calls made with query strings"""
+        params = dict((key, values[0]) for key, values in
+                      parse_qs(urlparse(self.path).query).items())
+        self.answer(params)
+
+    def do_POST(self):
+        """Calls made with a JSON payload"""
+        length = int(self.headers.get('Content-Length') or 0)
+        try:
+            params = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError:
+            params = dict()
+        self.answer(params)
+
+    def answer(self, params):
+        """Answer a call after the configured latency"""
+        mock = self.server.mock
+        endpoint = urlparse(self.path).path.rstrip('/').rsplit('/', 1)[-1]
+        time.sleep(mock.latency)
+        if mock.record_call(endpoint):
+            self.send_error(503)
+            return None
+        response = mock.handle(endpoint, params)
+        if response is None:
+            self.send_error(404)
+            return None
+        body = json.dumps(response).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        """Keep calls out of the console"""
+        pass
+
+
+def main():
+    """Serve a simulated follow list with random go-lives until interrupted"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--port', type=int, default=8088, help="Port to serve on")
+    parser.add_argument('--follows', type=int, default=1000, help="Followed users")
+    parser.add_argument('--lives-per-minute', type=float, default=10,
+                        help="Rate at which followed users go live")
+    parser.add_argument('--live-seconds', type=float, default=300,
+                        help="Typical length of a live broadcast")
+    parser.add_argument('--replay-delay', type=float, default=30,
+                        help="Seconds until an ended broadcast's replay is available")
+    parser.add_argument('--latency', type=float, default=0.0, help="Seconds before responses")
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help="Fraction of calls failed with a 503")
+    parser.add_argument('--media-url', default=None,
+                        help="Base url of an HLS stand-in (benchmarks/hls_server.py) to hand "
+                             "out stream urls for")
+    args = parser.parse_args()
+
+    mock = MockPeriscope(args.latency, args.error_rate, args.replay_delay, args.media_url,
+                         port=args.port).start()
+    mock.add_users(args.follows)
+    mock.churn(args.lives_per_minute, args.live_seconds, float('inf'))
+    print("Serving on {0}; set PERIAPI_API_BASE={1}".format(mock.url, mock.api_base))
+    try:
+        while True:
+            time.sleep(60)
+            print("{0:.0f} calls/min, {1} live".format(mock.calls_per_minute(), len(mock.live)))
+    except KeyboardInterrupt:
+        mock.stop()
+
+
+if __name__ == '__main__':
+    main()
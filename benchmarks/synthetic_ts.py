@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+"""
+Periscope API for the masses
+
+Synthetic H.264/AAC MPEG-TS segments shaped like Periscope's HLS chunks, for benchmarks.
+The video slices are random bytes behind valid headers: good enough for remuxing, not viewing.
+"""
+
+import os
+
+PAT_PID = 0x0000
+PMT_PID = 0x1000
+VIDEO_PID = 0x0100
+AUDIO_PID = 0x0101
+
+PTS_CLOCK = 90000
+START_PTS = 10 * PTS_CLOCK
+AAC_RATE_INDEX = {96000: 0, 88200: 1, 64000: 2, 48000: 3, 44100: 4, 32000: 5, 24000: 6,
+                  22050: 7, 16000: 8}
+
+
+def _crc_table():
+    """Table for the MPEG-2 flavour of CRC32 used by PSI sections"""
+    table = []
+    for i in range(256):
+        crc = i << 24
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x04C11DB7) if crc & 0x80000000 else (crc << 1)
+        table.append(crc & 0xFFFFFFFF)
+    return table
+
+CRC_TABLE = _crc_table()
+
+
+def crc32_mpeg(data):
+    """CRC32/MPEG-2 of data"""
+    crc = 0xFFFFFFFF
+    for byte in data:
+        crc = ((crc << 8) & 0xFFFFFFFF) ^ CRC_TABLE[((crc >> 24) ^ byte) & 0xFF]
+    return crc
+
+
+class _BitWriter:
+    """Writes bits and exp-golomb codes"""
+
+    def __init__(self):
+        self.bits = []
+
+    def u(self, count, value):
+        """Write value as count bits"""
+        self.bits.extend((value >> (count - 1 - i)) & 1 for i in range(count))
+
+    def ue(self, value):
+        """Write an unsigned exp-golomb code"""
+        value += 1
+        self.u(2 * value.bit_length() - 1, value)
+
+    def se(self, value):
+        """Write a signed exp-golomb code"""
+        self.ue(2 * value - 1 if value > 0 else -2 * value)
+
+    def rbsp(self):
+        """Add the stop bit, byte align and apply emulation prevention"""
+        self.u(1, 1)
+        while len(self.bits) % 8:
+            self.bits.append(0)
+        raw = bytes(int(''.join(map(str, self.bits[i:i + 8])), 2)
+                    for i in range(0, len(self.bits), 8))
+        out = bytearray()
+        zeros = 0
+        for byte in raw:
+            if zeros >= 2 and byte <= 3:
+                out.append(3)
+                zeros = 0
+            out.append(byte)
+            zeros = zeros + 1 if byte == 0 else 0
+        return bytes(out)
+
+
+def make_sps(width, height):
+    """Baseline profile SPS for the given (macroblock aligned) dimensions"""
+    writer = _BitWriter()
+    writer.u(8, 66)
+    writer.u(8, 0xC0)
+    writer.u(8, 30)
+    writer.ue(0)
+    writer.ue(0)
+    writer.ue(2)
+    writer.ue(1)
+    writer.u(1, 0)
+    writer.ue(width // 16 - 1)
+    writer.ue(height // 16 - 1)
+    writer.u(1, 1)
+    writer.u(1, 1)
+    writer.u(1, 0)
+    writer.u(1, 0)
+    return b'\x67' + writer.rbsp()
+
+
+def make_pps():
+    """PPS matching make_sps"""
+    writer = _BitWriter()
+    writer.ue(0)
+    writer.ue(0)
+    writer.u(1, 0)
+    writer.u(1, 0)
+    writer.ue(0)
+    writer.ue(0)
+    writer.ue(0)
+    writer.u(1, 0)
+    writer.u(2, 0)
+    writer.se(0)
+    writer.se(0)
+    writer.se(0)
+    writer.u(1, 1)
+    writer.u(1, 0)
+    writer.u(1, 0)
+    return b'\x68' + writer.rbsp()
+
+
+def _random_payload(size):
+    """Random bytes that can never contain a start code"""
+    return os.urandom(size).replace(b'\x00', b'\x01')
+
+
+def _timestamp(marker, value):
+    """Encode a 33 bit PES timestamp"""
+    return bytes([(marker << 4) | (((value >> 30) & 0x07) << 1) | 1, (value >> 22) & 0xFF,
+                  (((value >> 15) & 0x7F) << 1) | 1, (value >> 7) & 0xFF,
+                  ((value & 0x7F) << 1) | 1])
+
+
+def _pes(stream_id, payload, pts, dts=None):
+    """Build a PES packet"""
+    if dts is None or dts == pts:
+        header = b'\x80\x80\x05' + _timestamp(0x2, pts)
+    else:
+        header = b'\x80\xC0\x0A' + _timestamp(0x3, pts) + _timestamp(0x1, dts)
+    length = len(header) + len(payload)
+    if stream_id == 0xE0 or length > 0xFFFF:
+        length = 0
+    return b'\x00\x00\x01' + bytes([stream_id, length >> 8, length & 0xFF]) + header + payload
+
+
+def _adts(payload, sample_rate, channels):
+    """Wrap a raw AAC payload in an ADTS header"""
+    length = 7 + len(payload)
+    rate_index = AAC_RATE_INDEX[sample_rate]
+    return bytes([0xFF, 0xF1, (1 << 6) | (rate_index << 2) | (channels >> 2),
+                  ((channels & 0x03) << 6) | (length >> 11), (length >> 3) & 0xFF,
+                  ((length & 0x07) << 5) | 0x1F, 0xFC]) + payload
+
+
+class SyntheticStream:
+    """Produces consecutive TS segments of one continuous synthetic broadcast"""
+
+    def __init__(self, width=320, height=576, fps=30, video_bitrate=800000,
+                 sample_rate=44100, channels=2, audio_bitrate=64000, start_pts=START_PTS):
+        self.sps = make_sps(width, height)
+        self.pps = make_pps()
+        self.fps = fps
+        self.frame_size = max(video_bitrate // 8 // fps, 64)
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.aac_size = max(audio_bitrate // 8 * 1024 // sample_rate, 16)
+        self.video_time = start_pts
+        self.audio_time = start_pts
+        self.counters = dict()
+
+    def _packets(self, pid, data, pcr=None):
+        """Split a PES or PSI section into 188 byte TS packets"""
+        out = []
+        pos = 0
+        first = True
+        while first or pos < len(data):
+            counter = self.counters.get(pid, 0)
+            self.counters[pid] = (counter + 1) & 0x0F
+            adaptation = None
+            if first and pcr is not None:
+                adaptation = b'\x10' + bytes([(pcr >> 25) & 0xFF, (pcr >> 17) & 0xFF,
+                                               (pcr >> 9) & 0xFF, (pcr >> 1) & 0xFF,
+                                               ((pcr & 1) << 7) | 0x7E, 0])
+            room = 184 if adaptation is None else 183 - len(adaptation)
+            remaining = len(data) - pos
+            if remaining < room:
+                if adaptation is None:
+                    stuffing = 183 - remaining
+                    adaptation = b'\x00' + b'\xFF' * (stuffing - 1) if stuffing else b''
+                else:
+                    adaptation += b'\xFF' * (room - remaining)
+                room = remaining
+            header = bytes([0x47, (0x40 if first else 0) | (pid >> 8), pid & 0xFF,
+                            (0x10 if adaptation is None else 0x30) | counter])
+            if adaptation is not None:
+                header += bytes([len(adaptation)]) + adaptation
+            out.append(header + data[pos:pos + room])
+            pos += room
+            first = False
+        return b''.join(out)
+
+    def _psi(self):
+        """PAT and PMT packets"""
+        pat = b'\x00\xB0\x0D\x00\x01\xC1\x00\x00\x00\x01' + \
+            bytes([0xE0 | (PMT_PID >> 8), PMT_PID & 0xFF])
+        pat += crc32_mpeg(pat).to_bytes(4, 'big')
+        pmt = b'\x02\xB0\x17\x00\x01\xC1\x00\x00' + \
+            bytes([0xE0 | (VIDEO_PID >> 8), VIDEO_PID & 0xFF, 0xF0, 0x00,
+                   0x1B, 0xE0 | (VIDEO_PID >> 8), VIDEO_PID & 0xFF, 0xF0, 0x00,
+                   0x0F, 0xE0 | (AUDIO_PID >> 8), AUDIO_PID & 0xFF, 0xF0, 0x00])
+        pmt += crc32_mpeg(pmt).to_bytes(4, 'big')
+        return self._packets(PAT_PID, b'\x00' + pat) + self._packets(PMT_PID, b'\x00' + pmt)
+
+    def segment(self, duration=3.0):
+        """Next segment of the stream as TS bytes. Starts with PAT/PMT and a keyframe."""
+        out = [self._psi()]
+        end = self.video_time + int(duration * PTS_CLOCK)
+        frame_step = PTS_CLOCK // self.fps
+        audio_step = 1024 * PTS_CLOCK / self.sample_rate
+        keyframe = True
+        while self.video_time < end:
+            while self.audio_time <= self.video_time:
+                frame = _adts(_random_payload(self.aac_size), self.sample_rate, self.channels)
+                out.append(self._packets(AUDIO_PID, _pes(0xC0, frame, int(self.audio_time))))
+                self.audio_time += audio_step
+            if keyframe:
+                access_unit = b'\x00\x00\x00\x01\x09\xF0\x00\x00\x00\x01' + self.sps + \
+                    b'\x00\x00\x00\x01' + self.pps + b'\x00\x00\x00\x01\x65\x88\x84' + \
+                    _random_payload(self.frame_size * 4)
+            else:
+                access_unit = b'\x00\x00\x00\x01\x09\xF0\x00\x00\x00\x01\x41\x9A\x02' + \
+                    _random_payload(self.frame_size)
+            dts = self.video_time
+            out.append(self._packets(VIDEO_PID, _pes(0xE0, access_unit, dts + 2 * frame_step,
+                                                     dts), pcr=dts))
+            self.video_time += frame_step
+            keyframe = False
+        return b''.join(out)
+
+
+def write_segments(directory, count, duration=3.0, **stream_opts):
+    """Write count consecutive segments as chunk_<n>.ts files and return their paths"""
+    stream = SyntheticStream(**stream_opts)
+    paths = []
+    for idx in range(count):
+        path = os.path.join(directory, "chunk_{}.ts".format(idx))
+        with open(path, 'wb') as handle:
+            handle.write(stream.segment(duration))
+        paths.append(path)
+    return paths
@@ -5,7 +5,6 @@ Periscope API for the masses
 # pylint: disable=broad-except
 
 import os
-import re
 import shutil
 import sys
 import time
@@ -16,8 +15,20 @@ from requests.packages.urllib3.exceptions import NewConnectionError
 
 from . import PeriAPI
 from . import AutoCap
-
-BROADCAST_ID_PATTERN = r'1[a-zA-Z]{12}'
+from .broadcast import check_clip
+from .circuit import CircuitOpen
+from .cleanup import plan_cleanup, reclaimable_bytes, run_cleanup
+from .library import LibraryIndex, BROADCAST_ID_PATTERN, index_path
+from .tracing import read_traces, summarize, trace_path
+
+BULK_RESULT_MESSAGES = {
+    'followed': "Now following {}.",
+    'unfollowed': "No longer following {}.",
+    'already following': "Already following {}.",
+    'not following': "Not following {}.",
+    'not found': "User {} could not be found.",
+    'failed': "Request for {} failed.",
+}
 
 
 def run():
@@ -34,13 +45,34 @@ def enditall():
 def get_bc_id():
     """Get broadcast id from user input"""
     bc_userinput = input("\nInput broadcast ID or broadcast URL: ")
-    bc_id_match = re.search(BROADCAST_ID_PATTERN, bc_userinput)
+    bc_id_match = BROADCAST_ID_PATTERN.search(bc_userinput)
     if not bc_id_match:
         print("Broadcast {} not found.".format(bc_userinput))
         return None
     return bc_id_match.group(0)
 
 
+def read_usernames(userinput):
+    """Split comma separated usernames. Input naming an existing file (optionally prefixed with
+    @) is read as a file of usernames separated by commas or newlines."""
+    names_path = os.path.expanduser(userinput.strip().lstrip('@'))
+    if names_path and os.path.isfile(names_path):
+        with open(names_path) as names_file:
+            userinput = names_file.read()
+    return [_.strip().lstrip('@') for _ in userinput.replace('\n', ',').split(',') if _.strip()]
+
+
+def parse_offset(offset):
+    """Turn seconds or [hh:]mm:ss into a number of seconds. Blank input gives None."""
+    offset = offset.strip()
+    if not offset:
+        return None
+    seconds = 0.0
+    for part in offset.split(':'):
+        seconds = seconds * 60 + float(part)
+    return seconds
+
+
 class BadCLI:
     """Start up a rudimentary CLI"""
 
@@ -64,18 +96,21 @@ class BadCLI:
                     print("\t9 - Turn OFF separate folder downloads for each user")
                 else:
                     print("\t9 - Turn ON separate folder downloads for each user")
+                print("\t10 - Show the slowest phases of recent downloads")
                 print("\t0 - Exit\n")
-                choice = input("Please select an option (0-9): ")
+                choice = input("Please select an option (0-10): ")
                 if choice == '0':
                     enditall()
                 elif choice == '1':
                     self.show_followed_users()
                 elif choice == '2':
                     self.follow_user(input("Enter their username. If following more than one, "
-                                           "separate them with commas: "))
+                                           "separate them with commas or enter @ and the "
+                                           "path of a file listing them: "))
                 elif choice == '3':
-                    self.unfollow_user(input("Enter their username. If unfollowing more than one, "
-                                             "separate them with commas: "))
+                    self.unfollow_user(input("Enter their username. If unfollowing more than "
+                                             "one, separate them with commas or enter @ "
+                                             "and the path of a file listing them: "))
                 elif choice == '4':
                     if shutil.which('ffmpeg') is not None:
                         self.start_autocapper()
@@ -92,6 +127,8 @@ class BadCLI:
                     self.cleanup()
                 elif choice == '9':
                     self.config['separate_folders'] = not self.config.get('separate_folders')
+                elif choice == '10':
+                    self.show_slowest_phases()
                 else:
                     print("Invalid selection. Please try again.")
             except ValueError as error:
@@ -108,31 +145,17 @@ class BadCLI:
 
     def follow_user(self, usernames):
         """Tries to find and follow the entered username or usernames"""
-        if len(usernames) == 0:
-            return None
-
-        for username in [_.strip() for _ in usernames.split(",")]:
-            try:
-                user_id = self.api.find_user_id(username)
-            except ValueError:
-                print("User {} could not be found.".format(username))
-                continue
-            self.api.follow(user_id)
-            print("Now following {}.".format(username))
+        self.report_bulk_results(self.api.bulk_follow(read_usernames(usernames)))
 
     def unfollow_user(self, usernames):
         """Tries to find and unfollow the entered username or usernames"""
-        if len(usernames) == 0:
-            return None
+        self.report_bulk_results(self.api.bulk_unfollow(read_usernames(usernames)))
 
-        for username in [_.strip() for _ in usernames.split(",")]:
-            try:
-                user_id = self.api.find_user_id(username)
-            except ValueError:
-                print("User {} could not be found.".format(username))
-                continue
-            self.api.unfollow(user_id)
-            print("No longer following {}.".format(username))
+    @staticmethod
+    def report_bulk_results(results):
+        """Print the outcome of a bulk follow or unfollow"""
+        for username, result in results.items():
+            print(BULK_RESULT_MESSAGES[result].format(username))
 
     def start_autocapper(self, opts_override=None):
         """Start autocapper running"""
@@ -149,13 +172,20 @@ class BadCLI:
             opts["cap_invited"] = bool(inv_check.strip().lower()[:1] == "y")
         else:
             opts = opts_override
+        # Once started, the autocapper rides out outages itself, keeping its pool and state
+        while True:
+            try:
+                cap = AutoCap(self.api, opts)
+                break
+            except (exceptions.ConnectionError, NewConnectionError, timeout, gaierror,
+                    CircuitOpen):
+                print("Could not reach Periscope. Retrying in 15 seconds....")
+                time.sleep(15)
         try:
-            cap = AutoCap(self.api, opts)
             cap.start()
-        except (exceptions.ConnectionError, NewConnectionError, timeout, gaierror):
-            print("Attempting to re-start autocapper in 15 seconds....")
-            time.sleep(15)
-            self.start_autocapper(opts_override=opts)
+        finally:
+            # Console output comes from a sink thread; let it finish before the menu prompts
+            cap.events.flush()
         return None
 
     def set_download_directory(self):
@@ -174,50 +204,84 @@ class BadCLI:
 
     def cleanup(self):
         """Clean up live broadcasts that are duplicates of a downloaded replay"""
-        confirmation = input("\nThis may delete files you wish to keep. "
-                             "Are you sure you want to do this? (y/n): ")
-        if confirmation.lower() != 'y':
-            print("Canceled.")
+        root = self.config.get('download_directory')
+        print("Scanning {}...".format(root))
+        with LibraryIndex(index_path(self.config)) as index:
+            plan = plan_cleanup(index, root)
+            if not plan:
+                print("No live recordings with a downloaded replay were found.")
+                return None
+            print("{0} live recordings can be deleted, freeing {1:.1f} MB.".format(
+                len(plan), reclaimable_bytes(plan) / 1e6))
+
+            confirmation = input("\nThis may delete files you wish to keep. Delete them (y), "
+                                 "list them without deleting (l) or cancel (n)? ")
+            if confirmation.lower() == 'l':
+                for item in plan:
+                    print("{0:>10.1f} MB  {1}".format(item.size / 1e6, item.path))
+                return None
+            if confirmation.lower() != 'y':
+                print("Canceled.")
+                return None
+
+            files_deleted, freed, failed = run_cleanup(index, plan)
+        for path in failed:
+            print("{} could not be deleted.".format(os.path.basename(path)))
+        print("{0} files were deleted, freeing {1:.1f} MB.".format(files_deleted, freed / 1e6))
+
+    def show_slowest_phases(self):
+        """Summarise where recent downloads spent their time, slowest phase first"""
+        traces = read_traces(trace_path(self.config))
+        if not traces:
+            print("No download traces have been recorded yet.")
             return None
-
-        files_deleted = 0
-        for directory, subdirs, files in os.walk(self.config.get('download_directory')):
-            ids_to_clean = list()
-
-            for filename in files:
-                if 'REPLAY.mp4' in filename:
-                    ids_to_clean.append(re.search(BROADCAST_ID_PATTERN, filename).group(0))
-
-            for filename in files:
-                if '.live' in filename:
-                    try:
-                        if re.search(BROADCAST_ID_PATTERN, filename).group(0) in ids_to_clean:
-                            os.remove(os.path.join(directory, filename))
-                            files_deleted += 1
-                    except BaseException:
-                        print("{} could not be deleted.".format(filename))
-
-            for idx in range(len(subdirs)-1, -1, -1):
-                if '.periapi' in subdirs[idx]:
-                    del subdirs[idx]
-
-        print("{0} files were deleted.".format(files_deleted))
+        phases = summarize(traces)
+        print("Time spent per phase over the last {} download attempts:\n".format(len(traces)))
+        print("\t{0:<10} {1:>6} {2:>10} {3:>9} {4:>9} {5:>10}".format(
+            "Phase", "Count", "Total (s)", "Median", "90%", "MB"))
+        for phase in phases:
+            print("\t{0:<10} {1:>6} {2:>10.1f} {3:>9.2f} {4:>9.2f} {5:>10.1f}".format(
+                phase.phase, phase.count, phase.total, phase.median, phase.p90,
+                phase.bytes / 1e6))
+        print("\nSlowest single runs:")
+        for phase in phases:
+            print("\t{0:<10} {1:>9.1f}s  {2}".format(phase.phase, *phase.slowest))
 
     def cap_one(self):
         """Get broadcast ID from user and run the cap_one method in autocap"""
         broadcast_id = get_bc_id()
         if not broadcast_id:
             return None
+        try:
+            start = parse_offset(input("Start at (seconds or hh:mm:ss, blank for beginning): "))
+            end = parse_offset(input("End at (seconds or hh:mm:ss, blank for end): "))
+        except ValueError:
+            print("Invalid time offset.")
+            return None
+        # Raises ValueError, shown by the menu, before any work is done
+        check_clip(start, end)
         dummy_opts = {"check_backlog": False, "cap_invited": False}
         cap = AutoCap(self.api, dummy_opts)
-        cap.cap_one(broadcast_id)
+        try:
+            cap.cap_one(broadcast_id, start, end)
+        finally:
+            cap.events.flush()
 
     def cap_user(self):
         """Get username from user and run cap_user in autocap"""
         username = input("\nInput username: ")
         dummy_opts = {"check_backlog": False, "cap_invited": False}
         cap = AutoCap(self.api, dummy_opts)
-        cap.cap_user(username)
+        try:
+            handles = cap.cap_user(username)
+        finally:
+            cap.events.flush()
+        if handles:
+            failed = [handle for handle in handles if not handle.ok]
+            print("{0} of {1} broadcasts downloaded.".format(len(handles) - len(failed),
+                                                              len(handles)))
+            for handle in failed:
+                print("\t{0}: {1}".format(handle.broadcast.title, handle.failure_reason))
 
     # def heartbomb(self):
     #     """Flood a broadcast with hearts"""
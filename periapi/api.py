@@ -3,10 +3,17 @@
 Periscope API for the masses
 """
 
+from collections import OrderedDict
+from concurrent.futures import as_completed
 from functools import wraps
 
-from .login import LoginSession
+from .login import LoginSession, API_BASE
 from .logging import logging
+from .ratelimit import RateLimitedExecutor
+
+BULK_WORKERS = 8
+SEARCH_RATE = 5.0
+FOLLOW_RATE = 2.0
 
 
 def bool_response(fun):
@@ -41,7 +48,7 @@ class PeriAPI:
 
     def _get(self, url, payload=None):
         """Get request to API (Periscope uses query strings here, not json)"""
-        res = self.session.get(url, params=payload or {})
+        res = self.session.get_peri(url, params=payload or {})
         logging.debug("%s: params:%r result=%r", url, payload, res)
         try:
             return res.json()
@@ -67,7 +74,7 @@ class PeriAPI:
     def follow(self, user_id):
         """Follow a user"""
         return self._post(
-            'https://api.periscope.tv/api/v2/follow',
+            API_BASE + '/follow',
             {"user_id": user_id}
             )
 
@@ -75,14 +82,79 @@ class PeriAPI:
     def unfollow(self, user_id):
         """Unfollow a user"""
         return self._post(
-            'https://api.periscope.tv/api/v2/unfollow',
+            API_BASE + '/unfollow',
             {"user_id": user_id}
             )
 
+    def resolve_user_ids(self, usernames):
+        """Find the ids of many users concurrently. Returns a dict of username -> id, or None
+        for users that could not be found. Ids are cached in the config."""
+        cache = self.session.config.setdefault('user_ids', dict())
+        ids = dict()
+        futures = dict()
+        with RateLimitedExecutor(BULK_WORKERS, SEARCH_RATE) as executor:
+            for username in usernames:
+                if username.casefold() in cache:
+                    ids[username] = cache[username.casefold()]
+                else:
+                    futures[executor.submit(self.find_user_id, username)] = username
+            for future in as_completed(futures):
+                username = futures[future]
+                try:
+                    ids[username] = cache[username.casefold()] = future.result()
+                except (ValueError, IOError) as error:
+                    logging.debug("Could not resolve %s: %r", username, error)
+                    ids[username] = None
+        if futures:
+            self.session.config['user_ids'] = cache
+            self.session.config.write()
+        return ids
+
+    def bulk_follow(self, usernames):
+        """Follow many users. Returns a dict of username -> 'followed', 'already following',
+        'not found' or 'failed'."""
+        return self._bulk_follow_change(usernames, follow=True)
+
+    def bulk_unfollow(self, usernames):
+        """Unfollow many users. Returns a dict of username -> 'unfollowed', 'not following',
+        'not found' or 'failed'."""
+        return self._bulk_follow_change(usernames, follow=False)
+
+    def _bulk_follow_change(self, usernames, follow):
+        """Resolve usernames and make the follow or unfollow calls that are actually needed
+        through a rate limited pool"""
+        call, done = (self.follow, 'followed') if follow else (self.unfollow, 'unfollowed')
+        usernames = list(OrderedDict.fromkeys(i.strip() for i in usernames if i.strip()))
+        if not usernames:
+            return OrderedDict()
+        ids = self.resolve_user_ids(usernames)
+        followed = set(user.get('id') for user in self.following)
+
+        results = dict()
+        futures = dict()
+        with RateLimitedExecutor(BULK_WORKERS, FOLLOW_RATE) as executor:
+            for username in usernames:
+                user_id = ids.get(username)
+                if user_id is None:
+                    results[username] = 'not found'
+                elif follow and user_id in followed:
+                    results[username] = 'already following'
+                elif not follow and user_id not in followed:
+                    results[username] = 'not following'
+                else:
+                    futures[executor.submit(call, user_id)] = username
+            for future in as_completed(futures):
+                try:
+                    results[futures[future]] = done if future.result() else 'failed'
+                except (ValueError, IOError) as error:
+                    logging.debug("%s of %s failed: %r", done, futures[future], error)
+                    results[futures[future]] = 'failed'
+        return OrderedDict((username, results[username]) for username in usernames)
+
     def get_user_broadcast_history(self, user_id):
         """Users have broadcasts, this lists them"""
         return self._post(
-            'https://api.periscope.tv/api/v2/userBroadcasts',
+            API_BASE + '/userBroadcasts',
             {"user_id": user_id}
             )
 
@@ -90,35 +162,35 @@ class PeriAPI:
     def notifications(self):
         """Current notifications"""
         return self._post(
-            'https://api.periscope.tv/api/v2/followingBroadcastFeed'
+            API_BASE + '/followingBroadcastFeed'
             )
 
     @property
     def following(self):
         """Current people you're following"""
         return self._post(
-            'https://api.periscope.tv/api/v2/following',
+            API_BASE + '/following',
             {"user_id": self.pubid}
             )
 
     def get_access(self, broadcast_id):
         """Gets broadcast info (like rtmps url) for private broadcasts"""
         return self._post(
-            'https://api.periscope.tv/api/v2/accessChannel',
+            API_BASE + '/accessChannel',
             {'broadcast_id': broadcast_id}
             )
 
     def get_broadcast_info(self, broadcast_id):
         """Returns broadcast dictionary"""
         return self._get(
-            'https://api.periscope.tv/api/v2/getBroadcastPublic',
+            API_BASE + '/getBroadcastPublic',
             {'broadcast_id': broadcast_id}
             ).get('broadcast')
 
     def find_user_id(self, username):
         """Most API calls require the user id, not name, so find it"""
         results = self._post(
-            "https://api.periscope.tv/api/v2/userSearch",
+            API_BASE + '/userSearch',
             {"search": username}
             )
         username = username.casefold()
@@ -130,9 +202,9 @@ class PeriAPI:
     def ping_watching(self, broadcast_id, session, n_hearts, stop=False):
         """This needs to be called every 30 sec in order to be considered "watching" a stream"""
         if stop:
-            endpoint = "https://api.periscope.tv/api/v2/stopWatching"
+            endpoint = API_BASE + '/stopWatching'
         else:
-            endpoint = "https://api.periscope.tv/api/v2/pingWatching"
+            endpoint = API_BASE + '/pingWatching'
         return self._multipart_post(
             endpoint,
             {"broadcast_id": ('', broadcast_id),
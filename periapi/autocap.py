@@ -4,13 +4,19 @@ Periscope API for the masses
 """
 
 import os
+import threading
 import time
 
+from periapi import events
+from periapi.backlog import BacklogSweeper
 from periapi.downloadmgr import DownloadManager
 from periapi.listener import Listener
-from periapi.broadcast import Broadcast
+from periapi.broadcast import Broadcast, check_clip
+from periapi.library import LibraryIndex, index_path
+from periapi.polling import AdaptivePoller
 
 DEFAULT_NOTIFICATION_INTERVAL = 15
+STATUS_LISTING_INTERVAL = 150
 
 
 class AutoCap:
@@ -29,91 +35,140 @@ class AutoCap:
         if not os.path.exists(self.config.get("download_directory")):
             os.makedirs(self.config.get("download_directory"))
 
-        self.listener = Listener(api=self.api, **listener_opts)
-        self.downloadmgr = DownloadManager(api=self.api)
+        # Only directories changed since the last crawl are listed again
+        with LibraryIndex(index_path(self.config)) as index:
+            index.rebuild(self.config.get('download_directory'))
+
+        self.downloadmgr = DownloadManager(api=self.api, quiet_mode=quiet_mode)
+        self.events = self.downloadmgr.events
+        self.listener = Listener(api=self.api, count_active=self.downloadmgr.count_user_downloads,
+                                 **listener_opts)
+        self.poller = AdaptivePoller(self.config, start_interval=self.interval)
+        self.backlog = BacklogSweeper(self.api, self.downloadmgr, rules=self.listener.rules)
 
     def start(self):
         """Starts autocapper loop"""
 
-        loops = 0
+        last_listing = time.time()
+        if self.listener.check_backlog:
+            threading.Thread(target=self.sweep_backlog, args=(dict(self.listener.follows),),
+                             daemon=True).start()
+
         while self.keep_running:
 
-            new_broadcasts = self.listener.check_for_new()
+            try:
+                new_broadcasts = self.listener.check_for_new()
+            except IOError as error:
+                # Periscope is down or struggling; keep the pool and running downloads and
+                # try again next time around (the circuit breaker keeps this cheap)
+                new_broadcasts = None
+                self.events.publish(events.NOTICE, "Could not check for new broadcasts: "
+                                    "{}".format(error))
 
+            self.poller.record_poll(new_broadcasts)
             if new_broadcasts:
                 for broadcast in new_broadcasts:
                     self.downloadmgr.start_dl(broadcast)
 
-            if not self.quiet_mode:
-                loops = self.print_current_status(loops)
+            self.backlog.feed()
+            self.downloadmgr.retry_deferred()
 
-            time.sleep(self.interval)
+            last_listing = self.report_status(last_listing)
 
-        self.downloadmgr.pool.close()
-        self.downloadmgr.pool.join()
+            time.sleep(self.poller.next_interval())
+
+        self.downloadmgr.shutdown()
+        self.events.close()
 
     def stop(self):
         """Stops autocapper loop"""
         self.keep_running = False
 
-    def cap_one(self, broadcast_id):
-        """Cap a single broadcast"""
+    def cap_one(self, broadcast_id, start=None, end=None):
+        """Cap a single broadcast. With start and/or end (offsets in seconds) only that part of
+        the replay is downloaded; a live broadcast will be clipped once its replay is up. Returns
+        the broadcast's DownloadHandle once it is done. Raises ValueError for offsets that
+        don't make a window."""
+        check_clip(start, end)
         broadcast_info = self.api.get_access(broadcast_id).get('broadcast')
         broadcast = Broadcast(self.api, broadcast_info)
-        self.downloadmgr.start_dl(broadcast)
-        _ = len(self.downloadmgr.active_downloads)
-        while _ > 0:
-            if not self.quiet_mode:
-                print(self.downloadmgr.status)
-            time.sleep(self.interval)
-            self.downloadmgr.sema.acquire()
-            _ = len(self.downloadmgr.active_downloads)
-            self.downloadmgr.sema.release()
-        self.downloadmgr.pool.close()
-        self.downloadmgr.pool.join()
+        broadcast.clip = (start, end)
+        if broadcast.clip is not None and broadcast.islive:
+            broadcast.wait_for_replay = True
+        handle = self.downloadmgr.start_dl(broadcast)
+        return self.wait_for_downloads([handle])[0]
 
     def cap_user(self, username):
-        """Cap all broadcasts by a user"""
-        user_id = self.api.find_user_id(username)
-        broadcasts = self.api.get_user_broadcast_history(user_id)
-        if len(broadcasts) < 1:
-            print("No broadcast history found for {}".format(username))
+        """Cap all broadcasts by a user. Returns their DownloadHandles in the order they
+        finished."""
+        if not self.sweep_backlog([username]):
+            self.events.publish(events.NOTICE, "No new broadcasts found for {}".format(username))
             return None
-        for i in broadcasts:
-            broadcast = Broadcast(self.api, i)
-            self.downloadmgr.start_dl(broadcast)
-        _ = len(self.downloadmgr.active_downloads)
-        while _ > 0:
-            if not self.quiet_mode:
-                print(self.downloadmgr.status)
-            time.sleep(self.interval)
-            self.downloadmgr.sema.acquire()
-            _ = len(self.downloadmgr.active_downloads)
-            self.downloadmgr.sema.release()
-        self.downloadmgr.pool.close()
-        self.downloadmgr.pool.join()
-
-    def print_current_status(self, loops):
-        """Prints current status and lists active downloads every so often"""
-        print(self.downloadmgr.status)
-        if (loops * self.interval) > 150:
-            loops = 0
-            if len(self.downloadmgr.currently_downloading) > 0:
-                print("\tCurrently downloading:")
-                for bc_title in self.downloadmgr.currently_downloading:
-                    print("\t{}".format(bc_title))
-        else:
-            loops += 1
-        return loops
+        return self.wait_for_downloads(self.backlog.feed(), self.backlog)
+
+    def sweep_backlog(self, users):
+        """Queue the broadcasts in the histories of users (see BacklogSweeper.collect) that
+        haven't been downloaded yet. Returns the number queued."""
+        queued = self.backlog.collect(users)
+        if queued:
+            self.events.publish(events.NOTICE, "Backlog sweep found {} broadcasts to "
+                                "download".format(queued), queued=queued)
+        return queued
+
+    def wait_for_downloads(self, handles, sweeper=None):
+        """Wait for downloads to finish, feeding in the downloads queued by sweeper as others
+        finish, retrying deferred ones and printing status every interval, then shut down the
+        pool. Returns the handles in the order they finished."""
+        pending = list(handles)
+        finished = list()
+        while pending:
+            for handle in self.downloadmgr.as_completed(pending, timeout=self.interval):
+                pending.remove(handle)
+                finished.append(handle)
+                if sweeper is not None:
+                    started = sweeper.feed()
+                    if started:
+                        pending.extend(started)
+                        break
+            if pending:
+                lines = [self.downloadmgr.status]
+                lines.extend("\t{}".format(i) for i in self.downloadmgr.currently_downloading)
+                self.events.publish(events.STATUS, "\n".join(lines),
+                                    progress=self.downloadmgr.progress)
+                self.downloadmgr.retry_deferred()
+        self.downloadmgr.shutdown()
+        self.events.close()
+        return finished
+
+    def report_status(self, last_listing):
+        """Publishes the current status, and every so often a list of active downloads and how
+        quickly new broadcasts are being found. Returns when that list was last published."""
+        lines = [self.downloadmgr.status]
+        if time.time() - last_listing <= STATUS_LISTING_INTERVAL:
+            self.events.publish(events.STATUS, lines[0], progress=self.downloadmgr.progress)
+            return last_listing
+        currently_downloading = self.downloadmgr.currently_downloading
+        if len(currently_downloading) > 0:
+            lines.append("\tCurrently downloading:")
+            lines.extend("\t{}".format(bc_title) for bc_title in currently_downloading)
+        detection = self.poller.detection_stats
+        if detection is not None:
+            lines.append("\tNew broadcasts found {0:.0f}s after going live (90% within {1:.0f}s), "
+                         "checking every {2:.0f}s".format(detection['median'], detection['p90'],
+                                                           self.poller.interval))
+        if self.listener.rules.summary is not None:
+            lines.append("\tSkipped by capture rules: {}".format(self.listener.rules.summary))
+        self.events.publish(events.STATUS, "\n".join(lines),
+                            currently_downloading=currently_downloading,
+                            progress=self.downloadmgr.progress, detection=detection,
+                            dropped_by_rules=dict(self.listener.rules.counts))
+        return time.time()
 
     @property
     def interval(self):
-        """Get the interval (in seconds) to check for notifications.
-        Set default if no value exists."""
-        if not self.config.get('notification_interval'):
-            self.config['notification_interval'] = DEFAULT_NOTIFICATION_INTERVAL
-            self.config.write()
-        return self.config.get('notification_interval')
+        """Get the interval (in seconds) to check on downloads, which is also where notification
+        checks start out before adapting; the default if none is set"""
+        return self.config.get('notification_interval') or DEFAULT_NOTIFICATION_INTERVAL
 
     @interval.setter
     def interval(self, value):
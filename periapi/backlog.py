@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+Periscope API for the masses
+
+Sweeps of users' broadcast histories for broadcasts that haven't been downloaded yet
+"""
+
+import threading
+
+from collections import deque
+from concurrent.futures import as_completed
+
+from dateutil.parser import parse as dt_parse
+
+from periapi import metrics
+from periapi.broadcast import Broadcast
+from periapi.library import LibraryIndex, index_path
+from periapi.logging import logging
+from periapi.ratelimit import RateLimitedExecutor
+
+SWEEP_WORKERS = 4
+HISTORY_RATE = 1.0
+MAX_QUEUED_DOWNLOADS = 4
+
+
+class BacklogSweeper:
+    """Fetches the broadcast histories of many users through a bounded, rate limited pool and
+    queues the broadcasts that are neither in the library nor already known to the download
+    manager. Queued broadcasts are handed to the download manager a few at a time by feed().
+    Once a user's downloads have all finished, the newest broadcast swept is remembered
+    (config 'backlog_marks'), so later sweeps skip everything up to it."""
+
+    def __init__(self, api, downloadmgr, max_queued=None, rules=None):
+        self.api = api
+        self.downloadmgr = downloadmgr
+        self.rules = rules
+        self.config = self.api.session.config
+        self.max_queued = max_queued or self.config.get('backlog_max_queued') or \
+            MAX_QUEUED_DOWNLOADS
+        self.queue = deque()
+        self.handles = list()
+        self.sweeps = dict()
+        self.lock = threading.Lock()
+
+    @property
+    def marks(self):
+        """Dict of user id -> start time (ATOM string) of the newest broadcast swept"""
+        return self.config.get('backlog_marks') or dict()
+
+    def set_mark(self, user_id, start):
+        """Remember that user_id's history has been swept up to start"""
+        with self.lock:
+            marks = self.marks
+            marks[user_id] = start
+            self.config['backlog_marks'] = marks
+        self.config.write()
+
+    def collect(self, users):
+        """Fetch the histories of users (a dict of username -> user id, or usernames to look
+        up) and queue the broadcasts worth downloading, oldest first. Returns the number
+        queued."""
+        user_ids = users if isinstance(users, dict) else self.api.resolve_user_ids(users)
+        marks = self.marks
+        with LibraryIndex(index_path(self.config)) as index:
+            have_replay = index.broadcast_ids('replay')
+
+        found = list()
+        futures = dict()
+        with RateLimitedExecutor(SWEEP_WORKERS, HISTORY_RATE) as executor:
+            for username, user_id in user_ids.items():
+                if user_id is None:
+                    logging.info("Backlog sweep: could not find user %s", username)
+                else:
+                    futures[executor.submit(self.api.get_user_broadcast_history,
+                                            user_id)] = user_id
+            for future in as_completed(futures):
+                user_id = futures[future]
+                try:
+                    history = future.result()
+                except (ValueError, IOError) as error:
+                    logging.info("Backlog sweep: could not fetch history of %s: %r",
+                                 user_id, error)
+                    continue
+                wanted, newest = self.new_broadcasts(history, marks.get(user_id), have_replay)
+                found.extend((user_id, broadcast) for broadcast in wanted)
+                # A mark only moves once everything before it has been downloaded
+                if wanted:
+                    with self.lock:
+                        sweep = self.sweeps.setdefault(
+                            user_id, {'newest': newest, 'unfed': 0, 'handles': list()})
+                        sweep['newest'] = max(sweep['newest'], newest, key=dt_parse)
+                        sweep['unfed'] += len(wanted)
+                elif newest is not None:
+                    self.set_mark(user_id, newest)
+
+        found.sort(key=lambda item: item[1].start_dt)
+        self.queue.extend(found)
+        return len(found)
+
+    def new_broadcasts(self, history, mark, have_replay):
+        """The broadcasts of one user's history that started after mark and still need
+        downloading, and the start time of the newest broadcast in the history"""
+        mark_dt = dt_parse(mark) if mark else None
+        wanted = list()
+        newest = None
+        for info in history or list():
+            start_dt = dt_parse(info['start'])
+            if newest is None or start_dt > dt_parse(newest):
+                newest = info['start']
+            if mark_dt is not None and start_dt <= mark_dt:
+                continue
+            if info['id'] in have_replay or self.downloadmgr.is_tracking(info['id']):
+                continue
+            broadcast = Broadcast(self.api, info)
+            if not (broadcast.islive or broadcast.isreplay):
+                continue
+            # feed() already paces the sweep, so the per-user concurrency limit is skipped
+            if self.rules is None or self.rules.check(broadcast, queued=None):
+                wanted.append(broadcast)
+        return wanted, newest
+
+    def feed(self):
+        """Start queued downloads while fewer than max_queued of this sweep's downloads are
+        unfinished. Returns the handles of the downloads started."""
+        self.handles = [handle for handle in self.handles if not handle.done()]
+        started = list()
+        while self.queue and len(self.handles) < self.max_queued:
+            user_id, broadcast = self.queue.popleft()
+            handle = None
+            if not self.downloadmgr.is_tracking(broadcast.id):
+                handle = self.downloadmgr.start_dl(broadcast)
+                self.handles.append(handle)
+                started.append(handle)
+            with self.lock:
+                self.sweeps[user_id]['unfed'] -= 1
+                if handle is not None:
+                    self.sweeps[user_id]['handles'].append((broadcast.start, handle))
+        self.advance_marks()
+        metrics.set_gauge('periapi_queue_depth', len(self.queue), queue='backlog')
+        return started
+
+    def advance_marks(self):
+        """Move the marks of users whose swept broadcasts have all been handed off and are done
+        downloading: to the newest broadcast seen or, if some failed, to the newest one
+        downloaded before the first failure, so the next sweep tries the failures again"""
+        with self.lock:
+            settled = [user_id for user_id, sweep in self.sweeps.items() if not sweep['unfed']
+                       and all(handle.done() for _, handle in sweep['handles'])]
+            sweeps = [(user_id, self.sweeps.pop(user_id)) for user_id in settled]
+        for user_id, sweep in sweeps:
+            failed = [dt_parse(start) for start, handle in sweep['handles'] if not handle.ok]
+            if not failed:
+                self.set_mark(user_id, sweep['newest'])
+                continue
+            downloaded = [start for start, handle in sweep['handles']
+                          if handle.ok and dt_parse(start) < min(failed)]
+            if downloaded:
+                self.set_mark(user_id, max(downloaded, key=dt_parse))
@@ -4,8 +4,23 @@ Periscope API for the masses
 """
 
 import os
+import time
 from dateutil.parser import parse as dt_parse
 
+from periapi.diskspace import DEFAULT_MIN_FREE_SPACE
+from periapi.hls import parse_quality
+from periapi.library import index_path
+
+
+def check_clip(start, end):
+    """Raise ValueError unless (start, end) is a usable clip window: offsets in seconds that
+    aren't negative, either of them None for an open end, with start before end"""
+    for offset in (start, end):
+        if offset is not None and offset < 0:
+            raise ValueError("Clip offsets can't be negative.")
+    if start is not None and end is not None and start >= end:
+        raise ValueError("Clip start must come before its end.")
+
 
 class BroadcastDownloadInfo:
     """Contains information about the broadcast's download but not about the broadcast itself"""
@@ -17,12 +32,94 @@ class BroadcastDownloadInfo:
         self.dl_info['wait_for_replay'] = False
         self.dl_info['replay_downloaded'] = False
         self.dl_info['last_failure_reason'] = None
+        self.dl_info['clip'] = None
+        self.dl_info['live_chunks'] = list()
+        self.dl_info['stall_events'] = list()
+        self.dl_info['estimated_size'] = None
+        self.dl_info['notified_at'] = None
+        self.dl_info['hls_url'] = None
+        self.dl_info['hls_url_resolved_at'] = None
+        self.dl_info['first_byte_latency'] = None
+        self.dl_info['first_byte_reported'] = False
+        self.dl_info['stalls_reported'] = 0
+        self.dl_info['trace'] = list()
 
     @property
     def dl_times(self):
         """List of timestamps broadcast download was started or restarted"""
         return self.dl_info['dl_times']
 
+    @property
+    def stall_events(self):
+        """List of timestamps at which a stalled live capture was killed and restarted"""
+        return self.dl_info['stall_events']
+
+    @property
+    def estimated_size(self):
+        """Estimated size in bytes of the download, if known"""
+        return self.dl_info['estimated_size']
+
+    @estimated_size.setter
+    def estimated_size(self, size):
+        """Set estimated size in bytes of the download"""
+        self.dl_info['estimated_size'] = size
+
+    @property
+    def notified_at(self):
+        """Timestamp at which the broadcast turned up in the notification feed, if it did"""
+        return self.dl_info['notified_at']
+
+    @notified_at.setter
+    def notified_at(self, when):
+        """Set when the broadcast turned up in the notification feed"""
+        self.dl_info['notified_at'] = when
+
+    @property
+    def hls_url(self):
+        """Live stream url resolved ahead of the download, if any"""
+        return self.dl_info['hls_url']
+
+    @hls_url.setter
+    def hls_url(self, url):
+        """Store a resolved live stream url, noting when it was resolved"""
+        self.dl_info['hls_url'] = url
+        self.dl_info['hls_url_resolved_at'] = time.time() if url else None
+
+    @property
+    def hls_url_resolved_at(self):
+        """Timestamp at which hls_url was resolved"""
+        return self.dl_info['hls_url_resolved_at']
+
+    @property
+    def first_byte_latency(self):
+        """Seconds from notification to the first captured bytes of the live stream"""
+        return self.dl_info['first_byte_latency']
+
+    @first_byte_latency.setter
+    def first_byte_latency(self, seconds):
+        """Set seconds from notification to the first captured bytes"""
+        self.dl_info['first_byte_latency'] = seconds
+
+    @property
+    def first_byte_reported(self):
+        """Whether first_byte_latency has been published by the download manager"""
+        return self.dl_info['first_byte_reported']
+
+    @first_byte_reported.setter
+    def first_byte_reported(self, boolean):
+        """Set whether first_byte_latency has been published"""
+        self.dl_info['first_byte_reported'] = bool(boolean)
+
+    @property
+    def stalls_reported(self):
+        """Number of stall_events the download manager has published"""
+        return self.dl_info['stalls_reported']
+
+    @stalls_reported.setter
+    def stalls_reported(self, count):
+        """Set the number of stall_events published"""
+        self.dl_info['stalls_reported'] = count
+
     @property
     def dl_failures(self):
         """Counter for how many times download has failed"""
@@ -53,6 +150,30 @@ class BroadcastDownloadInfo:
         """Return whether or not live download should be skipped and replay should be waited for"""
         self.dl_info['wait_for_replay'] = bool(boolean)
 
+    @property
+    def live_chunks(self):
+        """Paths of the raw .ts chunks kept from live capture for reconciling with the replay"""
+        return self.dl_info['live_chunks']
+
+    @property
+    def trace(self):
+        """Timed phases (lists of span dicts) of the latest download attempts"""
+        return self.dl_info['trace']
+
+    @property
+    def clip(self):
+        """(start, end) offsets in seconds of the part of the replay to download, or None"""
+        return self.dl_info['clip']
+
+    @clip.setter
+    def clip(self, window):
+        """Set (start, end) offsets in seconds to only download part of the replay. Either
+        offset may be None for an open end."""
+        if window:
+            check_clip(*window)
+        self.dl_info['clip'] = tuple(window) if window and any(i is not None for i in window) \
+            else None
+
     @property
     def replay_downloaded(self):
         """Boolean indicating whether or not a replay of the broadcast has been downloaded"""
@@ -77,6 +198,16 @@ class Broadcast(BroadcastDownloadInfo):
         self._original_filetitle = self.filetitle
         self.dl_info['download_directory'] = self.api.session.config.get('download_directory')[:]
         self.dl_info['separate_folders'] = self.api.session.config.get('separate_folders')
+        self.dl_info['scratch_directory'] = self.api.session.config.get('scratch_directory')
+        self.dl_info['remux_engine'] = self.api.session.config.get('remux_engine')
+        self.dl_info['replay_quality'] = parse_quality(
+            self.api.session.config.get('replay_quality'))
+        self.dl_info['max_bandwidth'] = self.api.session.config.get('max_bandwidth')
+        self.dl_info['reconcile_live'] = self.api.session.config.get('reconcile_live')
+        self.dl_info['preallocate'] = self.api.session.config.get('preallocate', True)
+        self.dl_info['min_free_space'] = self.api.session.config.get('min_free_space',
+                                                                     DEFAULT_MIN_FREE_SPACE)
+        self.dl_info['library_index'] = index_path(self.api.session.config)
 
     def update_info(self):
         """Updates broadcast object with latest info from periscope"""
@@ -102,6 +233,52 @@ class Broadcast(BroadcastDownloadInfo):
             return os.path.join(self.dl_info['download_directory'], self.username)
         return self.dl_info['download_directory']
 
+    @property
+    def staging_directory(self):
+        """Directory temporary files are written to: the scratch directory if one is
+        configured, otherwise the download directory"""
+        return self.dl_info['scratch_directory'] or self.download_directory
+
+    @property
+    def temp_directory(self):
+        """Directory the chunks of this broadcast are stored in until they are assembled"""
+        return os.path.join(self.staging_directory, ".periapi.{}".format(self.filetitle))
+
+    @property
+    def remux_engine(self):
+        """Configured .ts to .mp4 conversion engine ('ffmpeg', 'python' or None for automatic)"""
+        return self.dl_info['remux_engine']
+
+    @property
+    def replay_quality(self):
+        """Preferred replay variant: 'best', 'worst' or a picture height (None means best)"""
+        return self.dl_info['replay_quality']
+
+    @property
+    def max_bandwidth(self):
+        """Highest variant bandwidth (bits/s) to download, or None for no limit"""
+        return self.dl_info['max_bandwidth']
+
+    @property
+    def reconcile_live(self):
+        """Whether the replay should be built from the live capture plus whatever it missed"""
+        return self.dl_info['reconcile_live']
+
+    @property
+    def preallocate(self):
+        """Whether the final file should be preallocated before it is written"""
+        return self.dl_info['preallocate']
+
+    @property
+    def min_free_space(self):
+        """Bytes to keep free on every drive the download writes to"""
+        return self.dl_info['min_free_space']
+
+    @property
+    def library_index(self):
+        """Path of the library index the finished download is recorded in"""
+        return self.dl_info['library_index']
+
     @property
     def id(self):
         """Returns broadcast id"""
@@ -132,6 +309,21 @@ class Broadcast(BroadcastDownloadInfo):
         """Human-readable time string of when broadcast started"""
         return self.start_dt.strftime('%H:%M:%S')
 
+    @property
+    def duration(self):
+        """Length in seconds of a broadcast that has ended, or None if unknown"""
+        if self.islive or not self.info.get('end'):
+            return None
+        try:
+            return (dt_parse(self.info['end']) - self.start_dt).total_seconds()
+        except (KeyError, ValueError, TypeError):
+            return None
+
+    @property
+    def language(self):
+        """Language code Periscope gives the broadcast, e.g. 'en', or None"""
+        return self.info.get('language')
+
     @property
     def title(self):
         """Title of broadcast (in the context of the downloader)"""
@@ -159,7 +351,11 @@ class Broadcast(BroadcastDownloadInfo):
                 self._original_filetitle = self.title.replace('/', '-').replace(':', '-') + '.live'
             else:
                 self._original_filetitle = self.title.replace('/', '-').replace(':', '-')
-        return self._original_filetitle
+        # The clip can be set after the name was cached, so its suffix is never cached
+        if self.clip is None:
+            return self._original_filetitle
+        return self._original_filetitle + '.clip-{}-{}'.format(
+            *['{:g}'.format(i) if i is not None else 'end' for i in self.clip])
 
     @property
     def islive(self):
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+"""
+Periscope API for the masses
+
+Per host circuit breakers, so an unreachable host is given a rest instead of being hammered
+"""
+
+import json
+import os
+import re
+import threading
+import time
+
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+import requests
+
+from periapi.logging import logging
+from periapi.ratelimit import fcntl, file_state
+
+FAILURE_THRESHOLD = 5
+RESET_TIMEOUT = 30
+# How stale a shared breaker's view of the other processes' calls may get
+SHARED_REFRESH_INTERVAL = 1.0
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+_BREAKERS = dict()
+_BREAKERS_LOCK = threading.Lock()
+_STATE_DIR = None
+
+
+class CircuitOpen(IOError):
+    """Raised instead of making a call to a host that is known to be down"""
+    pass
+
+
+class CircuitBreaker:
+    """Counts consecutive failed calls to one host. After failure_threshold of them the circuit
+    opens and calls fail fast with CircuitOpen. Every reset_timeout seconds one probe call is
+    let through (half-open); if it succeeds the circuit closes again."""
+
+    def __init__(self, host, failure_threshold=FAILURE_THRESHOLD, reset_timeout=RESET_TIMEOUT):
+        self.host = host
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = {'state': CLOSED, 'failures': 0, 'opened_at': 0.0}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def _locked_state(self):
+        """Exclusive access to the breaker's state"""
+        with self.lock:
+            yield self.state
+
+    def _peek(self):
+        """The breaker's state as last seen, for checks that change nothing"""
+        return self.state
+
+    @property
+    def is_open(self):
+        """Whether calls to the host would currently fail fast"""
+        state = self._peek()
+        return state['state'] != CLOSED and time.time() - state['opened_at'] < self.reset_timeout
+
+    def before_call(self):
+        """Raise CircuitOpen unless a call may be made now. Once the reset timeout has passed
+        the caller becomes the probe; a probe that never reports back is replaced after
+        another reset timeout."""
+        if self._peek()['state'] == CLOSED:
+            return None
+        with self._locked_state() as state:
+            if state['state'] == CLOSED:
+                return None
+            if time.time() - state['opened_at'] >= self.reset_timeout:
+                state['state'] = HALF_OPEN
+                state['opened_at'] = time.time()
+                return None
+            remaining = self.reset_timeout - (time.time() - state['opened_at'])
+        raise CircuitOpen("{} is unreachable; calls resume within {:.0f}s.".format(
+            self.host, remaining))
+
+    def record_success(self):
+        """Note a call that reached the host"""
+        state = self._peek()
+        if state['state'] == CLOSED and not state['failures']:
+            return None
+        with self._locked_state() as state:
+            if state['state'] != CLOSED:
+                logging.info("%s is reachable again", self.host)
+            state['state'] = CLOSED
+            state['failures'] = 0
+
+    def record_failure(self):
+        """Note a call that failed because of the host"""
+        with self._locked_state() as state:
+            state['failures'] += 1
+            if state['state'] == HALF_OPEN or state['failures'] >= self.failure_threshold:
+                if state['state'] == CLOSED:
+                    logging.warning("%s failed %s times in a row, pausing calls to it",
+                                    self.host, state['failures'])
+                state['state'] = OPEN
+                state['opened_at'] = time.time()
+
+
+class SharedCircuitBreaker(CircuitBreaker):
+    """CircuitBreaker whose state is kept in a file under an exclusive lock, so the parent and
+    every download process see one breaker per host. The file is only locked and written when
+    the state changes; calls to a healthy host just reread it every SHARED_REFRESH_INTERVAL
+    seconds. Without fcntl (Windows) each process gets a breaker of its own."""
+
+    def __init__(self, host, path, **kw):
+        super().__init__(host, **kw)
+        self.path = path
+        self.refreshed = 0.0
+
+    @contextmanager
+    def _locked_state(self):
+        with self.lock:
+            if fcntl is None:
+                yield self.state
+                return
+            with file_state(self.path, self.state) as state:
+                yield state
+            self.state, self.refreshed = state, time.time()
+
+    def _peek(self):
+        if fcntl is not None and time.time() - self.refreshed >= SHARED_REFRESH_INTERVAL:
+            self.refreshed = time.time()
+            try:
+                with open(self.path) as handle:
+                    self.state = dict(self.state, **json.load(handle))
+            except (IOError, ValueError):
+                # Not written yet, or caught mid-write; the last view will do until next time
+                pass
+        return self.state
+
+
+def share(state_dir):
+    """Keep breaker state in files under state_dir from now on, so every process sharing it
+    (the parent and its download pool) sees the same breakers"""
+    global _STATE_DIR
+    os.makedirs(state_dir, exist_ok=True)
+    with _BREAKERS_LOCK:
+        _STATE_DIR = state_dir
+        _BREAKERS.clear()
+
+
+def breaker(url):
+    """The circuit breaker of url's host: shared between processes once share() has been
+    called, otherwise by everything in this process"""
+    host = urlparse(url).netloc or url
+    with _BREAKERS_LOCK:
+        if host not in _BREAKERS:
+            if _STATE_DIR is None:
+                _BREAKERS[host] = CircuitBreaker(host)
+            else:
+                path = os.path.join(_STATE_DIR, 'circuit-' + re.sub(r'[^\w.-]', '_', host))
+                _BREAKERS[host] = SharedCircuitBreaker(host, path)
+        return _BREAKERS[host]
+
+
+def is_outage(error):
+    """Whether an exception means a host was unreachable rather than that the call was bad"""
+    return isinstance(error, (CircuitOpen, requests.ConnectionError, requests.Timeout))
+
+
+def request(method, url, session=None, **kw):
+    """requests.request (or session.request) guarded by the breaker of url's host. Connection
+    errors, timeouts and 5xx responses count as failures."""
+    host_breaker = breaker(url)
+    host_breaker.before_call()
+    try:
+        resp = (session or requests).request(method, url, **kw)
+    except (requests.ConnectionError, requests.Timeout):
+        host_breaker.record_failure()
+        raise
+    if resp.status_code >= 500:
+        host_breaker.record_failure()
+    else:
+        host_breaker.record_success()
+    return resp
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+"""
+Periscope API for the masses
+
+Cleanup of live recordings made redundant by a downloaded replay
+"""
+
+import os
+
+from collections import namedtuple
+
+from periapi.library import SCAN_WORKERS
+
+Redundant = namedtuple('Redundant', ['path', 'broadcast_id', 'size'])
+
+
+def plan_cleanup(index, root, workers=SCAN_WORKERS):
+    """Bring the index up to date for root and list the live recordings below it whose replay
+    has been downloaded, wherever in the library the replay is. Nothing is deleted, so this
+    doubles as a dry run."""
+    index.rebuild(root, workers)
+    replays = index.broadcast_ids('replay')
+    return [Redundant(*row) for row in index.files_of_kind('live', root) if row[1] in replays]
+
+
+def reclaimable_bytes(plan):
+    """Bytes freed by carrying out a cleanup plan"""
+    return sum(item.size for item in plan)
+
+
+def run_cleanup(index, plan):
+    """Delete the files of a cleanup plan. A live recording is only deleted while its replay is
+    still on disk. Returns (files deleted, bytes freed, paths that could not be deleted)."""
+    confirmed = set()
+    deleted = 0
+    freed = 0
+    failed = []
+    for item in plan:
+        if item.broadcast_id not in confirmed:
+            if not index.has(item.broadcast_id, 'replay'):
+                continue
+            confirmed.add(item.broadcast_id)
+        try:
+            if os.path.exists(item.path):
+                os.remove(item.path)
+                deleted += 1
+                freed += item.size
+            index.remove(item.path)
+        except OSError:
+            failed.append(item.path)
+    return deleted, freed, failed
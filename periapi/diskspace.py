@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+Periscope API for the masses
+
+Disk space estimates, admission checks, preallocation and moving finished files into place
+"""
+
+import errno
+import os
+import shutil
+
+DEFAULT_MIN_FREE_SPACE = 1 << 30
+DEFAULT_LIVE_BITRATE = 1000000
+DEFAULT_LIVE_DURATION = 3600
+
+
+class InsufficientDiskSpace(Exception):
+    """Raised when the target filesystem can't hold a download"""
+    pass
+
+
+def _existing(directory):
+    """Closest existing ancestor of directory (the directory may not have been created yet)"""
+    directory = os.path.abspath(directory)
+    while not os.path.exists(directory) and os.path.dirname(directory) != directory:
+        directory = os.path.dirname(directory)
+    return directory
+
+
+def free_bytes(directory):
+    """Free bytes on the filesystem directory lives on"""
+    return shutil.disk_usage(_existing(directory)).free
+
+
+def estimate_broadcast_size(broadcast, live_bitrate=None, live_duration=None):
+    """Rough size in bytes of a broadcast download, from its length (or, while it is live,
+    the expected length) and a typical bitrate"""
+    bitrate = live_bitrate or DEFAULT_LIVE_BITRATE
+    duration = live_duration or DEFAULT_LIVE_DURATION
+    if broadcast.estimated_size:
+        return broadcast.estimated_size
+    if broadcast.duration is not None:
+        duration = broadcast.duration
+    return int(max(duration, 0) * bitrate / 8)
+
+
+def check_free_space(needs, min_free=DEFAULT_MIN_FREE_SPACE):
+    """Raise InsufficientDiskSpace unless every filesystem can hold what will be written to it.
+    needs is an iterable of (directory, bytes); directories on the same device are summed."""
+    per_device = dict()
+    for directory, size in needs:
+        directory = _existing(directory)
+        device = os.stat(directory).st_dev
+        per_device.setdefault(device, [directory, 0])[1] += size
+    for directory, size in per_device.values():
+        free = free_bytes(directory)
+        if free - size < min_free:
+            raise InsufficientDiskSpace(
+                "Not enough space in {}: {} MB needed, {} MB free.".format(
+                    directory, (size + min_free) // 1000000, free // 1000000))
+
+
+def preallocate(handle, size):
+    """Reserve size bytes for an open file up front to keep it from fragmenting. A no-op where
+    fallocate isn't available."""
+    if size <= 0 or not hasattr(os, 'posix_fallocate'):
+        return False
+    try:
+        os.posix_fallocate(handle.fileno(), 0, size)
+    except OSError:
+        return False
+    return True
+
+
+def move_into_place(source, target, preallocate_target=True):
+    """Move a finished file to its final location. Across filesystems it is copied next to the
+    target under a temporary name, synced and then renamed, so the target directory never
+    holds a partial file."""
+    try:
+        os.replace(source, target)
+        return None
+    except OSError as error:
+        if error.errno != errno.EXDEV:
+            raise
+
+    partial = target + '.part'
+    try:
+        with open(source, 'rb') as src, open(partial, 'wb') as dst:
+            if preallocate_target:
+                preallocate(dst, os.path.getsize(source))
+            shutil.copyfileobj(src, dst, 1 << 20)
+            dst.flush()
+            os.fsync(dst.fileno())
+        os.replace(partial, target)
+    finally:
+        if os.path.exists(partial):
+            os.remove(partial)
+    os.remove(source)
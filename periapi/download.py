@@ -7,36 +7,101 @@ under The MIT License as part of Pyriscope: https://github.com/rharkanson/pyrisc
 """
 
 import os
+import re
 import shutil
+import sqlite3
+import threading
 import time
 
-from subprocess import Popen
+from contextlib import contextmanager
+from itertools import chain
+from subprocess import Popen, DEVNULL
 from urllib.parse import quote
 
 import requests
 
-from periapi.threaded_download import ThreadPool
+from periapi import circuit
+from periapi import hls
+from periapi import metrics
+from periapi import progress
+from periapi import remux
+from periapi import tracing
+from periapi.logging import logging
+from periapi.diskspace import check_free_space, preallocate, move_into_place
+from periapi.library import LibraryIndex, HashingWriter, file_kind
+from periapi.login import API_BASE
+from periapi.threaded_download import ThreadPool, ReplayDeleted
+from periapi.remux import TsRemuxer, RemuxError, remux_files
 
 BROADCAST_URL_FORMAT = "https://www.periscope.tv/w/"
-REPLAY_ACCESS = "https://api.periscope.tv/api/v2/replayPlaylist.m3u8?broadcast_id={}&cookie={}"
-PUBLIC_ACCESS = "https://api.periscope.tv/api/v2/getAccessPublic?broadcast_id={0}"
-PRIVATE_ACCESS = "https://api.periscope.tv/api/v2/accessChannel"
+REPLAY_ACCESS = API_BASE + "/replayPlaylist.m3u8?broadcast_id={}&cookie={}"
+PUBLIC_ACCESS = API_BASE + "/getAccessPublic?broadcast_id={0}"
+PRIVATE_ACCESS = API_BASE + "/accessChannel"
 
 FAIL_RESUME_WAIT = 15
+PROBE_BYTES = 188 * 512
+ALIGNMENT_TOLERANCE = remux.PTS_CLOCK // 2
 MAX_DOWNLOAD_ATTEMPTS = 3
 DEFAULT_DL_THREADS = 6
+REQUEST_TIMEOUT = (5, 15)
+MIN_CHUNK_THROUGHPUT = 16 * 1024
+THROUGHPUT_GRACE_PERIOD = 5
+QUEUED_CHUNKS_PER_THREAD = 4
+CHUNK_RETRIES = 2
 
 EXTENSIONS = ['.mp4', '.ts']
 FFMPEG_CONVERT = "ffmpeg -y -v quiet -i \"{0}.ts\" -bsf:a aac_adtstoasc -codec copy \"{0}.mp4\""
-FFMPEG_LIVE = "ffmpeg -y -v quiet -i \"{0}\" -c copy \"{1}.ts\""
-
-
-def convert_download(filename):
-    """Uses FFMPEG to convert .ts to .mp4"""
-    Popen(FFMPEG_CONVERT.format(filename), shell=True).wait()
-    if not os.path.exists("{}.mp4".format(filename)):
-        time.sleep(10)
-        Popen(FFMPEG_CONVERT.format(filename), shell=True).wait()
+FFMPEG_LIVE = ["ffmpeg", "-y", "-nostdin", "-v", "quiet", "-i", "{0}", "-c", "copy", "{1}.ts"]
+
+CAPTURE_POLL_INTERVAL = 1
+CAPTURE_FIRST_BYTE_POLL = 0.1
+HLS_URL_MAX_AGE = 60
+CAPTURE_START_TIMEOUT = 20
+CAPTURE_STALL_TIMEOUT = 10
+LIVE_CHUNK_PATTERN = re.compile(r'^chunk(\d+)\.ts$')
+
+
+def use_remuxer(engine):
+    """Whether to convert with the built-in remuxer instead of FFMPEG. Engine is 'python',
+    'ffmpeg' or None, meaning FFMPEG if it can be found."""
+    if engine == 'python':
+        return True
+    if engine == 'ffmpeg':
+        return False
+    return shutil.which('ffmpeg') is None
+
+
+@contextmanager
+def partial_output(path):
+    """Yields a temporary path to write path's contents to. It is renamed to path once the block
+    completes and removed if the block raises, so path never holds a truncated file."""
+    partial = path + '.part'
+    try:
+        yield partial
+        os.replace(partial, path)
+    finally:
+        if os.path.exists(partial):
+            os.remove(partial)
+
+
+def convert_download(filename, engine=None):
+    """Uses FFMPEG (or the built-in remuxer) to convert .ts to .mp4"""
+    if not os.path.exists("{}.ts".format(filename)):
+        return None
+    if use_remuxer(engine):
+        try:
+            with metrics.timer('periapi_convert_seconds', engine='python'), \
+                    partial_output("{}.mp4".format(filename)) as partial:
+                remux_files(["{}.ts".format(filename)], partial)
+        except RemuxError:
+            return None
+    else:
+        with metrics.timer('periapi_convert_seconds', engine='ffmpeg'):
+            Popen(FFMPEG_CONVERT.format(filename), shell=True).wait()
+        if not os.path.exists("{}.mp4".format(filename)):
+            time.sleep(10)
+            with metrics.timer('periapi_convert_seconds', engine='ffmpeg'):
+                Popen(FFMPEG_CONVERT.format(filename), shell=True).wait()
     if os.path.exists("{}.mp4".format(filename)):
         try:
             os.remove("{}.ts".format(filename))
@@ -44,6 +109,52 @@ def convert_download(filename):
             pass
 
 
+def supervise_capture(command, output_path):
+    """Run an FFMPEG live capture, killing it if its output file stops growing (or never starts
+    to) so a dead stream can't hang the worker. Returns whether the capture had to be killed
+    and when its first bytes were written (None if it never wrote any)."""
+    process = Popen(command, stdin=DEVNULL)
+    last_size = 0
+    last_growth = time.time()
+    first_byte = None
+    try:
+        while process.poll() is None:
+            # Poll quickly until the capture starts so its start is timed precisely
+            time.sleep(CAPTURE_POLL_INTERVAL if last_size else CAPTURE_FIRST_BYTE_POLL)
+            size = os.path.getsize(output_path) if os.path.exists(output_path) else 0
+            if size > last_size:
+                progress.add_bytes(size - last_size)
+                first_byte = first_byte or time.time()
+                last_size, last_growth = size, time.time()
+            elif time.time() - last_growth > \
+                    (CAPTURE_STALL_TIMEOUT if last_size else CAPTURE_START_TIMEOUT):
+                return True, first_byte
+        if first_byte is None and os.path.exists(output_path) and os.path.getsize(output_path):
+            first_byte = time.time()
+        return False, first_byte
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+
+
+def last_live_chunk(directory):
+    """Highest chunkN.ts number an earlier capture left in directory (0 if none), so a resumed
+    capture never writes over a chunk that is still wanted"""
+    numbers = [int(match.group(1)) for match in map(LIVE_CHUNK_PATTERN.match, os.listdir(directory))
+               if match is not None]
+    return max(numbers, default=0)
+
+
+def raise_if_outage(error, url):
+    """Raise CircuitOpen in place of a chunk pool's ReplayDeleted if its chunks were lost to
+    url's host being unreachable, so the download is deferred rather than failed"""
+    host_breaker = circuit.breaker(url)
+    if circuit.is_outage(error.__cause__) or host_breaker.is_open:
+        raise circuit.CircuitOpen("Lost connection to {} during download.".format(
+            host_breaker.host)) from error
+
+
 def download_successful(broadcast):
     """Checks if download was successful"""
     checks = 3
@@ -60,18 +171,67 @@ def download_successful(broadcast):
     return False
 
 
-def grab_chunk(url, path, headers, cookies):
-    """Downloads one chunk from the periscope replay servers"""
-    with open(path, 'wb') as temp_file:
-        data = requests.get(url, stream=True, headers=headers, cookies=cookies)
-        if not data.ok:
-            raise Exception("Chunk download at {} failed.".format(url))
-        for block in data.iter_content(4096):
-            temp_file.write(block)
+class ChunkStalled(Exception):
+    """Raised when a chunk transfer falls below the minimum throughput"""
+    pass
+
+
+def grab_chunk(url, path, headers, cookies, byterange=None):
+    """Downloads one chunk (or a (length, offset) byte range of one) from the periscope replay
+    servers. Connections that stall or crawl below MIN_CHUNK_THROUGHPUT are aborted. The chunk
+    is written under a temporary name first, so a duplicate request for the same chunk running
+    in another thread can't leave a half-written file behind."""
+    if byterange is not None:
+        length, offset = byterange
+        headers = dict(headers, Range="bytes={}-{}".format(offset, offset + length - 1))
+    temp_path = "{}.part{}".format(path, threading.get_ident())
+    requested = time.time()
+    received = 0
+    replaced = False
+    try:
+        with open(temp_path, 'wb') as temp_file:
+            data = circuit.request('GET', url, stream=True, headers=headers, cookies=cookies,
+                                   timeout=REQUEST_TIMEOUT)
+            if not data.ok:
+                raise Exception("Chunk download at {} failed.".format(url))
+            started = time.time()
+            for block in data.iter_content(4096):
+                temp_file.write(block)
+                received += len(block)
+                elapsed = time.time() - started
+                if elapsed > THROUGHPUT_GRACE_PERIOD and \
+                        received / elapsed < MIN_CHUNK_THROUGHPUT:
+                    data.close()
+                    raise ChunkStalled("Chunk download at {} stalled.".format(url))
+        os.replace(temp_path, path)
+        replaced = True
+        metrics.observe('periapi_chunk_seconds', time.time() - requested)
+    except Exception as error:
+        metrics.inc('periapi_chunk_failures_total', reason=metrics.reason(error))
+        raise
+    finally:
+        metrics.add_download_bytes(received)
+        progress.add_bytes(received, chunk_done=replaced)
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def worth_retrying(error):
+    """Whether a failed chunk download should be tried again: not while its host's circuit
+    breaker is open, when the retry would fail straight away"""
+    return not isinstance(error, circuit.CircuitOpen)
 
 
 def replay_downloaded(broadcast):
-    """Boolean indicating if given replay has been downloaded already"""
+    """Boolean indicating if given replay has been downloaded already. The library index finds
+    it wherever it was saved, even under a different folder layout or title."""
+    if broadcast.clip is None:
+        try:
+            with LibraryIndex(broadcast.library_index) as index:
+                if index.has(broadcast.id, 'replay'):
+                    return True
+        except sqlite3.Error as error:
+            logging.warning("Library index lookup failed: %s", error)
     for extension in EXTENSIONS:
         if os.path.exists(broadcast.filepathname + extension):
             return True
@@ -87,11 +247,16 @@ class Download:
             'User-Agent': 'Periscope/3313 (iPhone; iOS 7.1.1; Scale/2.00)',
             "Accept-Encoding": "gzip, deflate",
             }
+        self.content_hashes = dict()
 
-    def start(self):
-        """Start broadcast download"""
+    def start(self, progress_slot=None):
+        """Start broadcast download, reporting its progress in progress_slot of the shared
+        progress table if given"""
         self.broadcast.lock_name = True
         was_replay = self.broadcast.isreplay
+        metrics.bind_download(self.broadcast.id)
+        progress.bind(progress_slot, self.broadcast.id)
+        tracing.begin_attempt(self.broadcast)
 
         try:
             if self.broadcast.dl_failures > 0:
@@ -112,11 +277,18 @@ class Download:
             elif self.broadcast.islive:
                 self.capture_live()
 
-            if download_successful(self.broadcast):
+            with tracing.span(self.broadcast, 'verify'):
+                successful = download_successful(self.broadcast)
+
+            if successful:
                 try:
-                    convert_download(self.broadcast.filepathname)
+                    with tracing.span(self.broadcast, 'convert'):
+                        convert_download(self.broadcast.filepathname,
+                                         self.broadcast.remux_engine)
                 except BaseException:
                     pass
+                with tracing.span(self.broadcast, 'index'):
+                    self._index_download()
                 if was_replay:
                     self.broadcast.replay_downloaded = True
                 return True, self.broadcast
@@ -129,34 +301,47 @@ class Download:
             self.broadcast.failure_reason = _
             return False, self.broadcast
 
+        finally:
+            # Pool processes end without running atexit, which would drop pending changes
+            self.broadcast.api.session.config.flush()
+
     def capture_live(self):
         """Get necessary info to cap a live broadcast with FFMPEG, and send to FFMPEG"""
 
-        payload = {'broadcast_id': self.broadcast.id, 'cookie': self.broadcast.cookie}
+        hls_url = self._live_hls_url()
 
-        access = requests.post(PRIVATE_ACCESS, json=payload).json()
-
-        if not access.get('hls_url'):
-            raise Exception("Couldn't get live stream download url. Usually means broadcast has"
-                            " been deleted/broadcaster has been banned.")
-
-        temp_dir = os.path.join(self.broadcast.download_directory,
-                                ".periapi.{}".format(self.broadcast.filetitle))
+        temp_dir = self.broadcast.temp_directory
 
         if not os.path.exists(temp_dir):
             os.makedirs(temp_dir)
 
         filepaths = []
-        _ = 0
-        while self.broadcast.islive:
-            _ += 1
-            self.broadcast.dl_times.append(time.time())
-            filepaths.append(os.path.join(temp_dir, "chunk{}".format(_)))
+        _ = last_live_chunk(temp_dir)
+        with tracing.span(self.broadcast, 'capture') as capture_span:
+            while self.broadcast.islive:
+                _ += 1
+                self.broadcast.dl_times.append(time.time())
+                filepaths.append(os.path.join(temp_dir, "chunk{}".format(_)))
+
+                download_command = [i.format(hls_url, filepaths[-1]) for i in FFMPEG_LIVE]
+                with metrics.timer('periapi_live_capture_seconds'):
+                    stalled, first_byte = supervise_capture(download_command,
+                                                            '{}.ts'.format(filepaths[-1]))
+                if os.path.exists('{}.ts'.format(filepaths[-1])):
+                    metrics.add_download_bytes(os.path.getsize('{}.ts'.format(filepaths[-1])))
+                if stalled:
+                    self.broadcast.stall_events.append(time.time())
+                    logging.warning("Killed stalled live capture of %s", self.broadcast.title)
+                if first_byte and self.broadcast.notified_at and \
+                        self.broadcast.first_byte_latency is None:
+                    self.broadcast.first_byte_latency = first_byte - self.broadcast.notified_at
+                    logging.info("First bytes of %s captured %.1fs after its notification",
+                                 self.broadcast.title, self.broadcast.first_byte_latency)
 
-            download_command = FFMPEG_LIVE.format(access.get('hls_url'), filepaths[-1])
-            Popen(download_command, shell=True).wait()
-
-            self.broadcast.update_info()
+                self.broadcast.update_info()
+            capture_span['bytes'] = sum(os.path.getsize(path) for path in
+                                        ['{}.ts'.format(i) for i in filepaths]
+                                        if os.path.exists(path))
 
         for ext in EXTENSIONS:
             if os.path.isfile("{}{}".format(self.broadcast.filepathname, ext)):
@@ -166,56 +351,101 @@ class Download:
                 os.rename("{}{}".format(self.broadcast.filepathname, ext),
                           "{}.old-{}{}".format(self.broadcast.filepathname, _, ext))
 
-        with open("{}.ts".format(self.broadcast.filepathname), 'wb') as handle:
-            for path in filepaths:
-                chunk = '{}.ts'.format(path)
-                if not os.path.exists(chunk) or os.path.getsize(chunk) == 0:
-                    continue
-                with open(chunk, 'rb') as ts_file:
-                    handle.write(ts_file.read())
+        self._assemble(['{}.ts'.format(path) for path in filepaths], stop_at_missing=False)
+
+        if self.broadcast.reconcile_live:
+            # Keep the raw chunks so the replay download only has to fill in the gaps
+            self.broadcast.live_chunks.extend(
+                path for path in ['{}.ts'.format(i) for i in filepaths]
+                if os.path.exists(path) and os.path.getsize(path) > 0)
+            return None
 
         try:
             shutil.rmtree(temp_dir)
         except BaseException:
             pass
 
+    def _live_hls_url(self):
+        """HLS url of the live stream. The one resolved when the notification came in is used
+        if it is still fresh, saving a round trip before FFMPEG can start."""
+        hls_url = self.broadcast.hls_url
+        if hls_url and time.time() - self.broadcast.hls_url_resolved_at < HLS_URL_MAX_AGE:
+            # Restarted captures fetch a new one
+            self.broadcast.hls_url = None
+            return hls_url
+
+        payload = {'broadcast_id': self.broadcast.id, 'cookie': self.broadcast.cookie}
+        access = circuit.request('POST', PRIVATE_ACCESS, json=payload,
+                                 timeout=REQUEST_TIMEOUT).json()
+        if not access.get('hls_url'):
+            raise Exception("Couldn't get live stream download url. Usually means broadcast has"
+                            " been deleted/broadcaster has been banned.")
+        return access['hls_url']
+
     def download_replay(self):
         """Download chunks of broadcast replay and assemble into single .ts"""
-        if self.broadcast.private:
-            replay_info, cookies = self._get_chunk_info_private()
-        else:
-            replay_info, cookies = self._get_chunk_info()
+        with tracing.span(self.broadcast, 'access') as access_span:
+            if self.broadcast.private:
+                replay_info, cookies = self._get_chunk_info_private()
+            else:
+                replay_info, cookies = self._get_chunk_info()
+            access_span['bytes'] = len(replay_info.content)
+
+        if self.broadcast.live_chunks and self.broadcast.clip is None:
+            with tracing.span(self.broadcast, 'reconcile'):
+                if self._reconcile_with_live(replay_info, cookies):
+                    return None
 
-        server_directory = '/'.join(replay_info.url.split('/')[:-1])
-        chunks = [i.strip() for i in replay_info.text.split() if "chunk" in i.lower()]
+        segments = self._segments(replay_info)
+        first = next(segments, None)
 
-        if len(chunks) == 0:
+        if first is None:
             raise Exception("No chunks available for download. May be authentication issue.")
 
-        temp_dir = os.path.join(self.broadcast.download_directory,
-                                ".periapi.{}".format(self.broadcast.filetitle))
+        temp_dir = self.broadcast.temp_directory
 
         if not os.path.exists(temp_dir):
             os.makedirs(temp_dir)
 
-        chunk_pool = ThreadPool(self.broadcast.title, DEFAULT_DL_THREADS, len(chunks))
-
-        for chunk in chunks:
-            path = os.path.join(temp_dir, chunk)
-            url = '/'.join((server_directory, chunk))
-            chunk_pool.add_task(grab_chunk, url, path, self.headers, cookies)
-
         self.broadcast.dl_times.append(time.time())
 
-        chunk_pool.wait_completion()
+        with tracing.span(self.broadcast, 'chunks') as chunks_span:
+            # The first chunk tells us roughly how big the whole replay will be
+            grab_chunk(first.uri, os.path.join(temp_dir, first.filename), self.headers, cookies,
+                       first.byterange)
+            chunk_count = sum(1 for _ in self._segments(replay_info))
+            estimate = os.path.getsize(os.path.join(temp_dir, first.filename)) * chunk_count
+            self.broadcast.estimated_size = estimate
+            progress.set_totals(chunk_count, estimate)
+            needs = [(temp_dir, estimate), (self.broadcast.staging_directory, estimate)]
+            if self.broadcast.staging_directory != self.broadcast.download_directory:
+                needs.append((self.broadcast.download_directory, estimate))
+            check_free_space(needs, self.broadcast.min_free_space)
+
+            # Segments are parsed lazily and the queue is bounded, so memory stays flat no
+            # matter how long the replay is
+            chunk_pool = ThreadPool(self.broadcast.title, DEFAULT_DL_THREADS,
+                                    max_queued=DEFAULT_DL_THREADS * QUEUED_CHUNKS_PER_THREAD,
+                                    hedge=True, retries=CHUNK_RETRIES, retry_if=worth_retrying)
 
-        with open("{}.ts".format(self.broadcast.filepathname), 'wb') as handle:
-            for chunk in chunks:
-                chunk_path = os.path.join(temp_dir, chunk)
-                if not os.path.exists(chunk_path) or os.path.getsize(chunk_path) == 0:
-                    break
-                with open(chunk_path, 'rb') as ts_file:
-                    handle.write(ts_file.read())
+            try:
+                for segment in segments:
+                    path = os.path.join(temp_dir, segment.filename)
+                    chunk_pool.add_task(grab_chunk, segment.uri, path, self.headers, cookies,
+                                        segment.byterange)
+                chunk_pool.close()
+                chunk_pool.wait_completion()
+            except ReplayDeleted as error:
+                # Don't give up on a replay because the CDN went away; try again later
+                raise_if_outage(error, first.uri)
+                raise
+            chunks_span['bytes'] = sum(
+                os.path.getsize(path) for path in (os.path.join(temp_dir, segment.filename)
+                                                   for segment in self._segments(replay_info))
+                if os.path.exists(path))
+
+        self._assemble((os.path.join(temp_dir, segment.filename)
+                        for segment in self._segments(replay_info)), stop_at_missing=True)
 
         if chunk_pool.is_complete() and os.path.exists(temp_dir):
             try:
@@ -223,12 +453,206 @@ class Download:
             except BaseException:
                 pass
 
+    def _reconcile_with_live(self, replay_info, cookies):
+        """Build the replay from the chunks captured live, downloading only the replay
+        segments the live capture missed. Returns False if the two can't be lined up, in which
+        case the whole replay should be downloaded."""
+        live_pieces = []
+        for path in self.broadcast.live_chunks:
+            span = remux.probe_file(path) if os.path.exists(path) else None
+            if span is not None:
+                live_pieces.append((span, path))
+        if not live_pieces:
+            return False
+
+        segments = self._segments(replay_info)
+        first = next(segments, None)
+        if first is None:
+            return False
+        origin = self._segment_origin(first, cookies)
+        if origin is None:
+            return False
+
+        covered = []
+        for (start, end), _ in sorted(live_pieces):
+            if covered and start <= covered[-1][1] + ALIGNMENT_TOLERANCE:
+                covered[-1][1] = max(covered[-1][1], end)
+            else:
+                covered.append([start, end])
+
+        def is_covered(segment):
+            """Whether the live chunks already hold all of segment"""
+            start = origin + int(segment.start * remux.PTS_CLOCK)
+            end = origin + int(segment.end * remux.PTS_CLOCK)
+            return any(span_start - ALIGNMENT_TOLERANCE <= start and
+                       end <= span_end + ALIGNMENT_TOLERANCE for span_start, span_end in covered)
+
+        temp_dir = self.broadcast.temp_directory
+        if not os.path.exists(temp_dir):
+            os.makedirs(temp_dir)
+
+        chunk_pool = ThreadPool(self.broadcast.title, DEFAULT_DL_THREADS,
+                                max_queued=DEFAULT_DL_THREADS * QUEUED_CHUNKS_PER_THREAD,
+                                hedge=True, retries=CHUNK_RETRIES, retry_if=worth_retrying)
+        self.broadcast.dl_times.append(time.time())
+        replay_pieces = []
+        try:
+            for segment in chain([first], segments):
+                if is_covered(segment):
+                    continue
+                path = os.path.join(temp_dir, segment.filename)
+                replay_pieces.append((origin + int(segment.start * remux.PTS_CLOCK), path))
+                chunk_pool.add_task(grab_chunk, segment.uri, path, self.headers, cookies,
+                                    segment.byterange)
+            chunk_pool.close()
+            chunk_pool.wait_completion()
+        except ReplayDeleted as error:
+            raise_if_outage(error, first.uri)
+            raise
+
+        # Overlapping samples are dropped by the remuxer, so pieces only need to be in order
+        staged = self._staged_path()
+        with partial_output(staged + '.mp4') as partial, open(partial, 'wb') as handle:
+            writer = HashingWriter(handle)
+            remuxer = remux.TsRemuxer(writer, keep_timeline=True)
+            pieces = [(span[0], path) for span, path in live_pieces] + replay_pieces
+            for _, path in sorted(pieces):
+                if not os.path.exists(path):
+                    continue
+                with open(path, 'rb') as ts_file:
+                    remuxer.feed(ts_file.read())
+                remuxer.flush()
+            remuxer.close()
+        self.content_hashes = {'.mp4': writer.hexdigest()}
+        self._finalize(staged)
+
+        live_dirs = set(os.path.dirname(path) for path in self.broadcast.live_chunks)
+        for path in [temp_dir] + sorted(live_dirs):
+            shutil.rmtree(path, ignore_errors=True)
+        del self.broadcast.live_chunks[:]
+        return True
+
+    def _segment_origin(self, segment, cookies):
+        """Presentation timestamp at which a replay segment starts, read from its first bytes"""
+        headers = dict(self.headers, Range="bytes=0-{}".format(PROBE_BYTES - 1))
+        if segment.byterange is not None:
+            length, offset = segment.byterange
+            headers['Range'] = "bytes={}-{}".format(offset, offset + min(length, PROBE_BYTES) - 1)
+        data = circuit.request('GET', segment.uri, stream=True, headers=headers, cookies=cookies,
+                               timeout=REQUEST_TIMEOUT)
+        if not data.ok:
+            return None
+        blocks = []
+        for block in data.iter_content(4096):
+            blocks.append(block)
+            if sum(len(i) for i in blocks) >= PROBE_BYTES:
+                break
+        data.close()
+        span = remux.probe_timestamps(blocks)
+        return span[0] if span else None
+
+    def _segments(self, replay_info):
+        """Lazily yield the playlist's segments, limited to the clip window if one is set"""
+        segments = hls.parse_segments(replay_info.text, replay_info.url)
+        if self.broadcast.clip is not None:
+            segments = hls.segments_in_range(segments, *self.broadcast.clip)
+        return segments
+
+    def _assemble(self, chunk_paths, stop_at_missing):
+        """Join downloaded chunks into one .ts, or remux them straight into an .mp4 segment by
+        segment so no separate conversion pass is needed"""
+        present = []
+        for chunk_path in chunk_paths:
+            if not os.path.exists(chunk_path) or os.path.getsize(chunk_path) == 0:
+                if stop_at_missing:
+                    break
+                continue
+            present.append(chunk_path)
+
+        in_process = use_remuxer(self.broadcast.remux_engine)
+        extension = '.mp4' if in_process else '.ts'
+        staged = self._staged_path()
+        with tracing.span(self.broadcast, 'assemble') as assemble_span, \
+                partial_output(staged + extension) as partial, open(partial, 'wb') as handle:
+            if self.broadcast.preallocate and staged == self.broadcast.filepathname:
+                preallocate(handle, sum(os.path.getsize(i) for i in present))
+            writer = HashingWriter(handle)
+            remuxer = TsRemuxer(writer) if in_process else None
+            for chunk_path in present:
+                with open(chunk_path, 'rb') as ts_file:
+                    if remuxer is None:
+                        writer.write(ts_file.read())
+                    else:
+                        remuxer.feed(ts_file.read())
+                        remuxer.flush()
+            if remuxer is not None:
+                remuxer.close()
+            # The remuxed file comes out a little smaller than what was preallocated
+            handle.truncate()
+            assemble_span['bytes'] = handle.tell()
+        self.content_hashes = {extension: writer.hexdigest()}
+        self._finalize(staged)
+
+    def _index_download(self):
+        """Record the finished files in the library index. Hashes are only kept for files that
+        are still exactly what _assemble wrote."""
+        if self.broadcast.clip is not None and \
+                file_kind(self.broadcast.filepathname) != 'clip':
+            # Indexed as the full replay, a clip would let cleanup delete the live recording
+            logging.warning("Not indexing clip of %s saved without a clip file name",
+                            self.broadcast.title)
+            return None
+        try:
+            with LibraryIndex(self.broadcast.library_index) as index:
+                for extension in EXTENSIONS:
+                    path = self.broadcast.filepathname + extension
+                    if os.path.exists(path):
+                        index.add(path, self.broadcast.id, self.content_hashes.get(extension))
+                    else:
+                        index.remove(path)
+        except sqlite3.Error as error:
+            logging.warning("Could not update library index: %s", error)
+
+    def _staged_path(self):
+        """Path (without extension) to assemble the final file at before it is finalized"""
+        return os.path.join(self.broadcast.staging_directory, self.broadcast.filetitle)
+
+    def _finalize(self, staged):
+        """Move a file assembled in the scratch directory into the download directory. A .ts is
+        converted while still in scratch so the conversion doesn't run on the archive volume."""
+        if staged == self.broadcast.filepathname:
+            return None
+        if not os.path.exists(self.broadcast.download_directory):
+            os.makedirs(self.broadcast.download_directory)
+        with tracing.span(self.broadcast, 'convert'):
+            convert_download(staged, self.broadcast.remux_engine)
+        with tracing.span(self.broadcast, 'move') as move_span:
+            move_span['bytes'] = 0
+            for extension in EXTENSIONS:
+                if os.path.exists(staged + extension):
+                    move_span['bytes'] += os.path.getsize(staged + extension)
+                    move_into_place(staged + extension, self.broadcast.filepathname + extension,
+                                    self.broadcast.preallocate)
+
+    def _media_playlist(self, session, response):
+        """If response is a master playlist, fetch the media playlist of the preferred variant
+        only. Otherwise return response as is."""
+        if not hls.is_master(response.text):
+            return response
+        variant = hls.select_variant(hls.parse_variants(response.text, response.url),
+                                     self.broadcast.replay_quality, self.broadcast.max_bandwidth)
+        if variant is None:
+            return response
+        return circuit.request('GET', variant.uri, session=session, timeout=REQUEST_TIMEOUT)
+
     def _get_chunk_info(self):
         """Get the necessary credentials and list of chunks to download a replay"""
         with requests.Session() as _:
             _.headers.update(self.headers)
-            access = _.get(PUBLIC_ACCESS.format(self.broadcast.id)).json()
-            replay_info = _.get(access['replay_url'])
+            access = circuit.request('GET', PUBLIC_ACCESS.format(self.broadcast.id), session=_,
+                                     timeout=REQUEST_TIMEOUT).json()
+            replay_info = self._media_playlist(_, circuit.request(
+                'GET', access['replay_url'], session=_, timeout=REQUEST_TIMEOUT))
             self.headers = _.headers
             cookies = _.cookies
 
@@ -240,8 +664,9 @@ class Download:
 
         with requests.Session() as _:
             _.headers.update(self.headers)
-            playlist = _.get(replay_url)
-            replay_info = _.get(playlist.url)
+            playlist = circuit.request('GET', replay_url, session=_, timeout=REQUEST_TIMEOUT)
+            replay_info = self._media_playlist(_, circuit.request(
+                'GET', playlist.url, session=_, timeout=REQUEST_TIMEOUT))
             self.headers = _.headers
             cookies = _.cookies
 
@@ -5,14 +5,31 @@ Periscope API for the masses
 
 import os
 import sys
+import threading
 import time
 from multiprocessing.pool import Pool
 from multiprocessing import Semaphore
+from periapi import circuit
+from periapi import events
+from periapi import metrics
+from periapi import progress
+from periapi import tracing
 from periapi.download import Download
+from periapi.logging import logging
+from periapi.login import API_BASE
+from periapi.ratelimit import RateLimitedExecutor
+from periapi.diskspace import free_bytes, estimate_broadcast_size, InsufficientDiskSpace, \
+    DEFAULT_MIN_FREE_SPACE
 
 
 CORES_TO_USE = os.cpu_count()
 MAX_DOWNLOAD_ATTEMPTS = 3
+DEFERRED_RETRY_INTERVAL = 60
+# Downloads queued in the pool beyond its size also need a slot to report progress in
+PROGRESS_SLOTS = max(CORES_TO_USE * 4, 16)
+API_HOST = API_BASE
+FAST_START_WORKERS = 4
+ACCESS_RATE = 5.0
 
 
 def current_datetimestring():
@@ -20,48 +37,288 @@ def current_datetimestring():
     return " ".join([time.strftime('%x'), time.strftime('%X')])
 
 
-def initialize_download():
-    """Write output from our download processes to devnull (or logs if you prefer!)"""
+def initialize_download(metrics_queue=None, progress_handle=None, circuit_dir=None):
+    """Write output from our download processes to devnull (or logs if you prefer!), send
+    their metrics to the parent if it serves them, attach the shared progress table and share
+    the parent's circuit breakers"""
     sys.stdout = open(os.devnull, "w")
     sys.stderr = open(os.devnull, "w")
+    if circuit_dir is not None:
+        circuit.share(circuit_dir)
+    if metrics_queue is not None:
+        metrics.attach(metrics_queue)
+    progress.attach(progress_handle)
+
+
+class DownloadHandle:
+    """Outcome of a broadcast's download. Stays pending through resume attempts, replay
+    downloads and deferrals; resolves once the manager is done with the broadcast for good."""
+
+    def __init__(self, broadcast, finished):
+        self.broadcast = broadcast
+        self.ok = None
+        self.failure_reason = None
+        self._finished = finished
+        self._event = threading.Event()
+
+    def done(self):
+        """Whether the download has completed or failed for good"""
+        return self._event.is_set()
+
+    def wait(self, timeout=None):
+        """Block until the download is done or timeout seconds pass. Returns done()."""
+        return self._event.wait(timeout)
+
+    def result(self, timeout=None):
+        """Wait for the download and return (ok, broadcast)"""
+        if not self.wait(timeout):
+            raise TimeoutError("Download of {} is still running.".format(self.broadcast.title))
+        return self.ok, self.broadcast
+
+    def resolve(self, broadcast, download_ok, failure_reason=None):
+        """Record the final outcome and wake anyone waiting on it"""
+        with self._finished:
+            self.broadcast = broadcast
+            self.ok = download_ok
+            self.failure_reason = failure_reason
+            self._event.set()
+            self._finished.notify_all()
 
 
 class DownloadManager:
     """Class to start and track status of download processes."""
 
-    def __init__(self, api):
+    def __init__(self, api, quiet_mode=False):
         self.api = api
 
         self.config = self.api.session.config
+        self.events = events.configure_sinks(events.EventBus(), self.config, quiet_mode)
 
         self.download_progress = dict()
 
         self.download_progress['active'] = dict()
         self.download_progress['completed'] = list()
         self.download_progress['failed'] = list()
-
-        self.pool = Pool(CORES_TO_USE, initializer=initialize_download, maxtasksperchild=1)
+        self.download_progress['deferred'] = dict()
+
+        self.reservations = dict()
+        self.handles = dict()
+        self.finished = threading.Condition()
+        self.last_deferred_retry = time.time()
+
+        metrics_queue = None
+        if self.config.get('metrics_port'):
+            metrics_queue = metrics.serve(self.config['metrics_port'])
+        metrics.set_gauge('periapi_pool_processes', CORES_TO_USE)
+
+        self.progress_table = progress.ProgressTable(PROGRESS_SLOTS)
+        self.progress_slots = dict()
+        metrics.add_collector(self.report_progress)
+
+        # Pool processes only live for one download, so breakers must outlive them to be of use
+        circuit_dir = self.api.session.limiter.state_dir
+        circuit.share(circuit_dir)
+        self.pool = Pool(CORES_TO_USE, initializer=initialize_download,
+                         initargs=(metrics_queue, self.progress_table.handle, circuit_dir),
+                         maxtasksperchild=1)
         self.sema = Semaphore()
+        self.resolver = RateLimitedExecutor(FAST_START_WORKERS, ACCESS_RATE)
 
     def start_dl(self, broadcast):
-        """Adds a download task to the multiprocessing pool"""
-        print("[{0}] Adding Download: {1}".format(current_datetimestring(), broadcast.title))
-
-        self.pool.apply_async(Download(broadcast).start, (), callback=self._callback_dispatcher)
+        """Adds a download task to the multiprocessing pool. Returns the broadcast's
+        DownloadHandle, which is kept across retries and deferrals."""
+        handle = self.handle(broadcast)
+        metrics.REGISTRY.track_download(broadcast.id)
+        self.events.publish(events.QUEUED, broadcast=broadcast)
+        if not self.admit(broadcast):
+            self.report_queues()
+            return handle
+
+        self.events.publish(events.STARTED, "Adding Download: {}".format(broadcast.title),
+                            broadcast, attempt=broadcast.dl_failures + 1)
 
         self.sema.acquire()
+        slot = self.progress_slots[broadcast.id] = self.progress_table.claim(broadcast.id)
         self.active_downloads[broadcast.id] = broadcast
         self.sema.release()
 
+        if self.wants_fast_start(broadcast):
+            # Resolved off the main loop, so a burst of lives doesn't wait on one another
+            self.resolver.submit(self.fast_start, broadcast).add_done_callback(
+                lambda _: self.submit(broadcast, slot))
+        else:
+            self.submit(broadcast, slot)
+        self.report_queues()
+        return handle
+
+    def submit(self, broadcast, slot):
+        """Hand the download to a pool process"""
+        self.pool.apply_async(Download(broadcast).start, (slot,),
+                              callback=self._callback_dispatcher)
+
+    def handle(self, broadcast):
+        """The pending DownloadHandle of broadcast, or a new one if it has none"""
+        with self.finished:
+            handle = self.handles.get(broadcast.id)
+            if handle is None or handle.done():
+                handle = self.handles[broadcast.id] = DownloadHandle(broadcast, self.finished)
+            return handle
+
+    def finish(self, broadcast, download_ok, failure_reason=None):
+        """Resolve the broadcast's handle once nothing more will be done with it"""
+        with self.finished:
+            handle = self.handles.pop(broadcast.id, None)
+        if handle is not None:
+            handle.resolve(broadcast, download_ok, failure_reason)
+        if not download_ok:
+            metrics.inc('periapi_download_failures_total', reason=metrics.reason(failure_reason))
+        metrics.REGISTRY.forget_download(broadcast.id)
+
+    def report_queues(self):
+        """Update the pool utilization and queue depth gauges"""
+        self.sema.acquire()
+        active = len(self.active_downloads)
+        deferred = len(self.deferred_downloads)
+        self.sema.release()
+        metrics.set_gauge('periapi_pool_busy', active)
+        metrics.set_gauge('periapi_queue_depth', deferred, queue='deferred')
+
+    def report_progress(self):
+        """Set the speed, progress and ETA gauges of running downloads from the progress
+        table (called when metrics are scraped)"""
+        now = time.time()
+        for broadcast_id, snapshot in self.progress.items():
+            metrics.set_gauge('periapi_download_bytes_per_second',
+                              progress.current_rate(snapshot, now), broadcast=broadcast_id)
+            if snapshot['updated']:
+                metrics.set_gauge('periapi_download_idle_seconds', now - snapshot['updated'],
+                                  broadcast=broadcast_id)
+            if snapshot['bytes_total']:
+                metrics.set_gauge('periapi_download_progress_ratio', min(
+                    1.0, snapshot['bytes'] / snapshot['bytes_total']), broadcast=broadcast_id)
+            eta = progress.eta_seconds(snapshot, now)
+            if eta is not None:
+                metrics.set_gauge('periapi_download_eta_seconds', eta, broadcast=broadcast_id)
+
+    def shutdown(self):
+        """Wait for the running downloads to finish and stop the pool"""
+        self.resolver.shutdown()
+        self.pool.close()
+        self.pool.join()
+        metrics.remove_collector(self.report_progress)
+        self.sema.acquire()
+        self.progress_table.close()
+        self.sema.release()
+
+    def is_tracking(self, broadcast_id):
+        """Whether a download of the broadcast is running, deferred or otherwise unfinished"""
+        with self.finished:
+            return broadcast_id in self.handles
+
+    def count_user_downloads(self, username):
+        """Number of unfinished downloads of username's broadcasts"""
+        with self.finished:
+            return sum(1 for handle in self.handles.values()
+                       if handle.broadcast.username == username)
+
+    def as_completed(self, handles, timeout=None):
+        """Yield handles as their downloads finish, completed ones first. Stops early, leaving
+        the rest pending, if timeout seconds pass before all are done."""
+        pending = list(handles)
+        deadline = None if timeout is None else time.time() + timeout
+        while pending:
+            with self.finished:
+                done = [handle for handle in pending if handle.done()]
+                if not done:
+                    remaining = None if deadline is None else deadline - time.time()
+                    if remaining is not None and remaining <= 0:
+                        return None
+                    self.finished.wait(remaining)
+                    continue
+            for handle in done:
+                pending.remove(handle)
+                yield handle
+
+    @staticmethod
+    def wants_fast_start(broadcast):
+        """Whether the broadcast is a live the pool process could start capturing right away"""
+        return broadcast.islive and not (broadcast.private or broadcast.wait_for_replay or
+                                         broadcast.dl_failures)
+
+    def fast_start(self, broadcast):
+        """Resolve the stream url of a live broadcast before handing it to a pool process, so
+        the process can start FFMPEG without another round trip to the API"""
+        try:
+            broadcast.hls_url = self.api.get_access(broadcast.id).get('hls_url')
+        except (IOError, ValueError) as error:
+            logging.debug("Could not resolve stream url of %s early: %r", broadcast.title, error)
+
+    def admit(self, broadcast):
+        """Reserve room for the download on its target filesystem, counting what active
+        downloads have reserved. Defers the download if there isn't enough."""
+        estimate = estimate_broadcast_size(broadcast, self.config.get('live_bitrate'),
+                                           self.config.get('expected_live_duration'))
+        min_free = self.config.get('min_free_space', DEFAULT_MIN_FREE_SPACE)
+
+        self.sema.acquire()
+        reserved = sum(size for bc_id, size in self.reservations.items() if bc_id != broadcast.id)
+        admitted = free_bytes(broadcast.download_directory) - reserved - estimate >= min_free
+        if admitted:
+            self.reservations[broadcast.id] = estimate
+            self.deferred_downloads.pop(broadcast.id, None)
+        else:
+            self.deferred_downloads[broadcast.id] = broadcast
+        self.sema.release()
+
+        if not admitted:
+            self.events.publish(events.DEFERRED, "Deferring download, not enough disk space: "
+                                "{}".format(broadcast.title), broadcast,
+                                reason='InsufficientDiskSpace')
+            metrics.inc('periapi_downloads_deferred_total', reason='InsufficientDiskSpace')
+        return admitted
+
+    def retry_deferred(self):
+        """Try again to start downloads that were deferred for lack of disk space or because
+        Periscope was unreachable"""
+        if time.time() - self.last_deferred_retry < DEFERRED_RETRY_INTERVAL:
+            return None
+        if circuit.breaker(API_HOST).is_open:
+            return None
+        self.last_deferred_retry = time.time()
+
+        self.sema.acquire()
+        deferred = list(self.deferred_downloads.values())
+        self.sema.release()
+
+        for broadcast in deferred:
+            self.start_dl(broadcast)
+
+    def defer(self, broadcast, reason):
+        """Park a download until retry_deferred starts it again"""
+        self.events.publish(events.DEFERRED, "Deferring download: {0}\n\t{1}".format(
+            broadcast.title, reason), broadcast, reason=metrics.reason(reason))
+        self.sema.acquire()
+        self.deferred_downloads[broadcast.id] = broadcast
+        self.sema.release()
+        metrics.inc('periapi_downloads_deferred_total', reason=metrics.reason(reason))
+        self.report_queues()
+
     def review_broadcast_status(self, broadcast, download_ok):
         """Starts download of broadcast replay if not already gotten; or, resumes interrupted
          live download. Print status to console.
          """
         old_title = broadcast.title
         broadcast.lock_name = False
-        broadcast.update_info()
+        try:
+            broadcast.update_info()
+        except IOError as error:
+            if not circuit.is_outage(error):
+                raise
+            self.defer(broadcast, error)
+            return None
 
         if broadcast.isreplay and broadcast.replay_downloaded:
+            self.finish(broadcast, True)
             return None
 
         elif download_ok and broadcast.islive:
@@ -72,8 +329,12 @@ class DownloadManager:
             if broadcast.islive and broadcast.available:
                 broadcast.wait_for_replay = True
                 broadcast.dl_failures = 0
-                print("[{0}] Too many live resume attempts, waiting for replay: {1} {2}".format(
-                    current_datetimestring(), old_title, failure_message))
+                last_error = "" if broadcast.failure_reason is None else \
+                    "\n\tLast error:\n\t{}".format(broadcast.failure_reason)
+                self.events.publish(events.RETRIED, "Too many live resume attempts, waiting "
+                                    "for replay: {0}{1}".format(old_title, last_error),
+                                    broadcast, wait_for_replay=True,
+                                    reason=metrics.reason(broadcast.failure_reason))
             else:
                 failure_message = "\n\tExceeded maximum download attempts "
                 if broadcast.failure_reason is not None:
@@ -84,23 +345,28 @@ class DownloadManager:
             failure_message = "\n\tBroadcast no longer available."
 
         elif broadcast.dl_failures > 0:
-            print("[{0}] Resuming download (Attempt {1} of {2}): {3}".format(
-                current_datetimestring(), broadcast.dl_failures, MAX_DOWNLOAD_ATTEMPTS,
-                broadcast.title))
+            self.events.publish(events.RETRIED, "Resuming download (Attempt {0} of {1}): "
+                                "{2}".format(broadcast.dl_failures, MAX_DOWNLOAD_ATTEMPTS,
+                                             broadcast.title), broadcast,
+                                attempt=broadcast.dl_failures,
+                                reason=metrics.reason(broadcast.failure_reason))
 
         elif broadcast.isreplay and not broadcast.replay_downloaded:
-            print("[{0}] Downloading replay of: "
-                  "{1}".format(current_datetimestring(), broadcast.title))
+            self.events.publish(events.PROGRESS, "Downloading replay of: {}".format(
+                broadcast.title), broadcast, phase='replay')
 
         else:
+            self.finish(broadcast, download_ok, None if download_ok else broadcast.failure_reason)
             return None
 
         if failure_message is not None:
-            print("[{0}] Failed: {1} {2}".format(current_datetimestring(),
-                                                 old_title, failure_message))
+            self.events.publish(events.FAILED, "Failed: {0} {1}".format(
+                old_title, failure_message), broadcast,
+                reason=metrics.reason(broadcast.failure_reason))
             self.sema.acquire()
             self.failed_downloads.append((current_datetimestring(), broadcast))
             self.sema.release()
+            self.finish(broadcast, False, broadcast.failure_reason or failure_message.strip())
         else:
             self.start_dl(broadcast)
 
@@ -109,18 +375,51 @@ class DownloadManager:
         download_ok, broadcast = results
         self.sema.acquire()
         del self.active_downloads[broadcast.id]
+        self.reservations.pop(broadcast.id, None)
+        self.progress_table.release(self.progress_slots.pop(broadcast.id, None))
         self.sema.release()
+        self.report_queues()
+        tracing.save_trace(tracing.trace_path(self.config), broadcast, download_ok)
+        self.report_capture(broadcast)
+
+        # Neither running out of space nor an outage counts against the download's attempts
+        if not download_ok and (isinstance(broadcast.failure_reason, InsufficientDiskSpace) or
+                                circuit.is_outage(broadcast.failure_reason)):
+            self.defer(broadcast, broadcast.failure_reason)
+            return None
 
         if download_ok:
-            print("[{0}] Completed: {1}".format(current_datetimestring(), broadcast.title))
+            self.events.publish(events.COMPLETED, "Completed: {}".format(broadcast.title),
+                                broadcast)
             self.sema.acquire()
             self.completed_downloads.append((current_datetimestring(), broadcast))
             self.sema.release()
+            metrics.inc('periapi_downloads_completed_total')
         else:
             broadcast.dl_failures += 1
+            metrics.inc('periapi_failed_attempts_total',
+                        reason=metrics.reason(broadcast.failure_reason))
 
         self.review_broadcast_status(broadcast, download_ok)
 
+    def report_capture(self, broadcast):
+        """Publish what the pool process measured of a live capture, which it can't report
+        itself: how long after the notification the first bytes arrived (once per broadcast)
+        and the stalled FFMPEG runs killed since the last report"""
+        if broadcast.first_byte_latency is not None and not broadcast.first_byte_reported:
+            broadcast.first_byte_reported = True
+            metrics.observe('periapi_first_byte_seconds', broadcast.first_byte_latency)
+            self.events.publish(events.NOTICE, None, broadcast,
+                                first_byte_latency=broadcast.first_byte_latency)
+
+        stalls = len(broadcast.stall_events) - broadcast.stalls_reported
+        if stalls > 0:
+            broadcast.stalls_reported = len(broadcast.stall_events)
+            metrics.inc('periapi_live_stalls_total', stalls)
+            self.events.publish(events.NOTICE, "Restarted stalled live capture {0} time(s): "
+                                "{1}".format(stalls, broadcast.title), broadcast,
+                                stalls=stalls, total_stalls=len(broadcast.stall_events))
+
     @property
     def status(self):
         """Retrieve status string for printing to console"""
@@ -128,18 +427,37 @@ class DownloadManager:
         active = len(self.active_downloads)
         complete = len(self.completed_downloads)
         failed = len(self.failed_downloads)
+        deferred = len(self.deferred_downloads)
         self.sema.release()
 
         cur_status = "{0} active downloads, {1} completed downloads, " \
                      "{2} failed downloads".format(active, complete, failed)
+        if deferred:
+            cur_status += ", {0} deferred".format(deferred)
 
         return "[{0}] {1}".format(current_datetimestring(), cur_status)
 
+    @property
+    def progress(self):
+        """Dictionary of broadcast id: latest progress snapshot of each active download, read
+        straight from the shared progress table"""
+        self.sema.acquire()
+        slots = [(bc_id, self.progress_slots.get(bc_id)) for bc_id in self.active_downloads]
+        snapshots = dict((bc_id, self.progress_table.read(slot)) for bc_id, slot in slots
+                         if slot is not None)
+        self.sema.release()
+        return dict((bc_id, snapshot) for bc_id, snapshot in snapshots.items()
+                    if snapshot is not None and snapshot['broadcast_id'] == bc_id[:16])
+
     @property
     def currently_downloading(self):
-        """Returns list of the broadcast.title property of all active broadcast downloads"""
+        """Returns list of the broadcast.title property of all active broadcast downloads, with
+        their progress where it is known"""
+        snapshots = self.progress
         self.sema.acquire()
-        _ = [broadcast.title for _, broadcast in self.active_downloads.items()]
+        _ = ["{0} ({1})".format(broadcast.title, progress.describe(snapshots[bc_id]))
+             if bc_id in snapshots else broadcast.title
+             for bc_id, broadcast in self.active_downloads.items()]
         self.sema.release()
         return _
 
@@ -153,6 +471,11 @@ class DownloadManager:
         """Return list of completed downloads"""
         return self.download_progress['completed']
 
+    @property
+    def deferred_downloads(self):
+        """Return dictionary of downloads waiting for disk space or for Periscope to come back"""
+        return self.download_progress['deferred']
+
     @property
     def failed_downloads(self):
         """Return list of failed downloads"""
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+"""
+Periscope API for the masses
+
+Event bus for download and autocap progress, with console, JSON lines and Unix socket sinks
+"""
+
+import json
+import os
+import select
+import socket
+import threading
+import time
+
+from abc import ABC, abstractmethod
+from collections import namedtuple
+from queue import Queue, Full
+
+from periapi.logging import logging
+
+QUEUED = 'queued'
+STARTED = 'started'
+PROGRESS = 'progress'
+COMPLETED = 'completed'
+FAILED = 'failed'
+RETRIED = 'retried'
+DEFERRED = 'deferred'
+STATUS = 'status'
+NOTICE = 'notice'
+EVENT_KINDS = (QUEUED, STARTED, PROGRESS, COMPLETED, FAILED, RETRIED, DEFERRED, STATUS, NOTICE)
+
+SINK_BUFFER = 1000
+CLIENT_BUFFER_BYTES = 1 << 20
+FLUSH_TIMEOUT = 5
+
+Event = namedtuple('Event', 'kind time broadcast_id title message data')
+
+
+def event_timestring(when):
+    """Date and time of an event, as printed to the console"""
+    local = time.localtime(when)
+    return " ".join([time.strftime('%x', local), time.strftime('%X', local)])
+
+
+def event_json(event):
+    """One line of JSON describing an event"""
+    return json.dumps(event._asdict(), sort_keys=True, default=str)
+
+
+class Sink(ABC):
+    """Consumes events on a thread of its own from a bounded buffer. When the buffer is full
+    new events are dropped (and counted) rather than making the publisher wait."""
+
+    def __init__(self, kinds=None, buffer_size=SINK_BUFFER):
+        self.kinds = set(kinds) if kinds is not None else None
+        self.buffer = Queue(buffer_size)
+        self.dropped = 0
+        self.thread = threading.Thread(target=self._drain, daemon=True)
+        self.thread.start()
+
+    def offer(self, event):
+        """Queue an event for handling without blocking"""
+        if self.kinds is not None and event.kind not in self.kinds:
+            return None
+        try:
+            self.buffer.put_nowait(event)
+        except Full:
+            self.dropped += 1
+
+    def flush(self, timeout=FLUSH_TIMEOUT):
+        """Wait up to timeout seconds for the events queued so far to be handled"""
+        done = threading.Event()
+        try:
+            self.buffer.put(done, timeout=timeout)
+        except Full:
+            return False
+        return done.wait(timeout)
+
+    def close(self, timeout=FLUSH_TIMEOUT):
+        """Handle what is queued and stop"""
+        try:
+            self.buffer.put(None, timeout=timeout)
+        except Full:
+            return None
+        self.thread.join(timeout)
+
+    def _drain(self):
+        """Hand queued events to handle() until closed"""
+        while True:
+            event = self.buffer.get()
+            if event is None:
+                self.stop()
+                return None
+            if isinstance(event, threading.Event):
+                event.set()
+                continue
+            try:
+                self.handle(event)
+            except Exception as error:
+                logging.debug("%s could not handle %s event: %r", type(self).__name__,
+                              event.kind, error)
+
+    @abstractmethod
+    def handle(self, event):
+        """Deliver one event"""
+
+    def stop(self):
+        """Release whatever the sink holds on to"""
+        pass
+
+
+class ConsoleSink(Sink):
+    """Prints events that have a message, prefixed with their time"""
+
+    def handle(self, event):
+        if event.message is None:
+            return None
+        if event.kind == STATUS:
+            print(event.message)
+        else:
+            print("[{0}] {1}".format(event_timestring(event.time), event.message))
+
+
+class JsonLinesSink(Sink):
+    """Appends every event to a file as a line of JSON"""
+
+    def __init__(self, path, kinds=None, buffer_size=SINK_BUFFER):
+        self.file = open(path, 'a')
+        super().__init__(kinds, buffer_size)
+
+    def handle(self, event):
+        self.file.write(event_json(event) + '\n')
+        self.file.flush()
+
+    def stop(self):
+        self.file.close()
+
+
+class UnixSocketSink(Sink):
+    """Serves events as JSON lines to every client connected to a Unix socket. Sends never
+    block; a client that falls more than CLIENT_BUFFER_BYTES behind is disconnected."""
+
+    def __init__(self, path, kinds=None, buffer_size=SINK_BUFFER):
+        if os.path.exists(path):
+            os.remove(path)
+        self.path = path
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(path)
+        self.server.listen(8)
+        self.server.setblocking(False)
+        self.clients = dict()
+        super().__init__(kinds, buffer_size)
+
+    def _accept(self):
+        """Take on clients that connected since the last event"""
+        while select.select([self.server], [], [], 0)[0]:
+            try:
+                client, _ = self.server.accept()
+            except OSError:
+                return None
+            client.setblocking(False)
+            self.clients[client] = bytearray()
+
+    def _disconnect(self, client):
+        """Drop a client"""
+        del self.clients[client]
+        client.close()
+
+    def handle(self, event):
+        self._accept()
+        line = (event_json(event) + '\n').encode('utf-8')
+        for client, pending in list(self.clients.items()):
+            pending.extend(line)
+            try:
+                del pending[:client.send(pending)]
+            except BlockingIOError:
+                pass
+            except OSError:
+                self._disconnect(client)
+                continue
+            if len(pending) > CLIENT_BUFFER_BYTES:
+                logging.info("Disconnecting event socket client that fell behind")
+                self._disconnect(client)
+
+    def stop(self):
+        for client in list(self.clients):
+            client.close()
+        self.server.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class EventBus:
+    """Hands published events to every subscribed sink"""
+
+    def __init__(self):
+        self.sinks = list()
+        self.lock = threading.Lock()
+
+    def subscribe(self, sink):
+        """Start delivering events to sink"""
+        with self.lock:
+            self.sinks.append(sink)
+        return sink
+
+    def unsubscribe(self, sink):
+        """Stop delivering events to sink and close it"""
+        with self.lock:
+            self.sinks.remove(sink)
+        sink.close()
+
+    def publish(self, kind, message=None, broadcast=None, **data):
+        """Send an event to every sink. message is the human readable text (None for events
+        the console needn't show); data holds extra fields."""
+        event = Event(kind, time.time(), broadcast.id if broadcast is not None else None,
+                      broadcast.title if broadcast is not None else None, message, data)
+        with self.lock:
+            sinks = list(self.sinks)
+        for sink in sinks:
+            sink.offer(event)
+        return event
+
+    def flush(self, timeout=FLUSH_TIMEOUT):
+        """Wait for the sinks to handle everything published so far"""
+        with self.lock:
+            sinks = list(self.sinks)
+        for sink in sinks:
+            sink.flush(timeout)
+
+    def close(self):
+        """Close every sink"""
+        with self.lock:
+            sinks, self.sinks = self.sinks, list()
+        for sink in sinks:
+            sink.close()
+
+    @property
+    def dropped(self):
+        """Number of events sinks had to drop because they fell behind"""
+        with self.lock:
+            return sum(sink.dropped for sink in self.sinks)
+
+
+def configure_sinks(bus, config, quiet_mode=False):
+    """Subscribe the console sink (without status and notices in quiet mode) and the sinks set
+    up in the config: 'event_log' (JSON lines file) and 'event_socket' (Unix socket path)"""
+    bus.subscribe(ConsoleSink(
+        [i for i in EVENT_KINDS if i not in (STATUS, NOTICE)] if quiet_mode else None))
+    if config.get('event_log'):
+        bus.subscribe(JsonLinesSink(config['event_log']))
+    if config.get('event_socket'):
+        if hasattr(socket, 'AF_UNIX'):
+            bus.subscribe(UnixSocketSink(config['event_socket']))
+        else:
+            logging.warning("Unix sockets aren't available here; event_socket is ignored")
+    return bus
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""
+Periscope API for the masses
+
+HLS (M3U8) playlist parsing
+"""
+
+import os
+import re
+
+from collections import namedtuple
+from urllib.parse import urljoin, urlparse
+
+from periapi.logging import logging
+
+ATTRIBUTE_PATTERN = re.compile(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)')
+
+Variant = namedtuple('Variant', ['uri', 'bandwidth', 'width', 'height'])
+
+
+class Segment(namedtuple('Segment', ['uri', 'sequence', 'duration', 'start', 'byterange',
+                                     'discontinuity'])):
+    """One media segment of a playlist. start is the cumulative #EXTINF offset in seconds and
+    byterange is (length, offset) or None."""
+
+    __slots__ = ()
+
+    @property
+    def filename(self):
+        """Name to store the segment under locally; unique within one playlist"""
+        name = os.path.basename(urlparse(self.uri).path) or "chunk{}".format(self.sequence)
+        if self.byterange is not None:
+            name = "{}.{}".format(name, self.byterange[1])
+        return name
+
+    @property
+    def end(self):
+        """Offset in seconds at which the segment ends"""
+        return self.start + self.duration
+
+
+def iter_lines(text):
+    """Lazily yield the stripped, non-empty lines of a playlist"""
+    pos = 0
+    length = len(text)
+    while pos < length:
+        end = text.find('\n', pos)
+        if end == -1:
+            end = length
+        line = text[pos:end].strip()
+        pos = end + 1
+        if line:
+            yield line
+
+
+def parse_attributes(value):
+    """Parse an attribute list like BANDWIDTH=1,RESOLUTION=2x3 into a dict"""
+    return {key: val.strip('"') for key, val in ATTRIBUTE_PATTERN.findall(value)}
+
+
+def is_master(text):
+    """Whether the playlist is a master playlist listing variants"""
+    return '#EXT-X-STREAM-INF' in text
+
+
+def parse_variants(text, base_url=''):
+    """List the variant streams of a master playlist"""
+    variants = []
+    attributes = None
+    for line in iter_lines(text):
+        if line.startswith('#EXT-X-STREAM-INF:'):
+            attributes = parse_attributes(line.split(':', 1)[1])
+        elif attributes is not None and not line.startswith('#'):
+            width, _, height = attributes.get('RESOLUTION', '0x0').partition('x')
+            try:
+                bandwidth = int(attributes.get('BANDWIDTH', 0))
+                width, height = int(width), int(height or 0)
+            except ValueError:
+                bandwidth, width, height = 0, 0, 0
+            variants.append(Variant(urljoin(base_url, line), bandwidth, width, height))
+            attributes = None
+    return variants
+
+
+def parse_quality(quality):
+    """Normalize a replay_quality setting to 'best', 'worst' or a picture height. Heights may
+    be written as 720 or "720p"; anything else is warned about and treated as 'best'."""
+    if quality is None:
+        return 'best'
+    if isinstance(quality, int) and not isinstance(quality, bool) and quality > 0:
+        return quality
+    text = str(quality).strip().lower()
+    if text in ('best', 'worst'):
+        return text
+    if text.endswith('p'):
+        text = text[:-1]
+    if text.isdigit() and int(text) > 0:
+        return int(text)
+    logging.warning("Unknown replay_quality %r, downloading the best quality instead", quality)
+    return 'best'
+
+
+def select_variant(variants, quality=None, max_bandwidth=None):
+    """Pick a variant. quality is 'best' (default), 'worst' or a preferred picture height (see
+    parse_quality); variants above max_bandwidth (bits/s) are skipped unless nothing else is
+    left."""
+    if not variants:
+        return None
+    quality = parse_quality(quality)
+    candidates = [i for i in variants if not max_bandwidth or i.bandwidth <= max_bandwidth]
+    if not candidates:
+        candidates = [min(variants, key=lambda i: i.bandwidth)]
+
+    if quality == 'worst':
+        return min(candidates, key=lambda i: i.bandwidth)
+    if quality != 'best':
+        fitting = [i for i in candidates if i.height <= quality]
+        if fitting:
+            return max(fitting, key=lambda i: (i.height, i.bandwidth))
+        return min(candidates, key=lambda i: (i.height, i.bandwidth))
+    return max(candidates, key=lambda i: i.bandwidth)
+
+
+def parse_segments(text, base_url=''):
+    """Lazily yield the Segments of a media playlist"""
+    sequence = 0
+    start = 0.0
+    duration = None
+    byterange = None
+    discontinuity = False
+    range_ends = dict()
+
+    for line in iter_lines(text):
+        if line.startswith('#'):
+            tag, _, value = line.partition(':')
+            if tag == '#EXTINF':
+                try:
+                    duration = float(value.split(',', 1)[0])
+                except ValueError:
+                    duration = 0.0
+            elif tag == '#EXT-X-MEDIA-SEQUENCE':
+                sequence = int(value)
+            elif tag == '#EXT-X-BYTERANGE':
+                length, _, offset = value.partition('@')
+                byterange = (int(length), int(offset) if offset else None)
+            elif tag == '#EXT-X-DISCONTINUITY':
+                discontinuity = True
+            continue
+
+        uri = urljoin(base_url, line)
+        if byterange is not None:
+            length, offset = byterange
+            if offset is None:
+                offset = range_ends.get(uri, 0)
+            byterange = (length, offset)
+            range_ends[uri] = offset + length
+        duration = duration or 0.0
+        yield Segment(uri, sequence, duration, start, byterange, discontinuity)
+
+        start += duration
+        sequence += 1
+        duration = None
+        byterange = None
+        discontinuity = False
+
+
+def segments_in_range(segments, start=None, end=None):
+    """Lazily yield only the segments covering the start to end offsets (in seconds, either may
+    be None for an open end), going by cumulative #EXTINF durations"""
+    for segment in segments:
+        if end is not None and segment.start >= end:
+            return
+        if start is None or segment.end > start:
+            yield segment
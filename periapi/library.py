@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+"""
+Periscope API for the masses
+
+Persistent index of downloaded broadcast files
+"""
+
+import hashlib
+import os
+import re
+import sqlite3
+
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+BROADCAST_ID_PATTERN = re.compile(r'1[a-zA-Z]{12}')
+INDEX_FILENAME = '.periapi-library.db'
+MEDIA_EXTENSIONS = ('.mp4', '.ts')
+SCAN_WORKERS = 8
+SCHEMA_VERSION = 3
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS files (
+        path TEXT PRIMARY KEY,
+        directory TEXT NOT NULL,
+        broadcast_id TEXT NOT NULL,
+        kind TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        mtime REAL NOT NULL,
+        sha1 TEXT)""",
+    "CREATE INDEX IF NOT EXISTS files_by_broadcast ON files (broadcast_id, kind)",
+    "CREATE INDEX IF NOT EXISTS files_by_directory ON files (directory)",
+    """CREATE TABLE IF NOT EXISTS dirs (
+        path TEXT PRIMARY KEY,
+        mtime_ns INTEGER NOT NULL)""",
+]
+
+
+def index_path(config):
+    """Location of the library index: the library_index config key, or next to the config
+    file so it survives changes of download directory"""
+    if config.get('library_index'):
+        return config.get('library_index')
+    return os.path.join(os.path.dirname(os.path.abspath(config.file)), INDEX_FILENAME)
+
+
+def file_kind(filename):
+    """'live', 'clip', 'replay' or 'unconverted', going by the file name periapi gave the
+    download. Only a converted mp4 counts as a replay: a .ts may be cut short, and cleanup
+    deletes live recordings on the strength of their replays."""
+    if '.live' in filename:
+        return 'live'
+    if '.clip-' in filename:
+        return 'clip'
+    if not filename.endswith('.mp4'):
+        return 'unconverted'
+    return 'replay'
+
+
+def is_media_file(filename):
+    """Whether filename looks like a finished broadcast download"""
+    return filename.endswith(MEDIA_EXTENSIONS) and '.old-' not in filename and \
+        BROADCAST_ID_PATTERN.search(filename) is not None
+
+
+class HashingWriter:
+    """Wraps a writable file, computing the SHA-1 of everything written through it"""
+
+    def __init__(self, handle):
+        self.handle = handle
+        self.hash = hashlib.sha1()
+
+    def write(self, data):
+        """Write data and add it to the hash"""
+        self.hash.update(data)
+        return self.handle.write(data)
+
+    def hexdigest(self):
+        """Hash of everything written so far"""
+        return self.hash.hexdigest()
+
+    def __getattr__(self, name):
+        return getattr(self.handle, name)
+
+
+def _scan_directory(path, cached_mtime=None):
+    """List one directory. Returns (path, mtime_ns, subdirectories, media files) where files
+    are (path, name, size, mtime); subdirectories and files are None if the directory's mtime
+    still equals cached_mtime, and mtime_ns is None if it can't be read."""
+    try:
+        mtime = os.stat(path).st_mtime_ns
+        if mtime == cached_mtime:
+            return path, mtime, None, None
+        subdirs = []
+        files = []
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if not entry.name.startswith('.periapi'):
+                        subdirs.append(entry.path)
+                elif is_media_file(entry.name):
+                    stat = entry.stat()
+                    files.append((entry.path, entry.name, stat.st_size, stat.st_mtime))
+    except OSError:
+        return path, None, None, None
+    return path, mtime, subdirs, files
+
+
+class LibraryIndex:
+    """SQLite index of broadcast id -> downloaded files. Safe to use from several processes;
+    each process should open its own LibraryIndex."""
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=30)
+        with self.conn:
+            self.conn.execute("BEGIN EXCLUSIVE")
+            if self.conn.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+                # The index only mirrors what is on disk, so an old layout is just rebuilt
+                for table in ('files', 'dirs', 'roots'):
+                    self.conn.execute("DROP TABLE IF EXISTS {}".format(table))
+                self.conn.execute("PRAGMA user_version = {}".format(SCHEMA_VERSION))
+            for statement in SCHEMA:
+                self.conn.execute(statement)
+
+    def close(self):
+        """Close the database connection"""
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add(self, path, broadcast_id=None, sha1=None):
+        """Add or update the entry for a file"""
+        path = os.path.abspath(path)
+        filename = os.path.basename(path)
+        if broadcast_id is None:
+            match = BROADCAST_ID_PATTERN.search(filename)
+            if not match:
+                return None
+            broadcast_id = match.group(0)
+        stat = os.stat(path)
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)",
+                              (path, os.path.dirname(path), broadcast_id, file_kind(filename),
+                               stat.st_size, stat.st_mtime, sha1))
+
+    def remove(self, path):
+        """Drop the entry for a file"""
+        with self.conn:
+            self.conn.execute("DELETE FROM files WHERE path = ?", (os.path.abspath(path),))
+
+    def files(self, broadcast_id, kind=None):
+        """List (path, kind, size, sha1) of the indexed files of a broadcast"""
+        query = "SELECT path, kind, size, sha1 FROM files WHERE broadcast_id = ?"
+        params = [broadcast_id]
+        if kind is not None:
+            query += " AND kind = ?"
+            params.append(kind)
+        return self.conn.execute(query, params).fetchall()
+
+    def files_of_kind(self, kind, root=None):
+        """List (path, broadcast_id, size) of every indexed file of a kind, optionally only
+        those below root"""
+        query = "SELECT path, broadcast_id, size FROM files WHERE kind = ?"
+        params = [kind]
+        if root is not None:
+            query += " AND path LIKE ? ESCAPE '\\'"
+            params.append(_like_prefix(os.path.abspath(root)))
+        return self.conn.execute(query, params).fetchall()
+
+    def broadcast_ids(self, kind):
+        """Set of the ids of broadcasts with at least one indexed file of a kind"""
+        return set(i for (i,) in self.conn.execute(
+            "SELECT DISTINCT broadcast_id FROM files WHERE kind = ?", (kind,)))
+
+    def has(self, broadcast_id, kind='replay'):
+        """Whether a file of the given kind exists for a broadcast. Entries for files that
+        have since disappeared are dropped."""
+        for path, _, _, _ in self.files(broadcast_id, kind):
+            if os.path.exists(path):
+                return True
+            self.remove(path)
+        return False
+
+    def rebuild(self, root, workers=SCAN_WORKERS, full=False):
+        """Bring root's part of the index up to date with a parallel os.scandir crawl.
+        Directories whose mtime hasn't changed since the last crawl aren't listed again unless
+        full is set. Returns the number of directories that were (re)listed."""
+        root = os.path.abspath(root)
+        cached = dict()
+        children = defaultdict(list)
+        for path, mtime in self.conn.execute(
+                "SELECT path, mtime_ns FROM dirs WHERE path = ? OR path LIKE ? ESCAPE '\\'",
+                (root, _like_prefix(root))):
+            cached[path] = None if full else mtime
+            children[os.path.dirname(path)].append(path)
+
+        visited = set()
+        listed = 0
+        with ThreadPoolExecutor(max_workers=workers) as executor, self.conn:
+            pending = {executor.submit(_scan_directory, root, cached.get(root))}
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    path, mtime, subdirs, files = future.result()
+                    if mtime is None:
+                        continue
+                    visited.add(path)
+                    if files is None:
+                        subdirs = children[path]
+                    else:
+                        listed += 1
+                        self._replace_directory(path, files)
+                        self.conn.execute("INSERT OR REPLACE INTO dirs VALUES (?, ?)",
+                                          (path, mtime))
+                    for subdir in subdirs:
+                        pending.add(executor.submit(_scan_directory, subdir,
+                                                    cached.get(subdir)))
+
+            gone = [(path,) for path in cached if path not in visited]
+            self.conn.executemany("DELETE FROM dirs WHERE path = ?", gone)
+            self.conn.executemany("DELETE FROM files WHERE directory = ?", gone)
+        return listed
+
+    def _replace_directory(self, directory, files):
+        """Make the index entries of one directory match a fresh listing of it. Hashes are
+        kept for files whose size and mtime haven't changed."""
+        present = set(path for path, _, _, _ in files)
+        self.conn.executemany("DELETE FROM files WHERE path = ?", [
+            (path,) for (path,) in self.conn.execute(
+                "SELECT path FROM files WHERE directory = ?", (directory,))
+            if path not in present])
+        self.conn.executemany(
+            "INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, NULL) ON CONFLICT(path) "
+            "DO UPDATE SET size = excluded.size, mtime = excluded.mtime, "
+            "sha1 = CASE WHEN files.size = excluded.size AND "
+            "files.mtime = excluded.mtime THEN files.sha1 END",
+            [(path, directory, BROADCAST_ID_PATTERN.search(name).group(0), file_kind(name),
+              size, mtime) for path, name, size, mtime in files])
+
+
+def _like_prefix(directory):
+    """LIKE pattern matching every path below directory"""
+    escaped = directory.rstrip(os.sep).replace('\\', '\\\\').replace('%', '\\%') \
+        .replace('_', '\\_')
+    return escaped + os.sep.replace('\\', '\\\\') + '%'
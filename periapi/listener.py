@@ -3,22 +3,33 @@
 Periscope API for the masses
 """
 
+import time
+
+from collections import Counter
+
 from periapi.broadcast import Broadcast
+from periapi.library import index_path
+from periapi.rules import CaptureRules, LIMIT_RULES
 
 
 class Listener:
     """Class to check notifications stream for new broadcasts and return new broadcast ids"""
 
-    def __init__(self, api, check_backlog=False, cap_invited=False):
+    def __init__(self, api, check_backlog=False, cap_invited=False, count_active=None):
 
         self.api = api
 
-        self.follows = set([i['username'] for i in self.api.following])
+        self.follows = self.current_follows()
         self.config = self.api.session.config
 
         self.check_backlog = check_backlog
         self.cap_invited = cap_invited
         self.no_dls_yet = True
+        # Ids of broadcasts a concurrency limit held back, to be checked again on later polls
+        self.held = set()
+
+        self.rules = CaptureRules(self.config.get('capture_rules'), count_active,
+                                  index_path(self.config))
 
     def check_for_new(self):
         """Check for new broadcasts"""
@@ -39,12 +50,18 @@ class Listener:
         new_broadcasts = list()
         new = self.new_follows()
 
+        notified_at = time.time()
+        queued = Counter()
+        # Held broadcasts that dropped out of the feed can't be picked up again
+        self.held &= set(i.get('id') for i in notifications)
         for i in notifications:
 
             broadcast = Broadcast(self.api, i)
+            broadcast.notified_at = notified_at
 
-            if self.check_if_wanted(broadcast, new):
+            if self.check_if_wanted(broadcast, new, queued[broadcast.username]):
                 new_broadcasts.append(broadcast)
+                queued[broadcast.username] += 1
 
         if self.check_backlog:
             self.check_backlog = False
@@ -56,29 +73,45 @@ class Listener:
 
         return new_broadcasts
 
-    def check_if_wanted(self, broadcast, new_follow):
-        """Check if broadcast in notifications string is desired for download"""
+    def check_if_wanted(self, broadcast, new_follow, queued=0):
+        """Check if broadcast in notifications string is desired for download and passes the
+        capture rules; queued is how many of the user's broadcasts were already accepted"""
         if not (broadcast.islive or broadcast.isreplay):
             return None
 
-        if self.check_backlog or broadcast.isnewer or (broadcast.islive and self.no_dls_yet):
+        if self.check_backlog or broadcast.isnewer or broadcast.id in self.held or \
+                (broadcast.islive and self.no_dls_yet):
             if self.cap_invited or (broadcast.username in self.follows):
-                return True
+                return self.apply_rules(broadcast, queued)
 
         elif new_follow and broadcast.username in new_follow:
-            return True
+            return self.apply_rules(broadcast, queued)
 
         return None
 
+    def apply_rules(self, broadcast, queued):
+        """Check broadcast against the capture rules, holding it for a later poll if only a
+        concurrency limit turned it away"""
+        rule = self.rules.failed_rule(broadcast, queued)
+        if rule in LIMIT_RULES:
+            self.held.add(broadcast.id)
+            return None
+        self.held.discard(broadcast.id)
+        return rule is None or None
+
     def new_follows(self):
         """Get set of new follows since last check"""
-        cur_follows = set([i['username'] for i in self.api.following])
-        new_follows = cur_follows - self.follows
+        cur_follows = self.current_follows()
+        new_follows = set(cur_follows) - set(self.follows)
         self.follows = cur_follows
         if len(new_follows) > 0:
             return new_follows
         return None
 
+    def current_follows(self):
+        """Dict of username -> user id of the people you're following"""
+        return dict((i['username'], i['id']) for i in self.api.following)
+
     def update_latest_broadcast_time(self, broadcasts):
         """Get most recent broadcast time from iterable of broadcast objects"""
         for broadcast in broadcasts:
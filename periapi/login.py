@@ -4,63 +4,180 @@ Periscope API for the masses
 """
 # pylint: disable=broad-except,import-error
 
+from contextlib import contextmanager
 from urllib.parse import parse_qsl
 
+import atexit
 import json
+import os
+import threading
 
 import oauth2 as oauth
 import requests
 
 from path import path
+from . import circuit
+from . import metrics
 from .logging import logging
+from .ratelimit import RateLimiter, endpoint_name
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 RTOKEN_URL = 'https://api.twitter.com/oauth/request_token?oauth_callback=oob'
 ATOKEN_URL = 'https://api.twitter.com/oauth/access_token'
 AUTH_URL = 'https://api.twitter.com/oauth/authorize'
 VERIFY_URL = 'https://api.twitter.com/1.1/account/verify_credentials.json?' \
              'include_entities=false&skip_status=true'
-PERI_LOGIN_URL = 'https://api.periscope.tv/api/v2/loginTwitter'
-PERI_VERIFY_URL = 'https://api.periscope.tv/api/v2/verifyUsername'
-PERI_VALIDATE_URL = 'https://api.periscope.tv/api/v2/validateUsername'
+# Overridable so benchmarks can point periapi at a local stand-in server
+API_BASE = os.environ.get('PERIAPI_API_BASE', 'https://api.periscope.tv/api/v2').rstrip('/')
+PERI_LOGIN_URL = API_BASE + '/loginTwitter'
+PERI_VERIFY_URL = API_BASE + '/verifyUsername'
+PERI_VALIDATE_URL = API_BASE + '/validateUsername'
+
+CONFIG_FLUSH_DELAY = 5
+RETRY_STATUSES = (429, 503)
+MAX_RETRIES = 4
+# Calls that can safely be repeated when the server turned them away
+IDEMPOTENT_ENDPOINTS = {'followingBroadcastFeed', 'userBroadcasts', 'following', 'follow',
+                        'unfollow', 'accessChannel', 'getBroadcastPublic', 'userSearch'}
 
 
 class PeriConfig(dict):
-    """Persistent peri config dict"""
+    """Persistent peri config dict. Changes are coalesced: write() only marks the config dirty
+    and schedules a flush, which merges the changed keys into the file under a lock so several
+    processes can share it. Reads never touch the disk."""
 
     def __init__(self, *args, **kw):
         super().__init__(*args, **kw)
-        self.file = path(".peri.conf")
+        # Absolute, so flushes still find the file after the working directory changes
+        self.file = path(os.path.abspath(".peri.conf"))
         if not self.file.isfile():
             self.file = path("~/.peri.conf").expand()
+        self._init_state()
         if self.file.isfile():
             self.load()
+        atexit.register(self.flush)
+
+    def _init_state(self):
+        """Set up the bookkeeping for pending changes"""
+        self._dirty = set()
+        self._lock = threading.RLock()
+        self._timer = None
+
+    def __reduce__(self):
+        return _restore_config, (self.file, dict(self))
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            super().__setitem__(key, value)
+            self._dirty.add(key)
+
+    def __delitem__(self, key):
+        with self._lock:
+            super().__delitem__(key)
+            self._dirty.add(key)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kw):
+        for key, value in dict(*args, **kw).items():
+            self[key] = value
+
+    def pop(self, key, *default):
+        with self._lock:
+            if key in self:
+                self._dirty.add(key)
+            return super().pop(key, *default)
 
     def load(self):
         """Load the config from file"""
         with self.file.open("r") as inp:
-            self.update(json.load(inp))
+            with self._lock:
+                super().update(json.load(inp))
 
     def write(self):
-        """Persist the config to file"""
-        tmp = path(self.file + ".tmp")
-        try:
-            with tmp.open("w") as tmpp:
-                json.dump(self, tmpp, indent=2)
-            try:
-                self.file.unlink()
-            except Exception:
-                pass
-            tmp.move(self.file)
-        finally:
-            try:
-                tmp.unlink()
-            except Exception:
-                pass
+        """Schedule the pending changes to be persisted within CONFIG_FLUSH_DELAY seconds"""
+        with self._lock:
+            if self._timer is None or not self._timer.is_alive():
+                self._timer = threading.Timer(CONFIG_FLUSH_DELAY, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        """Persist pending changes now. Keys changed here are merged into the file as it is on
+        disk, so changes other processes made to other keys survive. The file is replaced
+        atomically and synced, so a crash leaves either the old or the new config."""
+        with self._lock:
+            if not self._dirty:
+                return None
+            dirty = set(self._dirty)
+            with self._file_lock():
+                try:
+                    with self.file.open("r") as inp:
+                        merged = json.load(inp)
+                except (IOError, ValueError):
+                    merged = dict()
+                for key in dirty:
+                    if key in self:
+                        merged[key] = self[key]
+                    else:
+                        merged.pop(key, None)
+                tmp = self.file + ".tmp"
+                with open(tmp, "w") as tmpp:
+                    json.dump(merged, tmpp, indent=2)
+                    tmpp.flush()
+                    os.fsync(tmpp.fileno())
+                os.replace(tmp, self.file)
+                _fsync_directory(os.path.dirname(os.path.abspath(self.file)))
+            self._dirty -= dirty
+
+    @contextmanager
+    def _file_lock(self):
+        """Exclusive lock on the config shared with other processes (a no-op without fcntl)"""
+        if fcntl is None:
+            yield
+            return
+        with open(self.file + ".lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+
+def _restore_config(file, items):
+    """Unpickle a PeriConfig (e.g. in a download process) without reading the file again"""
+    config = PeriConfig.__new__(PeriConfig)
+    dict.update(config, items)
+    config.file = file
+    config._init_state()  # pylint: disable=protected-access
+    atexit.register(config.flush)
+    return config
+
+
+def _fsync_directory(directory):
+    """Make a rename in directory durable, where the platform allows it"""
+    try:
+        handle = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return None
+    try:
+        os.fsync(handle)
+    except OSError:
+        pass
+    finally:
+        os.close(handle)
 
 
 class LoginSession(requests.Session):
     """Provides an authenticated requests.Session"""
 
+    # Keep the login and config when the session is pickled into download processes
+    __attrs__ = requests.Session.__attrs__ + ['config', 'cookie', 'uid', 'name']
+
     def __init__(self, *args, **kw):
         super().__init__(*args, **kw)
 
@@ -174,7 +291,7 @@ class LoginSession(requests.Session):
 
         test_payload = {"user_id": config["pubid"]}
         try:
-            resp = self.post('https://api.periscope.tv/api/v2/following', json=test_payload)
+            resp = self.post(API_BASE + '/following', json=test_payload)
         except:
             raise IOError('Could not complete authentication with Periscope')
         if resp.status_code == 200:
@@ -215,9 +332,48 @@ class LoginSession(requests.Session):
             if resp.json().get("success"):
                 config["username_validated"] = True
 
-        config.write()
+        config.flush()
         return cookie
 
+    @property
+    def limiter(self):
+        """Rate limiter shared by every periapi process using this config"""
+        if '_limiter' not in self.__dict__:
+            state_dir = os.path.join(os.path.dirname(os.path.abspath(self.config.file)),
+                                     '.periapi-ratelimit')
+            self._limiter = RateLimiter(state_dir, self.config.get('rate_limits'))
+        return self._limiter
+
+    @property
+    def stats(self):
+        """Counters of API calls made, throttled by the limiter, rejected and retried"""
+        return dict(self.limiter.stats)
+
+    def request_peri(self, method, url, **kw):
+        """Make an API call through the rate limiter and the API host's circuit breaker. Calls
+        the server rejects with 429 or 503 are retried with backoff, honouring Retry-After, if
+        repeating them is safe."""
+        idempotent = method == 'GET' or endpoint_name(url) in IDEMPOTENT_ENDPOINTS
+        attempt = 0
+        while True:
+            self.limiter.acquire(url)
+            with metrics.timer('periapi_api_request_seconds', endpoint=endpoint_name(url)):
+                resp = circuit.request(method, url, session=self, **kw)
+            metrics.inc('periapi_api_requests_total', endpoint=endpoint_name(url),
+                        status=resp.status_code)
+            if resp.status_code not in RETRY_STATUSES:
+                return resp
+            delay = self.limiter.backoff(url, resp.headers.get('Retry-After'), attempt)
+            if not idempotent or attempt >= MAX_RETRIES:
+                return resp
+            logging.info("%s returned %s, retrying in %.1fs", url, resp.status_code, delay)
+            self.limiter.count('retried')
+            attempt += 1
+
+    def get_peri(self, url, **kw):
+        """Make a get request to the peri API"""
+        return self.request_peri('GET', url, **kw)
+
     def post_peri(self, *args, **kw):
         """Make a post to the peri API"""
         # stuff in the cookie, if there is a payload
@@ -226,7 +382,7 @@ class LoginSession(requests.Session):
             payload["cookie"] = self.cookie
             kw["json"] = payload
             logging.debug("payload: %r", payload)
-        resp = self.post(*args, **kw)
+        resp = self.request_peri('POST', *args, **kw)
         if resp.status_code != 200:
             raise IOError("API call failed: {}".format(resp.status_code))
         return resp.json()
@@ -239,7 +395,7 @@ class LoginSession(requests.Session):
             payload["cookie"] = ('', self.cookie)
             kw["files"] = payload
             logging.debug("payload: %r", payload)
-        resp = self.post(*args, **kw)
+        resp = self.request_peri('POST', *args, **kw)
         if resp.status_code != 200:
             raise IOError("API call failed: {}".format(resp.status_code))
         return resp.json()
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+"""
+Periscope API for the masses
+
+Throughput, latency and queue depth metrics, served in the Prometheus text format
+"""
+
+import threading
+import time
+
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from multiprocessing import Queue
+from socketserver import ThreadingMixIn
+
+from periapi.logging import logging
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+DURATION_BUCKETS = (1, 5, 15, 60, 300, 900, 3600, 4 * 3600)
+FIRST_BYTE_BUCKETS = (1, 2, 5, 10, 20, 30, 60, 120)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# How long updates to a finished download's series are ignored; any still on their way from a
+# worker process arrive well within this
+FORGET_SECONDS = 600
+
+# name: (type, help, histogram buckets)
+METRICS = {
+    'periapi_bytes_downloaded_total': (
+        'counter', "Bytes downloaded by all downloads", None),
+    'periapi_download_bytes_total': (
+        'counter', "Bytes downloaded per running download", None),
+    'periapi_download_bytes_per_second': (
+        'gauge', "Current download speed of each running download", None),
+    'periapi_download_progress_ratio': (
+        'gauge', "Fraction of each running replay download done", None),
+    'periapi_download_eta_seconds': (
+        'gauge', "Expected time until each running replay download finishes", None),
+    'periapi_download_idle_seconds': (
+        'gauge', "Time since each running download last received data", None),
+    'periapi_chunk_seconds': (
+        'histogram', "Time taken to download one replay chunk", LATENCY_BUCKETS),
+    'periapi_chunk_failures_total': (
+        'counter', "Failed replay chunk downloads by reason", None),
+    'periapi_downloads_completed_total': (
+        'counter', "Downloads completed", None),
+    'periapi_failed_attempts_total': (
+        'counter', "Download attempts that failed, by reason", None),
+    'periapi_download_failures_total': (
+        'counter', "Downloads that failed for good, by reason", None),
+    'periapi_downloads_deferred_total': (
+        'counter', "Downloads deferred, by reason", None),
+    'periapi_pool_processes': (
+        'gauge', "Size of the download process pool", None),
+    'periapi_pool_busy': (
+        'gauge', "Downloads running in the process pool", None),
+    'periapi_queue_depth': (
+        'gauge', "Downloads waiting to be started, by queue", None),
+    'periapi_api_request_seconds': (
+        'histogram', "Periscope API call latency by endpoint", LATENCY_BUCKETS),
+    'periapi_api_requests_total': (
+        'counter', "Periscope API calls by endpoint and HTTP status", None),
+    'periapi_convert_seconds': (
+        'histogram', "Time taken to convert a download to mp4, by engine", DURATION_BUCKETS),
+    'periapi_live_capture_seconds': (
+        'histogram', "Length of each FFMPEG live capture run", DURATION_BUCKETS),
+    'periapi_first_byte_seconds': (
+        'histogram', "Time from a live's notification to its first captured bytes",
+        FIRST_BYTE_BUCKETS),
+    'periapi_live_stalls_total': (
+        'counter', "Stalled FFMPEG live captures killed and restarted", None),
+}
+_QUEUE = None
+_SERVER = None
+_BOUND_LABELS = dict()
+_COLLECTORS = list()
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    """HTTP server handling each request in a thread (http.server only has one from 3.7)"""
+    daemon_threads = True
+
+
+class Registry:
+    """Current value of every metric series, keyed by name and labels"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = dict()
+        self.forgotten = dict()
+
+    def apply(self, kind, name, value, labels):
+        """Add to a counter, set a gauge or observe a histogram value"""
+        key = (name, labels)
+        with self.lock:
+            if dict(labels).get('broadcast') in self.forgotten:
+                return None
+            if kind == 'set':
+                self.values[key] = value
+            elif kind == 'inc':
+                self.values[key] = self.values.get(key, 0) + value
+            else:
+                buckets = METRICS[name][2]
+                series = self.values.setdefault(key, [0] * (len(buckets) + 2))
+                for i, bound in enumerate(buckets):
+                    if value <= bound:
+                        series[i] += 1
+                series[-2] += value
+                series[-1] += 1
+
+    def forget_download(self, broadcast_id):
+        """Drop the series of a finished download, ignoring late updates to them for
+        FORGET_SECONDS"""
+        now = time.time()
+        with self.lock:
+            for stale in [i for i, when in self.forgotten.items() if now - when > FORGET_SECONDS]:
+                del self.forgotten[stale]
+            self.forgotten[broadcast_id] = now
+            for key in [key for key in self.values if ('broadcast', broadcast_id) in key[1]]:
+                del self.values[key]
+
+    def track_download(self, broadcast_id):
+        """Accept updates for a download again"""
+        with self.lock:
+            self.forgotten.pop(broadcast_id, None)
+
+    def render(self):
+        """Every series in the Prometheus text exposition format, after running the
+        collectors"""
+        for collector in list(_COLLECTORS):
+            try:
+                collector()
+            except Exception as error:
+                logging.debug("Metrics collector failed: %r", error)
+        with self.lock:
+            values = dict(self.values)
+
+        lines = list()
+        for name in sorted(METRICS):
+            series = sorted((labels, value) for (key, labels), value in values.items()
+                            if key == name)
+            if not series:
+                continue
+            kind, description, buckets = METRICS[name]
+            lines.append("# HELP {0} {1}".format(name, description))
+            lines.append("# TYPE {0} {1}".format(name, kind))
+            for labels, value in series:
+                if kind != 'histogram':
+                    lines.append("{0}{1} {2}".format(name, format_labels(labels), value))
+                    continue
+                for bound, count in zip(buckets, value):
+                    lines.append("{0}_bucket{1} {2}".format(
+                        name, format_labels(labels + (('le', str(bound)),)), count))
+                lines.append("{0}_bucket{1} {2}".format(
+                    name, format_labels(labels + (('le', '+Inf'),)), value[-1]))
+                lines.append("{0}_sum{1} {2}".format(name, format_labels(labels), value[-2]))
+                lines.append("{0}_count{1} {2}".format(name, format_labels(labels), value[-1]))
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def format_labels(labels):
+    """Prometheus label set, e.g. {endpoint="userSearch"}"""
+    if not labels:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(key, str(value).replace('\\', '\\\\').replace(
+        '"', '\\"').replace('\n', '\\n')) for key, value in labels) + '}'
+
+
+def reason(error):
+    """Label value for why something failed: the exception's class name"""
+    return type(error).__name__ if isinstance(error, BaseException) else 'other'
+
+
+def _record(kind, name, value, labels):
+    """Apply an update here, or send it to the parent process when running in a worker"""
+    labels = tuple(sorted(labels.items()))
+    if _QUEUE is not None:
+        try:
+            _QUEUE.put_nowait((kind, name, value, labels))
+        except Exception as error:
+            logging.debug("Could not report metric %s: %r", name, error)
+    else:
+        REGISTRY.apply(kind, name, value, labels)
+
+
+def inc(name, amount=1, **labels):
+    """Add to a counter"""
+    _record('inc', name, amount, labels)
+
+
+def set_gauge(name, value, **labels):
+    """Set a gauge"""
+    _record('set', name, value, labels)
+
+
+def observe(name, value, **labels):
+    """Add an observation to a histogram"""
+    _record('observe', name, value, labels)
+
+
+@contextmanager
+def timer(name, **labels):
+    """Observe how long the block takes in a histogram"""
+    started = time.time()
+    try:
+        yield
+    finally:
+        observe(name, time.time() - started, **labels)
+
+
+def bind_download(broadcast_id):
+    """Attribute this process's download bytes to a broadcast (pool processes run one download
+    at a time)"""
+    _BOUND_LABELS['broadcast'] = broadcast_id
+
+
+def add_download_bytes(amount):
+    """Count bytes downloaded, in total and for the download bound to this process"""
+    inc('periapi_bytes_downloaded_total', amount)
+    if _BOUND_LABELS:
+        inc('periapi_download_bytes_total', amount, **_BOUND_LABELS)
+
+
+def add_collector(collector):
+    """Have collector (a function setting gauges) called just before every scrape, for values
+    that are cheaper to read on demand than to keep up to date"""
+    _COLLECTORS.append(collector)
+
+
+def remove_collector(collector):
+    """Stop calling collector"""
+    if collector in _COLLECTORS:
+        _COLLECTORS.remove(collector)
+
+
+def attach(queue):
+    """Send this (pool worker) process's updates through queue to the parent"""
+    global _QUEUE
+    _QUEUE = queue
+
+
+def _collect(queue):
+    """Apply updates sent by worker processes until the process exits"""
+    while True:
+        try:
+            REGISTRY.apply(*queue.get())
+        except (EOFError, OSError):
+            return None
+        except Exception as error:
+            logging.debug("Bad metric update: %r", error)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Serves the registry at /metrics"""
+
+    def do_GET(self):
+        """Answer a scrape"""
+        if self.path.split('?', 1)[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return None
+        body = REGISTRY.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        """Keep scrapes out of the console"""
+        pass
+
+
+def serve(port, host='127.0.0.1'):
+    """Serve metrics on host:port in background threads and start collecting updates from
+    worker processes. Safe to call more than once. Returns the queue workers should attach."""
+    global _SERVER
+    if _SERVER is None:
+        queue = Queue()
+        server = ThreadingHTTPServer((host, int(port)), MetricsHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        threading.Thread(target=_collect, args=(queue,), daemon=True).start()
+        _SERVER = (server, queue)
+        logging.info("Serving metrics on http://%s:%s/metrics", host, port)
+    return _SERVER[1]
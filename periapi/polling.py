@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+Periscope API for the masses
+
+Adaptive scheduling of notification checks
+"""
+
+import random
+import time
+
+from collections import deque
+from datetime import datetime, timezone
+
+DEFAULT_MIN_INTERVAL = 5
+DEFAULT_MAX_INTERVAL = 120
+BACKOFF_FACTOR = 1.5
+JITTER = 0.2
+DETECTION_SAMPLE_SIZE = 200
+
+
+def percentile(values, fraction):
+    """Value below which fraction of the (non-empty) values fall"""
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+class AdaptivePoller:
+    """Decides how long to wait between notification checks. Polls tighten to the minimum
+    interval right after new broadcasts turn up and back off exponentially (with jitter) while
+    the feed is quiet. A per-hour histogram of when followed users went live caps the back off
+    during the hours they are usually active."""
+
+    def __init__(self, config, start_interval=None):
+        self.config = config
+        self.min_interval = config.get('min_notification_interval') or DEFAULT_MIN_INTERVAL
+        self.max_interval = max(config.get('max_notification_interval') or DEFAULT_MAX_INTERVAL,
+                                self.min_interval)
+        self.interval = self._clamp(start_interval or self.min_interval)
+        self.detection_delays = deque(maxlen=DETECTION_SAMPLE_SIZE)
+        self.last_poll = None
+        if len(config.get('golive_hours') or []) != 24:
+            config['golive_hours'] = [0] * 24
+
+    def _clamp(self, interval):
+        """Keep interval within the configured bounds"""
+        return min(max(interval, self.min_interval), self.max_interval)
+
+    @property
+    def hours(self):
+        """Number of go-lives seen per local hour of the day"""
+        return self.config['golive_hours']
+
+    def record_poll(self, new_broadcasts):
+        """Adjust the schedule to the outcome of a check (a list of new broadcasts, or None).
+        Only lives started since the previous check go into the statistics; the first check's,
+        backlog and newly followed users' broadcasts say nothing about when users go live."""
+        now, previous = datetime.now(timezone.utc), self.last_poll
+        self.last_poll = now
+        if not new_broadcasts:
+            self.interval = self._clamp(self.interval * BACKOFF_FACTOR)
+            return None
+
+        hours = list(self.hours)
+        for broadcast in new_broadcasts:
+            if not broadcast.islive or previous is None or broadcast.start_dt <= previous:
+                continue
+            started = broadcast.start_dt
+            hours[started.astimezone().hour] += 1
+            self.detection_delays.append(max((now - started).total_seconds(), 0))
+        self.config['golive_hours'] = hours
+        self.config.write()
+        self.interval = self.min_interval
+
+    def hour_ceiling(self, hour=None):
+        """Longest interval allowed in an hour of the day: the maximum, divided by how much
+        busier than average that hour usually is"""
+        hour = time.localtime().tm_hour if hour is None else hour
+        average = sum(self.hours) / 24
+        activity = (self.hours[hour] + 1) / (average + 1)
+        return self._clamp(self.max_interval / max(activity, 1))
+
+    def next_interval(self):
+        """Seconds to wait before the next check"""
+        interval = min(self.interval, self.hour_ceiling())
+        return self._clamp(interval * random.uniform(1 - JITTER, 1 + JITTER))
+
+    @property
+    def detection_stats(self):
+        """Median and 90th percentile of the seconds between a broadcast going live and it
+        being found, over the last DETECTION_SAMPLE_SIZE live broadcasts, or None"""
+        if not self.detection_delays:
+            return None
+        return {'count': len(self.detection_delays),
+                'median': percentile(self.detection_delays, 0.5),
+                'p90': percentile(self.detection_delays, 0.9)}
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+"""
+Periscope API for the masses
+
+Live progress of running downloads, shared between pool processes and the parent
+"""
+
+import os
+import struct
+import threading
+import time
+
+from multiprocessing.sharedctypes import RawArray
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+# seq, broadcast id, pid, started, updated, bytes, bytes total, chunks done, chunks total, rate
+SLOT_FORMAT = struct.Struct('<I16sIddQQIId')
+RATE_INTERVAL = 1.0
+RATE_SMOOTHING = 0.3
+STALL_SECONDS = 60
+READ_RETRIES = 5
+
+_TABLE = None
+_SLOT = None
+
+
+class ProgressTable:
+    """Fixed size slots, one per running download, in memory shared by every process. Each
+    slot has a single writer (the pool process running the download); a sequence number that
+    is odd while the writer is busy lets readers skip torn reads without any locking. Backed by
+    multiprocessing.shared_memory where available, otherwise by a shared ctypes array."""
+
+    def __init__(self, slots, handle=None):
+        self.slots = slots
+        self.shm = None
+        if handle is None and shared_memory is not None:
+            self.shm = shared_memory.SharedMemory(create=True, size=slots * SLOT_FORMAT.size)
+            self.handle = self.shm.name
+        elif handle is None:
+            self.handle = RawArray('c', slots * SLOT_FORMAT.size)
+        elif isinstance(handle, str):
+            self.shm = _attach(handle)
+            self.handle = handle
+        else:
+            self.handle = handle
+        self.buffer = self.shm.buf if self.shm is not None else memoryview(self.handle).cast('B')
+        self.owner = handle is None
+        self.free = list(range(slots)) if self.owner else list()
+        self.cache = [dict() for _ in range(slots)]
+
+    def claim(self, broadcast_id):
+        """Reserve an empty slot for a download (parent only). Returns its index, or None if
+        every slot is taken."""
+        if not self.free:
+            return None
+        slot = self.free.pop(0)
+        self._write(slot, broadcast_id.encode('ascii', 'replace')[:16], 0, 0.0, 0.0, 0, 0, 0, 0,
+                    0.0)
+        return slot
+
+    def release(self, slot):
+        """Hand a slot back once its download is over (parent only)"""
+        if slot is None or slot in self.free:
+            return None
+        self._write(slot, b'', 0, 0.0, 0.0, 0, 0, 0, 0, 0.0)
+        self.free.append(slot)
+
+    def _write(self, slot, *fields):
+        """Update a slot, bumping its sequence number around the write"""
+        offset = slot * SLOT_FORMAT.size
+        seq = struct.unpack_from('<I', self.buffer, offset)[0]
+        struct.pack_into('<I', self.buffer, offset, (seq + 1) & 0xFFFFFFFF)
+        SLOT_FORMAT.pack_into(self.buffer, offset, (seq + 1) & 0xFFFFFFFF, *fields)
+        struct.pack_into('<I', self.buffer, offset, (seq + 2) & 0xFFFFFFFF)
+
+    def read(self, slot):
+        """Snapshot of a slot as a dict, or None if it is empty. A slot that is being written
+        to on every try returns the last good snapshot."""
+        offset = slot * SLOT_FORMAT.size
+        for _ in range(READ_RETRIES):
+            fields = SLOT_FORMAT.unpack_from(self.buffer, offset)
+            if fields[0] % 2 == 0 and \
+                    struct.unpack_from('<I', self.buffer, offset)[0] == fields[0]:
+                break
+        else:
+            return self.cache[slot] or None
+        broadcast_id = fields[1].rstrip(b'\0').decode('ascii', 'replace')
+        if not broadcast_id:
+            return None
+        self.cache[slot] = dict(zip(('broadcast_id', 'pid', 'started', 'updated', 'bytes',
+                                     'bytes_total', 'chunks_done', 'chunks_total', 'rate'),
+                                    (broadcast_id,) + fields[2:]))
+        return self.cache[slot]
+
+    def close(self):
+        """Detach from (and, in the parent, free) the shared memory"""
+        self.buffer = None
+        if self.shm is not None:
+            self.shm.close()
+            if self.owner:
+                self.shm.unlink()
+
+
+def _attach(name):
+    """Open shared memory created by the parent. Pool processes share the parent's resource
+    tracker, so the memory is only freed once, by the parent."""
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        return shared_memory.SharedMemory(name=name)
+
+
+def describe(snapshot, now=None):
+    """One line summary of a slot snapshot: bytes so far, chunks, rate and ETA"""
+    now = now or time.time()
+    if not snapshot['pid']:
+        return "waiting to start"
+    parts = ["{:.1f} MB".format(snapshot['bytes'] / 1e6)]
+    if snapshot['chunks_total']:
+        parts.append("{0}/{1} chunks".format(min(snapshot['chunks_done'], snapshot['chunks_total']),
+                                             snapshot['chunks_total']))
+    parts.append("{:.2f} MB/s".format(current_rate(snapshot, now) / 1e6))
+    eta = eta_seconds(snapshot, now)
+    if eta is not None:
+        parts.append("ETA {:.0f}m{:02.0f}s".format(*divmod(eta, 60)))
+    if snapshot['updated'] and now - snapshot['updated'] > STALL_SECONDS:
+        parts.append("no data for {:.0f}s".format(now - snapshot['updated']))
+    elif not snapshot['updated']:
+        parts.append("no data yet")
+    return ", ".join(parts)
+
+
+def current_rate(snapshot, now=None):
+    """Rate of a slot snapshot, scaled down by how long it has gone without data. The writer
+    only updates the rate as bytes arrive, so a stalled download would keep its last one."""
+    now = now or time.time()
+    idle = now - snapshot['updated'] if snapshot['updated'] else 0.0
+    return snapshot['rate'] * min(1.0, RATE_INTERVAL / idle) if idle > 0 else snapshot['rate']
+
+
+def eta_seconds(snapshot, now=None):
+    """Seconds until a download is expected to finish, from its size (or chunk count) and
+    current rate, or None if that can't be told (e.g. live captures)"""
+    rate = current_rate(snapshot, now)
+    if not rate:
+        return None
+    if snapshot['bytes_total'] > snapshot['bytes']:
+        return (snapshot['bytes_total'] - snapshot['bytes']) / rate
+    if snapshot['chunks_total'] > snapshot['chunks_done'] and snapshot['chunks_done']:
+        per_chunk = snapshot['bytes'] / snapshot['chunks_done']
+        return (snapshot['chunks_total'] - snapshot['chunks_done']) * per_chunk / rate
+    return None
+
+
+def attach(handle):
+    """Attach this (pool) process to the parent's progress table"""
+    global _TABLE
+    _TABLE = ProgressTable(0, handle) if handle is not None else None
+
+
+class SlotWriter:
+    """Progress of the download this process is running, kept in its slot. Chunk threads share
+    it, so updates are serialized (the slot itself must only ever have one writer)."""
+
+    def __init__(self, table, slot, broadcast_id):
+        self.lock = threading.Lock()
+        self.table = table
+        self.slot = slot
+        self.broadcast_id = broadcast_id.encode('ascii', 'replace')[:16]
+        self.started = time.time()
+        self.updated = 0.0
+        self.bytes = 0
+        self.bytes_total = 0
+        self.chunks_done = 0
+        self.chunks_total = 0
+        self.rate = 0.0
+        self.rate_mark = (self.started, 0)
+        self.flush()
+
+    def flush(self):
+        """Write the current values to the slot"""
+        self.table._write(self.slot, self.broadcast_id, os.getpid(), self.started, self.updated,
+                          self.bytes, self.bytes_total, self.chunks_done, self.chunks_total,
+                          self.rate)
+
+    def add_bytes(self, amount, chunk_done=False):
+        """Count bytes received (and a finished chunk), updating the smoothed rate"""
+        with self.lock:
+            now = time.time()
+            self.bytes += amount
+            self.chunks_done += 1 if chunk_done else 0
+            self.updated = now
+            mark_time, mark_bytes = self.rate_mark
+            if now - mark_time >= RATE_INTERVAL:
+                current = (self.bytes - mark_bytes) / (now - mark_time)
+                self.rate = current if not self.rate else \
+                    RATE_SMOOTHING * current + (1 - RATE_SMOOTHING) * self.rate
+                self.rate_mark = (now, self.bytes)
+            self.flush()
+
+    def set_totals(self, chunks_total=None, bytes_total=None):
+        """Record how many chunks and bytes the download is expected to have"""
+        with self.lock:
+            self.chunks_total = chunks_total or self.chunks_total
+            self.bytes_total = bytes_total or self.bytes_total
+            self.flush()
+
+
+def bind(slot, broadcast_id):
+    """Start reporting the progress of a download in slot (pool processes run one download at
+    a time). Without a table or slot, reporting does nothing."""
+    global _SLOT
+    _SLOT = SlotWriter(_TABLE, slot, broadcast_id) \
+        if _TABLE is not None and slot is not None else None
+
+
+def add_bytes(amount, chunk_done=False):
+    """Report bytes received for the bound download"""
+    if _SLOT is not None:
+        _SLOT.add_bytes(amount, chunk_done)
+
+
+def set_totals(chunks_total=None, bytes_total=None):
+    """Report the expected size of the bound download"""
+    if _SLOT is not None:
+        _SLOT.set_totals(chunks_total, bytes_total)
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+"""
+Periscope API for the masses
+
+Client side rate limiting
+"""
+
+import json
+import os
+import random
+import threading
+import time
+
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Endpoint families share a bucket; (calls per second, burst)
+ENDPOINT_FAMILIES = {
+    'followingBroadcastFeed': 'feed',
+    'userBroadcasts': 'feed',
+    'getBroadcastPublic': 'broadcast',
+    'accessChannel': 'broadcast',
+    'following': 'social',
+    'follow': 'social',
+    'unfollow': 'social',
+    'userSearch': 'search',
+}
+DEFAULT_FAMILY = 'default'
+FAMILY_RATES = {
+    'feed': (1.0, 5),
+    'broadcast': (5.0, 10),
+    'social': (2.0, 5),
+    'search': (5.0, 10),
+    'default': (5.0, 10),
+}
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 120.0
+
+
+def endpoint_name(url):
+    """Last path component of an API url, e.g. 'getBroadcastPublic'"""
+    return url.split('?', 1)[0].rstrip('/').rsplit('/', 1)[-1]
+
+
+def parse_retry_after(value):
+    """Seconds to wait according to a Retry-After header (delta seconds or HTTP date), or
+    None if it is missing or unreadable"""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+@contextmanager
+def file_state(path, defaults):
+    """Exclusive access (across processes) to a dict of state kept as JSON in path. Yields
+    defaults updated with what the file holds; changes are written back. Needs fcntl."""
+    with open(path, 'a+') as handle:
+        fcntl.flock(handle, fcntl.LOCK_EX)
+        handle.seek(0)
+        try:
+            state = dict(defaults, **json.load(handle))
+        except ValueError:
+            state = dict(defaults)
+        yield state
+        handle.seek(0)
+        handle.truncate()
+        json.dump(state, handle)
+
+
+class TokenBucket:
+    """Allows rate calls per second on average, in bursts of up to capacity calls"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1)
+        self.state = {'tokens': self.capacity, 'updated': time.time(), 'blocked_until': 0.0}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def _locked_state(self):
+        """Exclusive access to the bucket's state"""
+        with self.lock:
+            yield self.state
+
+    def acquire(self):
+        """Block until a call may be made. Returns the number of seconds waited."""
+        waited = 0.0
+        while True:
+            with self._locked_state() as state:
+                now = time.time()
+                state['tokens'] = min(self.capacity, state['tokens'] +
+                                      max(now - state['updated'], 0) * self.rate)
+                state['updated'] = now
+                if now >= state['blocked_until'] and state['tokens'] >= 1:
+                    state['tokens'] -= 1
+                    return waited
+                delay = max(state['blocked_until'] - now, (1 - state['tokens']) / self.rate)
+            time.sleep(delay)
+            waited += delay
+
+    def pause(self, seconds):
+        """Hold off every caller for seconds, e.g. after the server asked us to slow down"""
+        with self._locked_state() as state:
+            state['blocked_until'] = max(state['blocked_until'], time.time() + seconds)
+
+
+class SharedTokenBucket(TokenBucket):
+    """TokenBucket whose state is kept in a file under an exclusive lock, so every process
+    using the same file draws from one bucket. Without fcntl (Windows) each process gets a
+    bucket of its own."""
+
+    def __init__(self, path, rate, capacity=None):
+        super().__init__(rate, capacity)
+        self.path = path
+
+    @contextmanager
+    def _locked_state(self):
+        with self.lock:
+            if fcntl is None:
+                yield self.state
+                return
+            with file_state(self.path, self.state) as state:
+                yield state
+
+
+class RateLimiter:
+    """Paces API calls with one shared token bucket per endpoint family and keeps counters of
+    calls, client side waits (throttled), server rejections (rate_limited) and retries"""
+
+    def __init__(self, state_dir, rates=None):
+        self.state_dir = state_dir
+        self.rates = dict(FAMILY_RATES, **(rates or dict()))
+        self.buckets = dict()
+        self.stats = Counter()
+        self.lock = threading.Lock()
+
+    def bucket(self, url):
+        """Bucket of the endpoint family url belongs to"""
+        family = ENDPOINT_FAMILIES.get(endpoint_name(url), DEFAULT_FAMILY)
+        with self.lock:
+            if family not in self.buckets:
+                if not os.path.exists(self.state_dir):
+                    os.makedirs(self.state_dir, exist_ok=True)
+                rate, capacity = self.rates.get(family, self.rates[DEFAULT_FAMILY])
+                self.buckets[family] = SharedTokenBucket(
+                    os.path.join(self.state_dir, family), rate, capacity)
+            return self.buckets[family]
+
+    def count(self, key, amount=1):
+        """Add to one of the counters"""
+        with self.lock:
+            self.stats[key] += amount
+
+    def acquire(self, url):
+        """Block until a call to url may be made"""
+        waited = self.bucket(url).acquire()
+        self.count('calls')
+        if waited:
+            self.count('throttled')
+            self.count('throttled_seconds', waited)
+
+    def backoff(self, url, retry_after=None, attempt=0):
+        """Record that the server rejected a call for being too fast or busy, and hold off the
+        endpoint family for as long as Retry-After says or, failing that, an exponentially
+        growing, jittered delay. Returns the delay in seconds."""
+        self.count('rate_limited')
+        delay = parse_retry_after(retry_after)
+        if delay is None:
+            delay = min(BACKOFF_BASE * 2 ** attempt, BACKOFF_MAX) * random.uniform(1.0, 1.5)
+        self.bucket(url).pause(delay)
+        return delay
+
+
+class RateLimitedExecutor:
+    """Thread pool whose tasks share one token bucket. submit blocks while max_pending tasks
+    are waiting, so a batch of thousands of calls doesn't pile up in memory."""
+
+    def __init__(self, max_workers, rate, capacity=None, max_pending=None):
+        self.bucket = TokenBucket(rate, capacity)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.slots = threading.BoundedSemaphore(max_pending or max_workers * 2)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+
+    def submit(self, func, *args, **kwargs):
+        """Schedule func(*args, **kwargs) and return its Future"""
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(self._run, func, args, kwargs)
+        except BaseException:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda _: self.slots.release())
+        return future
+
+    def _run(self, func, args, kwargs):
+        """Wait for a token, then make the call"""
+        self.bucket.acquire()
+        return func(*args, **kwargs)
+
+    def shutdown(self, wait=True):
+        """Stop accepting tasks, optionally waiting for the scheduled ones to finish"""
+        self.executor.shutdown(wait=wait)
@@ -0,0 +1,644 @@
+#!/usr/bin/env python3
+"""
+Periscope API for the masses
+
+Pure-python remuxer turning the H.264/AAC streams of MPEG-TS segments into fragmented MP4
+"""
+
+import struct
+
+from abc import ABC, abstractmethod
+
+TS_PACKET_SIZE = 188
+TS_SYNC_BYTE = 0x47
+
+STREAM_TYPE_H264 = 0x1B
+STREAM_TYPE_AAC = 0x0F
+
+PTS_CLOCK = 90000
+PTS_WRAP = 1 << 33
+DISCONTINUITY_THRESHOLD = 10 * PTS_CLOCK
+DEFAULT_VIDEO_STEP = 3000
+AAC_FRAME_SAMPLES = 1024
+
+SYNC_SAMPLE_FLAGS = 0x02000000
+NON_SYNC_SAMPLE_FLAGS = 0x01010000
+
+AAC_SAMPLE_RATES = [96000, 88200, 64000, 48000, 44100, 32000, 24000, 22050, 16000, 12000, 11025,
+                    8000, 7350]
+
+HIGH_PROFILES = (100, 110, 122, 244, 44, 83, 86, 118, 128, 138, 139, 134, 135)
+
+NAL_IDR = 5
+NAL_SPS = 7
+NAL_PPS = 8
+NAL_AUD = 9
+
+
+class RemuxError(Exception):
+    """Raised when a transport stream can't be remuxed"""
+    pass
+
+
+def _box(kind, *payloads):
+    """Build an ISO BMFF box"""
+    payload = b''.join(payloads)
+    return struct.pack('>I4s', 8 + len(payload), kind) + payload
+
+
+def _full_box(kind, version, flags, *payloads):
+    """Build an ISO BMFF full box (box with version and flags)"""
+    return _box(kind, struct.pack('>I', (version << 24) | flags), *payloads)
+
+
+def _descriptor(tag, payload):
+    """Build an MPEG-4 descriptor for the esds box"""
+    size = len(payload)
+    return bytes([tag, 0x80 | (size >> 21 & 0x7F), 0x80 | (size >> 14 & 0x7F),
+                  0x80 | (size >> 7 & 0x7F), size & 0x7F]) + payload
+
+
+def _read_timestamp(data, pos):
+    """Decode a 33 bit PES timestamp"""
+    return (((data[pos] >> 1) & 0x07) << 30) | (data[pos + 1] << 22) | \
+           (((data[pos + 2] >> 1) & 0x7F) << 15) | (data[pos + 3] << 7) | \
+           ((data[pos + 4] >> 1) & 0x7F)
+
+
+def _split_nals(data):
+    """Split an Annex B byte stream into NAL units"""
+    nals = []
+    start = data.find(b'\x00\x00\x01')
+    while start != -1:
+        start += 3
+        end = data.find(b'\x00\x00\x01', start)
+        nal = data[start:] if end == -1 else data[start:end]
+        nal = nal.rstrip(b'\x00')
+        if nal:
+            nals.append(nal)
+        start = end
+    return nals
+
+
+class _BitReader:
+    """Reads bits and exp-golomb codes from an RBSP"""
+
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def bits(self, count):
+        """Read an unsigned integer of count bits"""
+        value = 0
+        for _ in range(count):
+            byte = self.data[self.pos >> 3] if (self.pos >> 3) < len(self.data) else 0
+            value = (value << 1) | ((byte >> (7 - (self.pos & 7))) & 1)
+            self.pos += 1
+        return value
+
+    def ue(self):
+        """Read an unsigned exp-golomb code"""
+        zeros = 0
+        while self.bits(1) == 0:
+            zeros += 1
+            if zeros > 31:
+                raise RemuxError("Invalid exp-golomb code in SPS.")
+        return (1 << zeros) - 1 + self.bits(zeros)
+
+    def se(self):
+        """Read a signed exp-golomb code"""
+        value = self.ue()
+        return (value + 1) // 2 if value & 1 else -(value // 2)
+
+
+def parse_sps(sps):
+    """Get the picture dimensions and chroma layout out of an H.264 SPS NAL unit"""
+    reader = _BitReader(sps[1:].replace(b'\x00\x00\x03', b'\x00\x00'))
+    profile_idc = reader.bits(8)
+    reader.bits(16)
+    reader.ue()
+
+    chroma_format_idc = 1
+    bit_depth_luma = bit_depth_chroma = 0
+    separate_colour_plane = 0
+    if profile_idc in HIGH_PROFILES:
+        chroma_format_idc = reader.ue()
+        if chroma_format_idc == 3:
+            separate_colour_plane = reader.bits(1)
+        bit_depth_luma = reader.ue()
+        bit_depth_chroma = reader.ue()
+        reader.bits(1)
+        if reader.bits(1):
+            for i in range(8 if chroma_format_idc != 3 else 12):
+                if reader.bits(1):
+                    last_scale = next_scale = 8
+                    for _ in range(16 if i < 6 else 64):
+                        if next_scale != 0:
+                            next_scale = (last_scale + reader.se()) % 256
+                        last_scale = next_scale or last_scale
+
+    reader.ue()
+    poc_type = reader.ue()
+    if poc_type == 0:
+        reader.ue()
+    elif poc_type == 1:
+        reader.bits(1)
+        reader.se()
+        reader.se()
+        for _ in range(reader.ue()):
+            reader.se()
+
+    reader.ue()
+    reader.bits(1)
+    width_mbs = reader.ue() + 1
+    height_map_units = reader.ue() + 1
+    frame_mbs_only = reader.bits(1)
+    if not frame_mbs_only:
+        reader.bits(1)
+    reader.bits(1)
+
+    crop = (0, 0, 0, 0)
+    if reader.bits(1):
+        crop = (reader.ue(), reader.ue(), reader.ue(), reader.ue())
+
+    if chroma_format_idc == 0 or separate_colour_plane:
+        crop_x, crop_y = 1, 2 - frame_mbs_only
+    else:
+        crop_x = 1 if chroma_format_idc == 3 else 2
+        crop_y = (2 if chroma_format_idc == 1 else 1) * (2 - frame_mbs_only)
+
+    return {
+        'profile_idc': profile_idc,
+        'chroma_format_idc': chroma_format_idc,
+        'bit_depth_luma': bit_depth_luma,
+        'bit_depth_chroma': bit_depth_chroma,
+        'width': width_mbs * 16 - (crop[0] + crop[1]) * crop_x,
+        'height': (2 - frame_mbs_only) * height_map_units * 16 - (crop[2] + crop[3]) * crop_y,
+    }
+
+
+class _Track(ABC):
+    """Samples and timing state for one elementary stream"""
+
+    def __init__(self, track_id, timescale):
+        self.track_id = track_id
+        self.timescale = timescale
+        self.samples = []
+        self.ts_offset = 0
+        self.last_dts = None
+        self.step = DEFAULT_VIDEO_STEP
+        self.next_decode_time = None
+
+    @property
+    @abstractmethod
+    def configured(self):
+        """Whether enough codec info has been seen to write the init segment"""
+
+    def timeline(self, dts, keep_timeline):
+        """Unwrap a 90kHz decode timestamp and hide discontinuities unless keeping the timeline"""
+        dts += self.ts_offset
+        if self.last_dts is not None:
+            delta = dts - self.last_dts
+            if delta < -(PTS_WRAP >> 1):
+                self.ts_offset += PTS_WRAP
+                dts += PTS_WRAP
+            elif not keep_timeline and (delta <= 0 or delta > DISCONTINUITY_THRESHOLD):
+                shift = self.last_dts + self.step - dts
+                self.ts_offset += shift
+                dts += shift
+        return dts
+
+
+class _VideoTrack(_Track):
+    """H.264 track"""
+
+    kind = b'vide'
+
+    def __init__(self, track_id):
+        super().__init__(track_id, PTS_CLOCK)
+        self.sps = None
+        self.pps = None
+
+    @property
+    def configured(self):
+        return self.sps is not None and self.pps is not None
+
+    def add_pes(self, pts, dts, payload):
+        """Turn one PES payload (an access unit) into a sample"""
+        nals = _split_nals(payload)
+        data = []
+        sync = False
+        for nal in nals:
+            nal_type = nal[0] & 0x1F
+            if nal_type == NAL_SPS:
+                self.sps = nal
+            elif nal_type == NAL_PPS:
+                self.pps = nal
+            elif nal_type != NAL_AUD:
+                sync = sync or nal_type == NAL_IDR
+                data.append(struct.pack('>I', len(nal)))
+                data.append(nal)
+        if not data:
+            return None
+        data = b''.join(data)
+        if pts is not None and dts is not None and pts - dts < -(PTS_WRAP >> 1):
+            pts += PTS_WRAP
+
+        if pts is None:
+            if self.samples:
+                dts, cts, old, old_sync = self.samples[-1]
+                self.samples[-1] = (dts, cts, old + data, old_sync or sync)
+            return None
+        return dts, pts - dts, data, sync
+
+    def sample_entry(self):
+        """Build the avc1 sample entry"""
+        info = parse_sps(self.sps)
+        avcc = bytes([1, self.sps[1], self.sps[2], self.sps[3], 0xFF, 0xE1]) + \
+            struct.pack('>H', len(self.sps)) + self.sps + \
+            b'\x01' + struct.pack('>H', len(self.pps)) + self.pps
+        if info['profile_idc'] in HIGH_PROFILES:
+            avcc += bytes([0xFC | info['chroma_format_idc'], 0xF8 | info['bit_depth_luma'],
+                           0xF8 | info['bit_depth_chroma'], 0])
+        entry = _box(
+            b'avc1',
+            b'\x00' * 6, struct.pack('>H', 1), b'\x00' * 16,
+            struct.pack('>HHIIIH', info['width'], info['height'], 0x00480000, 0x00480000, 0, 1),
+            b'\x00' * 32, struct.pack('>Hh', 0x18, -1),
+            _box(b'avcC', avcc))
+        return entry, info['width'], info['height']
+
+
+class _AudioTrack(_Track):
+    """AAC (ADTS) track"""
+
+    kind = b'soun'
+
+    def __init__(self, track_id):
+        super().__init__(track_id, 0)
+        self.config = None
+        self.channels = 2
+        self.pending = b''
+        self.next_pts = None
+
+    @property
+    def configured(self):
+        return self.config is not None
+
+    def add_pes(self, pts, payload):
+        """Split a PES payload into ADTS frames, one sample each"""
+        data = self.pending + payload
+        self.pending = b''
+        if pts is None:
+            pts = self.next_pts
+        samples = []
+        pos = 0
+        while pos + 7 <= len(data):
+            if data[pos] != 0xFF or (data[pos + 1] & 0xF0) != 0xF0:
+                pos += 1
+                continue
+            header_size = 7 if data[pos + 1] & 0x01 else 9
+            frame_size = ((data[pos + 3] & 0x03) << 11) | (data[pos + 4] << 3) | \
+                         (data[pos + 5] >> 5)
+            if frame_size < header_size:
+                pos += 1
+                continue
+            if pos + frame_size > len(data):
+                break
+            if self.config is None:
+                object_type = (data[pos + 2] >> 6) + 1
+                rate_index = (data[pos + 2] >> 2) & 0x0F
+                self.channels = ((data[pos + 2] & 0x01) << 2) | (data[pos + 3] >> 6)
+                self.timescale = AAC_SAMPLE_RATES[min(rate_index, len(AAC_SAMPLE_RATES) - 1)]
+                self.step = AAC_FRAME_SAMPLES * PTS_CLOCK // self.timescale
+                self.config = struct.pack('>H', (object_type << 11) | (rate_index << 7) |
+                                          (self.channels << 3))
+            if pts is not None:
+                samples.append((pts, 0, data[pos + header_size:pos + frame_size], True))
+                pts += AAC_FRAME_SAMPLES * PTS_CLOCK // (self.timescale or 44100)
+            pos += frame_size
+        self.pending = data[pos:]
+        self.next_pts = pts
+        return samples
+
+    def sample_entry(self):
+        """Build the mp4a sample entry"""
+        es_descriptor = _descriptor(0x03, struct.pack('>HB', self.track_id, 0) + _descriptor(
+            0x04, struct.pack('>BB3sII', 0x40, 0x15, b'\x00\x00\x00', 0, 0) +
+            _descriptor(0x05, self.config)) + _descriptor(0x06, b'\x02'))
+        entry = _box(
+            b'mp4a',
+            b'\x00' * 6, struct.pack('>H', 1), b'\x00' * 8,
+            struct.pack('>HHHHI', self.channels, 16, 0, 0, (self.timescale << 16) & 0xFFFFFFFF),
+            _full_box(b'esds', 0, 0, es_descriptor))
+        return entry, 0, 0
+
+
+class TsRemuxer:
+    """Incrementally remuxes MPEG-TS bytes into a fragmented MP4 written to out.
+
+    Feed bytes as they arrive with feed(), call flush() at every segment boundary to write a
+    fragment, and close() once the last segment has been fed. With keep_timeline the original
+    timestamps are kept and samples that overlap what has already been written are dropped,
+    which allows stitching overlapping captures together in timestamp order.
+    """
+
+    def __init__(self, out, keep_timeline=False):
+        self.out = out
+        self.keep_timeline = keep_timeline
+        self.bytes_written = 0
+        self._buffer = b''
+        self._pmt_pids = set()
+        self._tracks = dict()
+        self._pes = dict()
+        self._initialized = False
+        self._base_dts = None
+        self._sequence = 0
+
+    def feed(self, data):
+        """Feed raw transport stream bytes (any length)"""
+        data = self._buffer + bytes(data)
+        pos = 0
+        end = len(data) - TS_PACKET_SIZE
+        while pos <= end:
+            if data[pos] != TS_SYNC_BYTE:
+                nxt = data.find(bytes([TS_SYNC_BYTE]), pos + 1)
+                if nxt == -1:
+                    pos = len(data)
+                    break
+                pos = nxt
+                continue
+            self._packet(data[pos:pos + TS_PACKET_SIZE])
+            pos += TS_PACKET_SIZE
+        self._buffer = data[pos:]
+
+    def flush(self):
+        """Finish the current segment and write everything buffered so far as a fragment"""
+        for pid in list(self._pes):
+            self._finish_pes(pid)
+        self._write_fragment(final=False)
+
+    def close(self):
+        """Write out all remaining samples. The output file is complete afterwards."""
+        self.flush()
+        self._write_fragment(final=True)
+        if not self._initialized:
+            raise RemuxError("No H.264 or AAC streams found in transport stream.")
+
+    def _packet(self, packet):
+        """Route one 188 byte TS packet"""
+        pid = ((packet[1] & 0x1F) << 8) | packet[2]
+        pusi = packet[1] & 0x40
+        adaptation = (packet[3] >> 4) & 0x03
+        if not adaptation & 0x01:
+            return
+        offset = 4
+        if adaptation & 0x02:
+            offset += 1 + packet[4]
+        if offset >= TS_PACKET_SIZE:
+            return
+        payload = packet[offset:]
+
+        if pid == 0:
+            if pusi:
+                self._parse_pat(payload[1 + payload[0]:])
+        elif pid in self._pmt_pids:
+            if pusi:
+                self._parse_pmt(payload[1 + payload[0]:])
+        elif pid in self._tracks:
+            if pusi:
+                self._finish_pes(pid)
+                self._pes[pid] = [payload]
+            elif pid in self._pes:
+                self._pes[pid].append(payload)
+
+    def _parse_pat(self, section):
+        """Read program map PIDs from the program association table"""
+        length = ((section[1] & 0x0F) << 8) | section[2]
+        for pos in range(8, min(3 + length - 4, len(section) - 3), 4):
+            program = (section[pos] << 8) | section[pos + 1]
+            if program != 0:
+                self._pmt_pids.add(((section[pos + 2] & 0x1F) << 8) | section[pos + 3])
+
+    def _parse_pmt(self, section):
+        """Create tracks for the H.264 and AAC streams in the program map table"""
+        length = ((section[1] & 0x0F) << 8) | section[2]
+        pos = 12 + (((section[10] & 0x0F) << 8) | section[11])
+        end = min(3 + length - 4, len(section))
+        while pos + 5 <= end:
+            stream_type = section[pos]
+            pid = ((section[pos + 1] & 0x1F) << 8) | section[pos + 2]
+            if pid not in self._tracks and not self._initialized:
+                if stream_type == STREAM_TYPE_H264:
+                    self._tracks[pid] = _VideoTrack(len(self._tracks) + 1)
+                elif stream_type == STREAM_TYPE_AAC:
+                    self._tracks[pid] = _AudioTrack(len(self._tracks) + 1)
+            pos += 5 + (((section[pos + 3] & 0x0F) << 8) | section[pos + 4])
+
+    def _finish_pes(self, pid):
+        """Parse a completed PES packet into samples"""
+        parts = self._pes.pop(pid, None)
+        if not parts:
+            return
+        pes = b''.join(parts)
+        if len(pes) < 9 or pes[:3] != b'\x00\x00\x01':
+            return
+        pts = dts = None
+        if pes[7] & 0x80:
+            pts = dts = _read_timestamp(pes, 9)
+        if pes[7] & 0x40:
+            dts = _read_timestamp(pes, 14)
+        payload = pes[9 + pes[8]:]
+
+        track = self._tracks[pid]
+        if isinstance(track, _VideoTrack):
+            sample = track.add_pes(pts, dts, payload)
+            samples = [sample] if sample else []
+        else:
+            samples = track.add_pes(pts, payload)
+
+        for sample_dts, cts, data, sync in samples:
+            sample_dts = track.timeline(sample_dts, self.keep_timeline)
+            if track.last_dts is not None and sample_dts <= track.last_dts:
+                continue
+            track.last_dts = sample_dts
+            track.samples.append((sample_dts, cts, data, sync))
+
+    def _write(self, data):
+        """Write to the output and keep count"""
+        self.out.write(data)
+        self.bytes_written += len(data)
+
+    def _write_init(self):
+        """Write ftyp and moov once every track has its codec configuration"""
+        tracks = [track for track in self._tracks.values() if track.configured]
+        if not tracks:
+            return False
+        self._tracks = {pid: track for pid, track in self._tracks.items() if track.configured}
+        for track_id, track in enumerate(tracks, 1):
+            track.track_id = track_id
+        self._base_dts = min([track.samples[0][0] for track in tracks if track.samples] or [0])
+
+        traks = []
+        for track in tracks:
+            entry, width, height = track.sample_entry()
+            media_header = _full_box(b'vmhd', 0, 1, b'\x00' * 8) \
+                if track.kind == b'vide' else _full_box(b'smhd', 0, 0, b'\x00' * 4)
+            traks.append(_box(
+                b'trak',
+                _full_box(b'tkhd', 0, 3, struct.pack(
+                    '>IIIII8xhhhh36sII', 0, 0, track.track_id, 0, 0, 0, 0,
+                    0x0100 if track.kind == b'soun' else 0, 0,
+                    struct.pack('>9I', 0x10000, 0, 0, 0, 0x10000, 0, 0, 0, 0x40000000),
+                    width << 16, height << 16)),
+                _box(
+                    b'mdia',
+                    _full_box(b'mdhd', 0, 0, struct.pack('>IIIIHH', 0, 0, track.timescale, 0,
+                                                         0x55C4, 0)),
+                    _full_box(b'hdlr', 0, 0, struct.pack('>I4s12s', 0, track.kind, b''),
+                              b'VideoHandler\x00' if track.kind == b'vide'
+                              else b'SoundHandler\x00'),
+                    _box(
+                        b'minf', media_header,
+                        _box(b'dinf', _full_box(b'dref', 0, 0, struct.pack('>I', 1),
+                                                _full_box(b'url ', 0, 1))),
+                        _box(
+                            b'stbl',
+                            _full_box(b'stsd', 0, 0, struct.pack('>I', 1), entry),
+                            _full_box(b'stts', 0, 0, struct.pack('>I', 0)),
+                            _full_box(b'stsc', 0, 0, struct.pack('>I', 0)),
+                            _full_box(b'stsz', 0, 0, struct.pack('>II', 0, 0)),
+                            _full_box(b'stco', 0, 0, struct.pack('>I', 0)))))))
+
+        self._write(_box(b'ftyp', b'isom', struct.pack('>I', 0x200),
+                         b'isom', b'iso6', b'avc1', b'mp41'))
+        self._write(_box(
+            b'moov',
+            _full_box(b'mvhd', 0, 0, struct.pack(
+                '>IIIIIH10s36s24sI', 0, 0, 1000, 0, 0x10000, 0x0100, b'',
+                struct.pack('>9I', 0x10000, 0, 0, 0, 0x10000, 0, 0, 0, 0x40000000),
+                b'', len(tracks) + 1)),
+            *traks,
+            _box(b'mvex', *[_full_box(b'trex', 0, 0, struct.pack(
+                '>IIIII', track.track_id, 1, 0, 0, 0)) for track in tracks])))
+        self._initialized = True
+        return True
+
+    def _write_fragment(self, final):
+        """Write a moof/mdat pair holding every sample whose duration is known"""
+        if not self._initialized:
+            ready = self._tracks and all(track.configured for track in self._tracks.values())
+            if not (ready or final) or not self._write_init():
+                return
+
+        runs = []
+        for track in self._tracks.values():
+            if final or track.kind == b'soun':
+                samples = track.samples
+            else:
+                samples = track.samples[:-1]
+            if not samples:
+                continue
+            track.samples = track.samples[len(samples):]
+            runs.append(self._run(track, samples))
+        if not runs:
+            return
+
+        self._sequence += 1
+        header = self._build_moof(runs, 0)
+        moof = self._build_moof(runs, len(header) + 8)
+        self._write(moof)
+        self._write(struct.pack('>I4s', 8 + sum(size for _, _, _, _, size in runs), b'mdat'))
+        for _, samples, _, _, _ in runs:
+            for _, _, data, _ in samples:
+                self._write(data)
+
+    def _run(self, track, samples):
+        """Work out decode time and trun entries for a track's samples in the next fragment"""
+        if track.kind == b'vide':
+            decode_time = max(samples[0][0] - self._base_dts, 0)
+            following = track.samples[0][0] if track.samples else None
+            entries = []
+            for idx, (dts, cts, data, sync) in enumerate(samples):
+                nxt = samples[idx + 1][0] if idx + 1 < len(samples) else following
+                if nxt is not None:
+                    track.step = nxt - dts
+                entries.append(struct.pack(
+                    '>IIIi', track.step, len(data),
+                    SYNC_SAMPLE_FLAGS if sync else NON_SYNC_SAMPLE_FLAGS, cts))
+            flags = 0x000F01
+        else:
+            decode_time = max(samples[0][0] - self._base_dts, 0) * track.timescale // PTS_CLOCK
+            if track.next_decode_time is not None and \
+                    abs(decode_time - track.next_decode_time) < AAC_FRAME_SAMPLES:
+                decode_time = track.next_decode_time
+            track.next_decode_time = decode_time + AAC_FRAME_SAMPLES * len(samples)
+            entries = [struct.pack('>II', AAC_FRAME_SAMPLES, len(data))
+                       for _, _, data, _ in samples]
+            flags = 0x000301
+        size = sum(len(data) for _, _, data, _ in samples)
+        return track, samples, (decode_time, flags, entries), len(samples), size
+
+    def _build_moof(self, runs, data_offset):
+        """Build the moof box for the given runs, with mdat payload starting at data_offset"""
+        trafs = []
+        for track, _, (decode_time, flags, entries), count, size in runs:
+            trafs.append(_box(
+                b'traf',
+                _full_box(b'tfhd', 0, 0x020000, struct.pack('>I', track.track_id)),
+                _full_box(b'tfdt', 1, 0, struct.pack('>Q', decode_time)),
+                _full_box(b'trun', 1, flags, struct.pack('>Ii', count, data_offset), *entries)))
+            data_offset += size
+        return _box(b'moof', _full_box(b'mfhd', 0, 0, struct.pack('>I', self._sequence)), *trafs)
+
+
+def remux_files(ts_paths, mp4_path, keep_timeline=False, block_size=1 << 20):
+    """Remux a sequence of .ts files (segments of one stream) into a single fragmented .mp4"""
+    with open(mp4_path, 'wb') as handle:
+        remuxer = TsRemuxer(handle, keep_timeline=keep_timeline)
+        for ts_path in ts_paths:
+            with open(ts_path, 'rb') as ts_file:
+                for block in iter(lambda: ts_file.read(block_size), b''):
+                    remuxer.feed(block)
+            remuxer.flush()
+        remuxer.close()
+    return remuxer.bytes_written
+
+
+class _TimestampProbe(TsRemuxer):
+    """Demuxer that only records the presentation timestamps of each stream"""
+
+    def __init__(self):
+        super().__init__(None)
+        self.spans = dict()
+
+    def _finish_pes(self, pid):
+        parts = self._pes.pop(pid, None)
+        if not parts:
+            return
+        pes = parts[0]
+        if len(pes) < 14 or pes[:3] != b'\x00\x00\x01' or not pes[7] & 0x80:
+            return
+        pts = _read_timestamp(pes, 9)
+        kind = self._tracks[pid].kind
+        first, last = self.spans.get(kind, (pts, pts))
+        self.spans[kind] = (min(first, pts), max(last, pts))
+
+    def _write_fragment(self, final):
+        pass
+
+
+def probe_timestamps(blocks):
+    """(first, last) presentation timestamps (90kHz) of the video in an iterable of TS byte
+    blocks, or of the audio if there is no video. None if no timestamps were found."""
+    probe = _TimestampProbe()
+    for block in blocks:
+        probe.feed(block)
+    probe.flush()
+    return probe.spans.get(b'vide') or probe.spans.get(b'soun')
+
+
+def probe_file(ts_path, block_size=1 << 20):
+    """probe_timestamps for a .ts file"""
+    with open(ts_path, 'rb') as ts_file:
+        return probe_timestamps(iter(lambda: ts_file.read(block_size), b''))
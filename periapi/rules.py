@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+Periscope API for the masses
+
+Capture rules deciding which broadcasts are worth downloading
+"""
+
+import threading
+
+from collections import Counter, OrderedDict
+
+from periapi.library import LibraryIndex
+from periapi.logging import logging
+
+MODES = ('both', 'live', 'replay')
+PRIVATE_HANDLING = ('include', 'exclude', 'only')
+RULE_KEYS = ('include_users', 'exclude_users', 'mode', 'private', 'min_duration', 'languages',
+             'max_concurrent_per_user', 'skip_captured_lives')
+# Rules that only hold a broadcast back for now, rather than drop it
+LIMIT_RULES = ('max_concurrent_per_user',)
+# Broadcasts remembered as dropped, so one seen on every poll is only counted once
+DROPPED_IDS_KEPT = 10000
+
+
+class CaptureRules:
+    """The 'capture_rules' config compiled into one list of predicates per user. Example:
+
+        {"exclude_users": ["spammer"], "min_duration": 60, "languages": ["en", "de"],
+         "mode": "both", "private": "exclude", "max_concurrent_per_user": 1,
+         "skip_captured_lives": true, "users": {"friend": {"private": "include"}}}
+
+    mode is 'both', 'live' or 'replay'; private is 'include', 'exclude' or 'only'. Entries in
+    "users" override the other rules for one user. Counts how many broadcasts each rule
+    dropped, each broadcast once; broadcasts held back by a limit rule aren't counted."""
+
+    def __init__(self, rules=None, count_active=None, library_index=None):
+        self.rules = dict(rules or dict())
+        self.overrides = dict((username.casefold(), dict(self.rules, **user_rules))
+                              for username, user_rules in self.rules.pop('users', dict()).items())
+        self.count_active = count_active
+        self.library_index = library_index
+        self.dropped = Counter()
+        self.dropped_ids = OrderedDict()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+        unknown = set(self.rules) - set(RULE_KEYS)
+        for user_rules in self.overrides.values():
+            unknown.update(set(user_rules) - set(RULE_KEYS))
+        if unknown:
+            raise ValueError("Unknown capture rules: {}".format(", ".join(sorted(unknown))))
+
+        self.predicates = self.compile(self.rules)
+        self.user_predicates = dict((username, self.compile(user_rules))
+                                    for username, user_rules in self.overrides.items())
+
+    def compile(self, rules):
+        """List of (rule name, predicate) for a set of rules. Predicates take a broadcast and
+        the number of the user's broadcasts being queued alongside it."""
+        predicates = list()
+
+        if rules.get('include_users'):
+            include = set(i.casefold() for i in rules['include_users'])
+            predicates.append(('include_users', lambda bc, _: bc.username.casefold() in include))
+        if rules.get('exclude_users'):
+            exclude = set(i.casefold() for i in rules['exclude_users'])
+            predicates.append(('exclude_users',
+                               lambda bc, _: bc.username.casefold() not in exclude))
+
+        mode = rules.get('mode') or 'both'
+        if mode not in MODES:
+            raise ValueError("Capture rule mode must be one of {}".format(", ".join(MODES)))
+        if mode == 'live':
+            predicates.append(('mode', lambda bc, _: bc.islive))
+        elif mode == 'replay':
+            predicates.append(('mode', lambda bc, _: bc.isreplay))
+
+        private = rules.get('private') or 'include'
+        if private not in PRIVATE_HANDLING:
+            raise ValueError("Capture rule private must be one of {}".format(
+                ", ".join(PRIVATE_HANDLING)))
+        if private == 'exclude':
+            predicates.append(('private', lambda bc, _: not bc.private))
+        elif private == 'only':
+            predicates.append(('private', lambda bc, _: bc.private))
+
+        # Only ended broadcasts have a length; lives are let through
+        if rules.get('min_duration'):
+            min_duration = float(rules['min_duration'])
+            predicates.append(('min_duration', lambda bc, _: bc.duration is None or
+                               bc.duration >= min_duration))
+
+        if rules.get('languages'):
+            languages = set(i.casefold() for i in rules['languages'])
+            predicates.append(('languages', lambda bc, _: not bc.language or
+                               bc.language.casefold() in languages))
+
+        if rules.get('skip_captured_lives') and self.library_index is not None:
+            predicates.append(('skip_captured_lives', self._not_captured_live))
+
+        if rules.get('max_concurrent_per_user') and self.count_active is not None:
+            limit = int(rules['max_concurrent_per_user'])
+            predicates.append(('max_concurrent_per_user', lambda bc, queued: queued is None or
+                               self.count_active(bc.username) + queued < limit))
+
+        return predicates
+
+    def _not_captured_live(self, broadcast, _):
+        """Whether broadcast isn't the replay of a live broadcast that is in the library"""
+        if not broadcast.isreplay:
+            return True
+        # One connection per thread (sqlite connections can't be shared), kept between polls
+        if getattr(self.local, 'index', None) is None:
+            self.local.index = LibraryIndex(self.library_index)
+        return not self.local.index.has(broadcast.id, 'live')
+
+    def check(self, broadcast, queued=0):
+        """Whether broadcast passes every rule that applies to its user. queued is the number
+        of the user's broadcasts accepted alongside it; None skips the concurrency limit."""
+        return self.failed_rule(broadcast, queued) is None
+
+    def failed_rule(self, broadcast, queued=0):
+        """Name of the first rule broadcast fails, or None if it passes them all (queued as
+        for check)"""
+        predicates = self.user_predicates.get(broadcast.username.casefold(), self.predicates)
+        for name, predicate in predicates:
+            if not predicate(broadcast, queued):
+                if name in LIMIT_RULES:
+                    logging.debug("Capture rule %s held back %s", name, broadcast.title)
+                else:
+                    self.count_drop(name, broadcast.id)
+                    logging.debug("Capture rule %s dropped %s", name, broadcast.title)
+                return name
+        return None
+
+    def count_drop(self, name, broadcast_id):
+        """Count a broadcast dropped by a rule, unless it was dropped before"""
+        with self.lock:
+            if broadcast_id in self.dropped_ids:
+                return None
+            self.dropped_ids[broadcast_id] = name
+            if len(self.dropped_ids) > DROPPED_IDS_KEPT:
+                self.dropped_ids.popitem(last=False)
+            self.dropped[name] += 1
+
+    @property
+    def counts(self):
+        """Copy of the number of broadcasts dropped per rule"""
+        with self.lock:
+            return Counter(self.dropped)
+
+    @property
+    def summary(self):
+        """Human readable counts of broadcasts dropped per rule, or None if none were"""
+        counts = self.counts
+        if not counts:
+            return None
+        return ", ".join("{0} {1}".format(name, count) for name, count in counts.most_common())
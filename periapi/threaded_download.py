@@ -9,8 +9,16 @@ Much of the code in this file is a modification of Pyriscope code. Modification
 https://github.com/crusherw; viewable at https://github.com/rharkanson/pyriscope/pull/12
 """
 
-from threading import Thread, Event
-from queue import Queue, Empty
+import time
+
+from collections import deque
+from threading import Thread, Event, Lock
+from queue import Queue, Empty, Full
+
+HEDGE_FACTOR = 2.0
+HEDGE_MIN_WAIT = 1.0
+HEDGE_SAMPLE_SIZE = 200
+RETRY_WAIT = 1.0
 
 
 class ReplayDeleted(Exception):
@@ -23,17 +31,19 @@ class TasksInfo:
     def __init__(self, name, num_tasks):
         self.name = name
         self.num_tasks = num_tasks
+        self.num_tasks_added = 0
         self.num_tasks_complete = 0
 
     def is_complete(self):
-        """Are all tasks complete?"""
-        return self.num_tasks_complete == self.num_tasks
+        """Are all tasks complete? Never true while the task count is still unknown."""
+        return self.num_tasks is not None and self.num_tasks_complete == self.num_tasks
 
 
 class Worker(Thread):
     """Subclass of Thread with modifications to detect pool starvation and deleted replays"""
     def __init__(self, thread_pool):
-        Thread.__init__(self)
+        Thread.__init__(self, daemon=True)
+        self.pool = thread_pool
         self.tasks = thread_pool.tasks
         self.tasks_info = thread_pool.tasks_info
         self.stop = thread_pool.stop
@@ -42,21 +52,33 @@ class Worker(Thread):
     def run(self):
         """Thread method modified to check for conditions deleted replays can cause"""
         while not self.stop.is_set():
+            queued = True
             try:
                 # don't block forever, ...
-                func, args, kargs = self.tasks.get(timeout=0.5)
+                task = self.tasks.get(timeout=0.5)
             except Empty:
                 # ...check periodically if we should stop
+                if self.tasks_info.is_complete():
+                    self.stop.set()
+                    continue
+                # ...or if the tasks left all failed for good, in which case nothing will
+                # ever complete the pool
+                if self.pool.is_settled():
+                    return None
+                # ...or if a straggling task is worth duplicating
+                task = self.pool.next_hedge()
+                if task is None:
+                    continue
+                queued = False
+
+            task_id, func, args, kargs = task
+            if not self.pool.task_started(task_id, task):
                 continue
+            if self.pool.run_task(func, args, kargs, task_id):
+                self.pool.task_finished(task_id)
 
-            try:
-                func(*args, **kargs)
-            except Exception as _:
-                raise Exception("Error: ThreadPool Worker Exception: {}".format(_))
-
-            self.tasks_info.num_tasks_complete += 1
-
-            self.tasks.task_done()
+            if queued:
+                self.tasks.task_done()
 
             if self.tasks_info.is_complete():
                 # stop other threads, no more work
@@ -64,26 +86,136 @@ class Worker(Thread):
 
 
 class ThreadPool:
-    """Object to dole out tasks to threads and track their completion"""
-    def __init__(self, name, num_threads, num_tasks):
-        self.tasks = Queue(0)
+    """Object to dole out tasks to threads and track their completion.
+
+    If num_tasks isn't known up front, call close() once the last task has been added. With
+    max_queued set, add_task blocks while that many tasks are waiting for a worker so a
+    producer can stream tasks in without queueing all of them at once. A failed task is tried
+    up to retries more times, when retry_if (if given) says its error is worth it."""
+    def __init__(self, name, num_threads, num_tasks=None, max_queued=0, hedge=False, retries=0,
+                 retry_if=None):
+        self.tasks = Queue(max_queued)
         self.tasks_info = TasksInfo(name, num_tasks)
         self.stop = Event()
+        self.hedge = hedge
+        self.retries = retries
+        self.retry_if = retry_if
+        self.lock = Lock()
+        self.in_flight = dict()
+        self.finished = set()
+        self.lost = set()
+        self.failure = None
+        self.durations = deque(maxlen=HEDGE_SAMPLE_SIZE)
         self.workers = [Worker(self) for _ in range(num_threads)]
 
     def add_task(self, func, *args, **kwargs):
-        """Add a task to the pool"""
-        self.tasks.put((func, args, kwargs))
+        """Add a task to the pool, waiting for room in the queue if it is bounded"""
+        self.tasks_info.num_tasks_added += 1
+        task = (self.tasks_info.num_tasks_added, func, args, kwargs)
+        while True:
+            try:
+                self.tasks.put(task, timeout=0.5)
+                return
+            except Full:
+                if not any(worker.is_alive() for worker in self.workers):
+                    raise ReplayDeleted("Replay was deleted.") from self.failure
+
+    def close(self):
+        """Signal that no more tasks will be added"""
+        self.tasks_info.num_tasks = self.tasks_info.num_tasks_added
+        if self.tasks_info.is_complete():
+            self.stop.set()
+
+    def run_task(self, func, args, kwargs, task_id):
+        """Run a task, retrying it with a growing wait. Returns whether it succeeded; a task
+        lost for good keeps the pool from completing, which wait_completion reports, while
+        the worker carries on with the other tasks."""
+        attempt = 0
+        while True:
+            try:
+                func(*args, **kwargs)
+                return True
+            except Exception as error:
+                attempt += 1
+                if attempt > self.retries or self.stop.is_set() or task_id in self.finished or \
+                        (self.retry_if is not None and not self.retry_if(error)):
+                    self.task_failed(task_id, error)
+                    return False
+            time.sleep(RETRY_WAIT * attempt)
+
+    def task_started(self, task_id, task):
+        """Record that a worker is starting a task (or a duplicate of it). Returns False if
+        the task has already been finished by another worker and needn't run."""
+        with self.lock:
+            if task_id in self.finished:
+                return False
+            entry = self.in_flight.setdefault(task_id, [task, time.time(), 0, False])
+            entry[2] += 1
+            return True
+
+    def task_finished(self, task_id):
+        """Record a finished task. Only the first copy of a hedged task to finish counts, and a
+        task already given up on is no longer lost."""
+        with self.lock:
+            if task_id in self.finished:
+                return
+            self.finished.add(task_id)
+            self.lost.discard(task_id)
+            entry = self.in_flight.pop(task_id, None)
+            if entry is not None:
+                self.durations.append(time.time() - entry[1])
+            self.tasks_info.num_tasks_complete += 1
+
+    def task_failed(self, task_id, error=None):
+        """Record a failed copy of a task. Returns True if the failure can be ignored because
+        another copy of the task finished or is still running. The error of the first task lost
+        for good is kept as the cause of the pool's ReplayDeleted."""
+        with self.lock:
+            if task_id in self.finished:
+                return True
+            entry = self.in_flight.get(task_id)
+            if entry is not None:
+                entry[2] -= 1
+                if entry[2] > 0:
+                    return True
+                del self.in_flight[task_id]
+            self.lost.add(task_id)
+            self.failure = self.failure or error
+            return False
+
+    def next_hedge(self):
+        """Once every task has been handed out, pick a task that has been running much longer
+        than the median task to run a speculative duplicate of, so one slow request doesn't
+        decide when the whole pool finishes. Each task is duplicated at most once."""
+        if not self.hedge or self.tasks_info.num_tasks is None or not self.tasks.empty():
+            return None
+        with self.lock:
+            if not self.durations:
+                return None
+            median = sorted(self.durations)[len(self.durations) // 2]
+            cutoff = time.time() - max(median * HEDGE_FACTOR, HEDGE_MIN_WAIT)
+            for entry in self.in_flight.values():
+                if not entry[3] and entry[1] < cutoff:
+                    entry[3] = True
+                    return entry[0]
+        return None
 
     def is_complete(self):
         """Check if tasks are complete"""
         return self.tasks_info.is_complete()
 
+    def is_settled(self):
+        """Whether every task has either finished or failed for good (each counted once)"""
+        with self.lock:
+            return self.tasks_info.num_tasks is not None and \
+                len(self.finished) + len(self.lost) == self.tasks_info.num_tasks
+
     def wait_completion(self):
         """Check for dead workers and finish up"""
         # If all workers quit because of errors, tasks.join()
-        # will never return. Join worker threads instead.
-        while self.workers:
+        # will never return. Join worker threads instead. Stop waiting as soon as every task
+        # is done, even if the losing copy of a hedged task is still running.
+        while self.workers and not self.tasks_info.is_complete():
             try:
                 self.workers = [w for w in self.workers if w.is_alive()]
                 for worker in self.workers:
@@ -94,4 +226,4 @@ class ThreadPool:
                 self.stop.set()
 
         if not self.stop.is_set() and not self.tasks_info.is_complete():
-            raise ReplayDeleted("Replay was deleted.")
+            raise ReplayDeleted("Replay was deleted.") from self.failure
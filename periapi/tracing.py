@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+Periscope API for the masses
+
+Per phase timing traces of downloads
+"""
+
+import json
+import os
+import time
+
+from collections import deque, namedtuple
+from contextlib import contextmanager
+
+from periapi.logging import logging
+from periapi.polling import percentile
+
+TRACE_FILENAME = '.periapi-traces.jsonl'
+TRACE_HISTORY = 200
+TRACE_FILE_MAX_BYTES = 8 << 20
+MAX_TRACED_ATTEMPTS = 5
+
+PhaseSummary = namedtuple('PhaseSummary', 'phase count total median p90 slowest bytes')
+
+# pylint: disable=invalid-name
+trace_log = logging.getChild('trace')
+# pylint: enable=invalid-name
+
+
+def trace_path(config):
+    """Location of the trace file: the trace_file config key, or next to the config file"""
+    if config.get('trace_file'):
+        return config.get('trace_file')
+    return os.path.join(os.path.dirname(os.path.abspath(config.file)), TRACE_FILENAME)
+
+
+def begin_attempt(broadcast):
+    """Start a new list of spans for a download attempt, keeping the last few attempts"""
+    broadcast.trace.append(list())
+    del broadcast.trace[:-MAX_TRACED_ATTEMPTS]
+
+
+@contextmanager
+def span(broadcast, phase):
+    """Time a phase of the current download attempt. The yielded dict can be given a 'bytes'
+    count. The finished span is logged as a JSON line and kept in the broadcast's trace."""
+    record = {'broadcast': broadcast.id, 'phase': phase, 'start': time.time(), 'bytes': None}
+    try:
+        yield record
+    except BaseException as error:
+        record['error'] = repr(error)
+        raise
+    finally:
+        record['end'] = time.time()
+        record['duration'] = record['end'] - record['start']
+        if not broadcast.trace:
+            begin_attempt(broadcast)
+        broadcast.trace[-1].append(record)
+        trace_log.info(json.dumps(record, sort_keys=True))
+
+
+def save_trace(path, broadcast, download_ok):
+    """Append the spans of the broadcast's last download attempt to the trace file, trimming
+    the file to the most recent TRACE_HISTORY attempts once it grows past its size limit"""
+    if not broadcast.trace or not broadcast.trace[-1]:
+        return None
+    line = json.dumps({'broadcast': broadcast.id, 'title': broadcast.title, 'ok': download_ok,
+                       'spans': broadcast.trace[-1]}, sort_keys=True)
+    try:
+        with open(path, 'a') as trace_file:
+            trace_file.write(line + '\n')
+        if os.path.getsize(path) > TRACE_FILE_MAX_BYTES:
+            with open(path) as trace_file:
+                recent = deque(trace_file, maxlen=TRACE_HISTORY)
+            with open(path + '.tmp', 'w') as trace_file:
+                trace_file.writelines(recent)
+            os.replace(path + '.tmp', path)
+    except OSError as error:
+        logging.warning("Could not save download trace: %s", error)
+
+
+def read_traces(path, recent=TRACE_HISTORY):
+    """The last recent download attempts recorded in the trace file"""
+    if not os.path.exists(path):
+        return list()
+    traces = deque(maxlen=recent)
+    with open(path) as trace_file:
+        for line in trace_file:
+            try:
+                traces.append(json.loads(line))
+            except ValueError:
+                continue
+    return list(traces)
+
+
+def summarize(traces):
+    """PhaseSummary of each phase over traces, the phase taking the most time in total first.
+    slowest is the (duration, title) of the slowest span of the phase."""
+    durations = dict()
+    slowest = dict()
+    byte_counts = dict()
+    for trace in traces:
+        for record in trace.get('spans', list()):
+            phase = record['phase']
+            durations.setdefault(phase, list()).append(record['duration'])
+            if record['duration'] > slowest.get(phase, (-1, None))[0]:
+                slowest[phase] = (record['duration'], trace.get('title'))
+            byte_counts[phase] = byte_counts.get(phase, 0) + (record.get('bytes') or 0)
+    summaries = [PhaseSummary(phase, len(values), sum(values), percentile(values, 0.5),
+                              percentile(values, 0.9), slowest[phase], byte_counts[phase])
+                 for phase, values in durations.items()]
+    return sorted(summaries, key=lambda summary: summary.total, reverse=True)